@@ -1,32 +1,48 @@
-from auth import get_openai_client
-from settings import OMDB_URL
+from helpers import acreate_chat_completion, create_chat_completion
+from http_client import get_wikipedia
+from metrics import metrics
+from rate_limiter import rate_limiter
+from movie_data.omdb import alookup_movie, lookup_movie
+from movie_data.wikipedia import afetch_longer_plot, find_stored_plot, should_fetch_plot, wikipedia_flight
+from settings import WIKIPEDIA_PLOT_MAX_LENGTH
 from user_profile import UserProfile
-from settings import OPENAI_MODEL
+from enrichment import MovieEnrichmentPipeline
+from typing import List
 
-import os
 import logging
-import requests
-import wikipediaapi
-
-omdb_api_key = os.getenv('OMDB_API_KEY')
-client = get_openai_client()
 
 class MovieChoiceExplainer():
-    def explain_movie(self, movie, user_profile: UserProfile, ) -> str:
-        """Generates a short explanation of why the user would like the movie based on the user profile metadata."""        
+    def _explanation_messages(self, movie, user_profile: UserProfile) -> List[dict]:
         metadata = user_profile.to_metadata_str()
-        explanation = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "You are a movie expert that provides compact movie recommendations. Take a deep breath, and let's get started!"},
-                {"role": "system", "content": f"Movie plot: {movie.longer_plot}"},
-                {"role": "user", "content": f"Explain why the user would like the movie: {movie.title}. The plot is provided. Be honest, but keep it short. User profile: {metadata}"}
-            ],
-            max_tokens=200
-        )
-        return explanation.choices[0].message.content.strip()
+        return [
+            {"role": "system", "content": "You are a movie expert that provides compact movie recommendations. Take a deep breath, and let's get started!"},
+            {"role": "system", "content": f"Movie plot: {movie.longer_plot}"},
+            {"role": "user", "content": f"Explain why the user would like the movie: {movie.title}. The plot is provided. Be honest, but keep it short. User profile: {metadata}"}
+        ]
+
+    @metrics.instrument("movie.explain")
+    def explain_movie(self, movie, user_profile: UserProfile, ) -> str:
+        """Generates a short explanation of why the user would like the movie based on the user profile metadata. Cached per (movie plot, profile)."""        
+        return create_chat_completion(messages=self._explanation_messages(movie, user_profile), max_tokens=200)
+
+    @metrics.instrument("movie.explain")
+    async def aexplain_movie(self, movie, user_profile: UserProfile) -> str:
+        """Async version of explain_movie."""
+        return await acreate_chat_completion(messages=self._explanation_messages(movie, user_profile), max_tokens=200)
 
 class MovieDataRetriever():
+    def fetch_movie_data(self, title: str, year: str = None) -> dict | None:
+        """Tries to get a movie by title and year from the OMDB API, without summarizing the plot. Lookups are cached on disk.
+
+        Args:
+            title (str): The title of the movie.
+            year (str, optional): The year of the movie. Defaults to None as not every movie comes provided with one
+
+        Returns:
+            dict | None: Returns the movie data from OMDB or None if the movie is not found.
+        """
+        return lookup_movie(title, year)
+
     def get_movie_by_title(self, title: str, year: str = None) -> dict | None:
         """Tries to get a movie by title and year from the OMDB API.
 
@@ -35,39 +51,46 @@ class MovieDataRetriever():
             year (str, optional): The year of the movie. Defaults to None as not every movie comes provided with one
 
         Returns:
-            dict | None: Returns the movie data from OMDB or None if the movie is not found.
+            dict | None: Returns the movie data from OMDB, with a summarized plot, or None if the movie is not found.
         """
-        response = requests.get(OMDB_URL, params={"apikey": omdb_api_key, "t": title, "plot": "full", "y": year})
-        data = response.json()
-        if data['Response'] == "True":
+        data = self.fetch_movie_data(title, year)
+        if data is not None:
             data['Plot'] = self.summarize_plot(data['Plot'])
-            return data
-        else:
-            logging.error("Movie not found: %s", title)
-            return None
+        return data
     
-    def get_longer_plot(self, title) -> str | None:
+    def get_longer_plot(self, title, year: str = None) -> str | None:
         """Ideally, we would like to get a longer plot from Wikipedia. This is because the OMDB plot is often too short for a comprehensive explanation / summary. 
+        The plot store imported from a Wikipedia dump is checked first, see movie_data/wikipedia_dump.py.
 
         Args:
             title (_type_): The title of the movie. Needed for wikipedia search.
+            year (str, optional): The year of the movie, used to find it in the plot store.
 
         Returns:
             str: The plot, extracted from Wikipedia.
         """
-        wiki_wiki = wikipediaapi.Wikipedia(user_agent='movie-recommender',language='en')
-        page = wiki_wiki.page(f"{title}")
+        plot = find_stored_plot(title, year)
+        if plot is not None or not should_fetch_plot():
+            return plot
+        # Concurrent requests for the same plot share a single page fetch
+        return wikipedia_flight.do(title, self._fetch_plot_section, title)
+
+    @metrics.instrument("wikipedia.plot")
+    def _fetch_plot_section(self, title) -> str | None:
+        rate_limiter.acquire("wikipedia")
+        page = get_wikipedia().page(f"{title}")
         if page.exists():
             plot_section = page.section_by_title('Plot')
             if plot_section:
                 plot_text = plot_section.text
-                if len(plot_text) > 2500:
-                    plot_text = plot_text[:2500]
+                if len(plot_text) > WIKIPEDIA_PLOT_MAX_LENGTH:
+                    plot_text = plot_text[:WIKIPEDIA_PLOT_MAX_LENGTH]
                 return plot_text
         return None
     
+    @metrics.instrument("movie.summarize_plot")
     def summarize_plot(self, plot: str) -> str:
-        """Summarizes the provided plot using GPT-3.5-turbo.
+        """Summarizes the provided plot using GPT-3.5-turbo. The same plot is only summarized once, see helpers.create_chat_completion.
 
         Args:
             plot (str): The plot to summarize
@@ -76,22 +99,34 @@ class MovieDataRetriever():
             str: _description_
         """
         logging.debug("Summarizing plot with AI")
+        return create_chat_completion(messages=self._summary_messages(plot), max_tokens=500)
+
+    async def afetch_movie_data(self, title: str, year: str = None) -> dict | None:
+        """Async version of fetch_movie_data."""
+        return await alookup_movie(title, year)
+
+    async def aget_longer_plot(self, title, year: str = None) -> str | None:
+        """Async version of get_longer_plot."""
+        return await afetch_longer_plot(title, year)
+
+    @metrics.instrument("movie.summarize_plot")
+    async def asummarize_plot(self, plot: str) -> str:
+        """Async version of summarize_plot."""
+        return await acreate_chat_completion(messages=self._summary_messages(plot), max_tokens=500)
+
+    def _summary_messages(self, plot: str) -> List[dict]:
         prompt = (f"Summarize the following plot:\n\n{plot}")
-        response = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that has in-depth movie knowledge."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500
-        )
-        return response.choices[0].message.content.strip()
+        return [
+            {"role": "system", "content": "You are a helpful assistant that has in-depth movie knowledge."},
+            {"role": "user", "content": prompt}
+        ]
 
 movie_data_retriever = MovieDataRetriever()
 movie_choice_explainer = MovieChoiceExplainer()
+enrichment_pipeline = MovieEnrichmentPipeline(movie_data_retriever, movie_choice_explainer)
 
 class Movie():
-    def __init__(self, title: str, explanation: str = None, year: int =None, user_profile: UserProfile = None) -> None:
+    def __init__(self, title: str, explanation: str = None, year: int =None, user_profile: UserProfile = None, enrich: bool = True) -> None:
         self.movie_data_retriever = movie_data_retriever
         self.movie_choice_explainer = movie_choice_explainer
         self.title = title
@@ -109,26 +144,12 @@ class Movie():
         self.actors = None
         self.longer_plot = None
         self.user_profile_used = user_profile
+        self.validated = False
         
-        # TODO fix this code, convoluted
-        # Gets movie by title and year, then uses the response to set all above attributes in set_attributes
-        self.set_attributes(self.movie_data_retriever.get_movie_by_title(title=title, year=year))
-        
-        # If the response is not None, it will continue 
-        if self.validated:
-            
-            # Retrieve longer plot from wikipedia if possible, and summarize it
-            self.longer_plot = self.movie_data_retriever.get_longer_plot(self.title)
-            if self.longer_plot:
-                self.plot = self.movie_data_retriever.summarize_plot(self.longer_plot)
-            
-            else:
-                # If we can't retrieve it, summarize it from the 3 lines of IMDB plot
-                self.plot = self.movie_data_retriever.summarize_plot(self.plot)
-                
-            if self.reason is None and self.user_profile_used is not None:
-                # If no reason has been given yet, we create our own!
-                self.reason = self.movie_choice_explainer.explain_movie(self, self.user_profile_used)
+        # Gets movie by title and year from OMDB, the longer plot from Wikipedia, and summarizes and explains it.
+        # Pass enrich=False and use create_movies to enrich several movies concurrently.
+        if enrich:
+            enrichment_pipeline.enrich(self)
 
     def set_attributes(self, data: dict | None) -> None:
         """Write the data to the Movie instance attributes.
@@ -145,7 +166,35 @@ class Movie():
             setattr(self, attr_name, value)    
         self.validated = True
     
+    def to_dict(self) -> dict:
+        """Returns the movie data as a JSON serializable dictionary, without the helpers and the user profile."""
+        return {attr: value for attr, value in self.__dict__.items()
+                if attr not in ("movie_data_retriever", "movie_choice_explainer", "user_profile_used")}
+
     def print_attributes(self):
         """Print all attributes of the Movie instance."""
         for attr, value in self.__dict__.items():
-            print(f"{attr}: {value}")
\ No newline at end of file
+            print(f"{attr}: {value}")
+
+def create_movies(movies: List[dict]) -> List[Movie]:
+    """Creates and enriches several movies concurrently.
+
+    Args:
+        movies (List[dict]): The keyword arguments of every Movie, e.g. {"title": "The Matrix", "year": "1999"}.
+
+    Returns:
+        List[Movie]: The enriched movies, in the same order as they were given.
+    """
+    return enrichment_pipeline.enrich_all([Movie(**kwargs, enrich=False) for kwargs in movies])
+
+
+async def acreate_movies(movies: List[dict]) -> List[Movie]:
+    """Async version of create_movies. Enrichment runs on the event loop instead of a thread pool.
+
+    Args:
+        movies (List[dict]): The keyword arguments of every Movie, e.g. {"title": "The Matrix", "year": "1999"}.
+
+    Returns:
+        List[Movie]: The enriched movies, in the same order as they were given.
+    """
+    return await enrichment_pipeline.aenrich_all([Movie(**kwargs, enrich=False) for kwargs in movies])
@@ -1,21 +1,25 @@
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import time
+
 from typing import List
 from enum import Enum
-from typing import List
-from fastapi import FastAPI
-from recommenders.SubtitleRecommender import SubtitleRecommender
-from recommenders.OpenAIRecommender import AIAssistRecommender, PureAIRecommender
-from recommenders.WorstMovieRecommender import  WorstMovieRecommender
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from metrics import metrics, request_timings, server_timing_header
+from rate_limiter import RateLimitExceeded
+from recommenders.RecommenderRegistry import RecommenderRegistry, lazy_factory
 from movie_data.tmdb import get_genres, get_actors, get_keyword_ids, discover_movies
 from movie_data.omdb import get_movie_by_title
 from dotenv import load_dotenv
-from fastapi import FastAPI
-from movie_data.omdb import get_movie_by_title
-from dotenv import load_dotenv
 import uvicorn
+from settings import SERVER_TIMING
 from user_profile import UserProfile    
 
-app = FastAPI()
-
     
 class RecommendationSystem(str, Enum):
     SUBTITLES = "subtitles"
@@ -23,21 +27,116 @@ class RecommendationSystem(str, Enum):
     PUREAI = "pureai"
     WORSTMOVIE = "worstmovie"
 
+# Every recommender is built once and shared by all requests
+# The recommender modules are only imported when they are built, so importing the API stays fast
+registry = RecommenderRegistry({
+    RecommendationSystem.SUBTITLES.value: lazy_factory("recommenders.SubtitleRecommender", "SubtitleRecommender"),
+    RecommendationSystem.AIASSIST.value: lazy_factory("recommenders.OpenAIRecommender", "AIAssistRecommender"),
+    RecommendationSystem.PUREAI.value: lazy_factory("recommenders.OpenAIRecommender", "PureAIRecommender"),
+    RecommendationSystem.WORSTMOVIE.value: lazy_factory("recommenders.WorstMovieRecommender", "WorstMovieRecommender"),
+})
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the corpora in the background, requests for a recommender that is still loading wait for it
+    registry.warm_up()
+    yield
+    registry.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_exceeded(request: Request, exc: RateLimitExceeded):
+    """An external service is out of budget for longer than a request may wait, see rate_limiter.py."""
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(math.ceil(exc.retry_after))})
+
+def _add_server_timing(response: Response, timings: List, start: float) -> None:
+    """Adds the time spent per stage to the response, if SERVER_TIMING is set."""
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = server_timing_header(timings, time.perf_counter() - start)
+
 @app.post("/recommend/{system}", tags=["Recommendations"])
-def recommend(system: RecommendationSystem, user_profile: UserProfile):
-    if system == RecommendationSystem.SUBTITLES:
-        recommender = SubtitleRecommender()
-    elif system == RecommendationSystem.AIASSIST:
-        recommender = AIAssistRecommender()
-    elif system == RecommendationSystem.PUREAI:
-        recommender = PureAIRecommender()
-    elif system == RecommendationSystem.WORSTMOVIE:
-        recommender = WorstMovieRecommender()
-    else:
-        return {"error": "Invalid recommendation system"}
+async def recommend(system: RecommendationSystem, user_profile: UserProfile, response: Response):
+    start = time.perf_counter()
+    try:
+        recommender = await registry.aget(system.value)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Recommender {system.value} could not be loaded: {e}")
+
+    with request_timings() if SERVER_TIMING else contextlib.nullcontext([]) as timings:
+        with metrics.timed(f"recommend.{system.value}"):
+            recommendations = await recommender.agenerate_recommendations(user_profile=user_profile)
+    _add_server_timing(response, timings, start)
+    return {"recommendations": {name: movie.to_dict() for name, movie in recommendations.items()}}
+
+@app.post("/recommend/{system}/batch", tags=["Recommendations"])
+async def recommend_batch(system: RecommendationSystem, user_profiles: List[UserProfile], response: Response):
+    """Recommends movies for many user profiles at once. The subtitle and worst movie recommenders embed all profiles
+    in batched requests, score them with one matrix product and enrich every recommended movie only once.
+    """
+    start = time.perf_counter()
+    try:
+        recommender = await registry.aget(system.value)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Recommender {system.value} could not be loaded: {e}")
+
+    # Scoring is CPU bound, numpy releases the GIL so the event loop keeps serving other requests
+    with request_timings() if SERVER_TIMING else contextlib.nullcontext([]) as timings:
+        with metrics.timed(f"recommend_batch.{system.value}"):
+            recommendations = await asyncio.to_thread(recommender.generate_batch_recommendations, user_profiles)
+    _add_server_timing(response, timings, start)
+    return {"recommendations": [{name: movie.to_dict() for name, movie in movies.items()} for movies in recommendations]}
+
+def _format_event(event: dict, sse: bool) -> str:
+    """Formats a stream event as a server-sent event or as a line of NDJSON."""
+    if sse:
+        return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+@app.post("/recommend/{system}/stream", tags=["Recommendations"])
+async def recommend_stream(system: RecommendationSystem, user_profile: UserProfile, request: Request):
+    """Streams the recommendations as NDJSON, or as server-sent events if the client accepts text/event-stream.
+    A "skeleton" event with the title and year of every movie comes first, then a "movie" event with the
+    enriched movie as soon as it is done, in the order the movies finish. The stream ends with a "done" event.
+    """
+    try:
+        recommender = await registry.aget(system.value)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Recommender {system.value} could not be loaded: {e}")
+    sse = "text/event-stream" in request.headers.get("accept", "")
+
+    async def events():
+        try:
+            async for event, index, movie in recommender.astream_recommendations(user_profile=user_profile):
+                if event == "skeleton":
+                    yield _format_event({"event": event, "index": index, "title": movie.title, "year": movie.year}, sse)
+                else:
+                    yield _format_event({"event": event, "index": index, "movie": movie.to_dict()}, sse)
+        except Exception as e:
+            # The status code has been sent already, so the error is reported in the stream
+            logging.error("Streaming recommendations of %s failed: %s", system.value, e)
+            yield _format_event({"event": "error", "detail": str(e)}, sse)
+            return
+        yield _format_event({"event": "done"}, sse)
+
+    media_type = "text/event-stream" if sse else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type)
+
+@app.get("/metrics", tags=["Health"])
+def get_metrics():
+    """The latency histograms and counters in the Prometheus text format, see metrics.py."""
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled, set METRICS_ENABLED in settings.py")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health", tags=["Health"])
+def health():
+    return {"ready": registry.is_ready(), "recommenders": registry.status()}
 
-    recommendations = recommender.generate_recommendations(user_profile=user_profile)
-    return {"recommendations": recommendations}
+@app.get("/health/ready", tags=["Health"])
+def readiness():
+    status_code = 200 if registry.is_ready() else 503
+    return JSONResponse(status_code=status_code, content={"ready": status_code == 200, "recommenders": registry.status()})
 
 @app.get("/movies/genres", tags=["Movie data"])
 def get_movie_genres():
@@ -1,13 +1,46 @@
+import asyncio
 import os
-import openai
+import threading
+import weakref
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import openai
 
 def get_themoviedb_headers() -> dict[str, str]:
     return {
         "accept": "application/json",
         "Authorization": f"Bearer {os.environ['TMDB_API_KEY']}"
     }
-    
-def get_openai_client() -> openai.Client:
-    return openai.Client(
-        api_key=os.environ['OPENAI_API_KEY']
-    )
\ No newline at end of file
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client() -> "openai.Client":
+    """Returns the OpenAI client shared by every module. The openai package takes a while to import,
+    so it is only imported and the client only built once a request actually needs it."""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                import openai
+                _openai_client = openai.Client(
+                    api_key=os.environ['OPENAI_API_KEY']
+                )
+    return _openai_client
+
+_async_openai_clients = weakref.WeakKeyDictionary()
+
+def get_async_openai_client() -> "openai.AsyncClient":
+    """Returns the async OpenAI client of the running event loop.
+    The client is reused, as it keeps its connection pool bound to the loop it was created on."""
+    loop = asyncio.get_running_loop()
+    client = _async_openai_clients.get(loop)
+    if client is None:
+        import openai
+        client = openai.AsyncClient(
+            api_key=os.environ['OPENAI_API_KEY']
+        )
+        _async_openai_clients[loop] = client
+    return client
@@ -0,0 +1,61 @@
+"""Compares two result files of benchmarks.run, matching the measurements by benchmark and parameters.
+
+    python -m benchmarks.compare benchmarks/results/<old>.json benchmarks/results/<new>.json --threshold 0.1
+
+Exits with status 1 if any median got slower by more than the threshold, so it can guard a CI job.
+"""
+import argparse
+import json
+import sys
+
+from typing import Dict, Tuple
+
+# The fields that identify a measurement, every other field is a result
+KEY_FIELDS = ("benchmark", "corpus", "recommender", "movies", "aggregation", "mode", "cache")
+
+
+def load_results(path: str) -> Tuple[dict, Dict[Tuple, dict]]:
+    with open(path, 'r', encoding='utf-8') as results_file:
+        report = json.load(results_file)
+    results = {tuple(result.get(field) for field in KEY_FIELDS): result for result in report["results"]}
+    return report, results
+
+
+def describe(key: Tuple) -> str:
+    return " ".join(str(value) for value in key if value is not None)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compares the medians of two benchmark result files.")
+    parser.add_argument("old", help="The baseline result file.")
+    parser.add_argument("new", help="The result file to compare against the baseline.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown of a median that counts as a regression.")
+    args = parser.parse_args()
+
+    old_report, old_results = load_results(args.old)
+    new_report, new_results = load_results(args.new)
+    if old_report["config"] != new_report["config"]:
+        print("Warning: the runs used different configurations, the comparison may be meaningless", file=sys.stderr)
+    print(f"old: {old_report['revision']['commit']}  {old_report['revision']['subject']}")
+    print(f"new: {new_report['revision']['commit']}  {new_report['revision']['subject']}")
+    print()
+
+    regressions = 0
+    for key, new in new_results.items():
+        old = old_results.get(key)
+        if old is None:
+            continue
+        old_median, new_median = old["seconds"]["median"], new["seconds"]["median"]
+        ratio = new_median / old_median if old_median else float("inf")
+        flag = ""
+        if ratio > 1 + args.threshold:
+            regressions += 1
+            flag = "  REGRESSION"
+        print(f"{describe(key):60} {old_median * 1000:10.3f} ms {new_median * 1000:10.3f} ms {ratio:6.2f}x{flag}")
+    print()
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""Deterministic synthetic corpora in the format of the subtitle and worst movie stores, from a handful to 100k films."""
+import numpy as np
+
+from collections.abc import Mapping
+from typing import Iterator, List
+
+from embedding_store import Entry
+
+# The chunks of a movie are noisy copies of one of these topics, so movies are clustered like real plots and subtitles
+N_TOPICS = 64
+TOPIC_NOISE = 0.5
+
+
+def synthetic_title(index: int) -> str:
+    """The "<title> (<year>)" name of the synthetic movie at index."""
+    return f"Synthetic Movie {index} ({1950 + index % 70})"
+
+
+class SyntheticCorpus(Mapping):
+    """Maps the title of every synthetic movie to its entries, as EmbeddingStore.write expects.
+    Entries are generated on access from a seed per movie, so a corpus of 100k films never has to fit in memory
+    and the same arguments always produce the same vectors.
+
+    Args:
+        movies (int): The amount of movies.
+        min_chunks (int): The least amount of chunks of a movie, 1 for plot corpora.
+        max_chunks (int): The most amount of chunks of a movie. Movies cycle through the counts in between.
+        dimensions (int): The dimension of the embeddings.
+        seed (int, optional): Changes every vector of the corpus.
+    """
+    def __init__(self, movies: int, min_chunks: int, max_chunks: int, dimensions: int, seed: int = 0):
+        self.movies = movies
+        self.min_chunks = min_chunks
+        self.max_chunks = max_chunks
+        self.dimensions = dimensions
+        self.seed = seed
+        self.topics = np.random.default_rng([seed, N_TOPICS]).standard_normal((N_TOPICS, dimensions), dtype=np.float32)
+        self._indices = {synthetic_title(i): i for i in range(movies)}
+
+    def __len__(self) -> int:
+        return self.movies
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._indices)
+
+    def __getitem__(self, title: str) -> List[Entry]:
+        index = self._indices[title]
+        chunks = self.min_chunks + index % (self.max_chunks - self.min_chunks + 1)
+        rng = np.random.default_rng([self.seed, index])
+        vectors = self.topics[index % N_TOPICS] + TOPIC_NOISE * rng.standard_normal((chunks, self.dimensions), dtype=np.float32)
+        if self.max_chunks == 1:
+            return [("plot", "", vectors[0])]
+        return [(str(chunk * 10), "", vector) for chunk, vector in enumerate(vectors)]
+
+    @property
+    def chunks(self) -> int:
+        """The total amount of chunks in the corpus."""
+        span = self.max_chunks - self.min_chunks + 1
+        full_cycles, rest = divmod(self.movies, span)
+        return full_cycles * sum(range(self.min_chunks, self.max_chunks + 1)) + sum(range(self.min_chunks, self.min_chunks + rest))
+
+
+def subtitle_corpus(movies: int, dimensions: int, seed: int = 0) -> SyntheticCorpus:
+    """Films of one and a half to two and a half hours, in intervals of 10 minutes."""
+    return SyntheticCorpus(movies, 9, 15, dimensions, seed)
+
+
+def worst_movie_corpus(movies: int, dimensions: int, seed: int = 0) -> SyntheticCorpus:
+    """One plot embedding per film."""
+    return SyntheticCorpus(movies, 1, 1, dimensions, seed)
@@ -0,0 +1,205 @@
+"""In-process fakes for OpenAI, TMDB, OMDB and Wikipedia, so the benchmarks run offline and deterministically.
+
+Every fake sleeps for a configurable latency per call, to stand in for the network, and counts its calls.
+Embeddings are derived from a hash of the text, so the same text always gets the same embedding.
+Import this module only after benchmarks.run has pointed the settings to its temporary directory.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import weakref
+import httpx
+import numpy as np
+
+from types import SimpleNamespace
+from typing import Dict, List
+from urllib.parse import urlparse
+
+import auth
+import helpers
+import http_client
+from settings import AMOUNT_OF_MOVIES
+
+
+def fake_embedding(text: str, dimensions: int) -> List[float]:
+    """A deterministic unit vector for the text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class CallCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset(self) -> Dict[str, int]:
+        """Returns the counts so far and starts counting from zero."""
+        with self._lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+
+class _FakeOpenAIBase:
+    def __init__(self, latency: float, dimensions: int, titles: List[str], counter: CallCounter):
+        self.latency = latency
+        self.dimensions = dimensions
+        self.titles = titles
+        self.counter = counter
+
+    def _embeddings_response(self, model_input) -> SimpleNamespace:
+        self.counter.add("openai.embeddings")
+        texts = [model_input] if isinstance(model_input, str) else list(model_input)
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=fake_embedding(text, self.dimensions)) for i, text in enumerate(texts)])
+
+    def _chat_response(self, messages: List[dict]) -> SimpleNamespace:
+        self.counter.add("openai.chat")
+        prompt = "\n".join(message["content"] for message in messages)
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        if "JSON format" in prompt:
+            # A recommendation prompt: pick a deterministic set of titles from the fake catalogue
+            start = int(digest[:8], 16) % max(len(self.titles), 1)
+            titles = [self.titles[(start + i) % len(self.titles)] for i in range(min(AMOUNT_OF_MOVIES, len(self.titles)))]
+            content = json.dumps({"movies": [{"title": title, "explanation": f"Fake explanation {digest[:8]}."} for title in titles]})
+        else:
+            content = f"Fake completion {digest[:16]}."
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeOpenAI(_FakeOpenAIBase):
+    """Stands in for openai.Client, with the embeddings and chat completion endpoints used by this project."""
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.embeddings = SimpleNamespace(create=self._create_embeddings)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat_completion))
+
+    def _create_embeddings(self, model: str, input, **kwargs):
+        time.sleep(self.latency)
+        return self._embeddings_response(input)
+
+    def _create_chat_completion(self, model: str, messages: List[dict], **kwargs):
+        time.sleep(self.latency)
+        return self._chat_response(messages)
+
+
+class FakeAsyncOpenAI(_FakeOpenAIBase):
+    """Stands in for openai.AsyncClient."""
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.embeddings = SimpleNamespace(create=self._create_embeddings)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_chat_completion))
+
+    async def _create_embeddings(self, model: str, input, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._embeddings_response(input)
+
+    async def _create_chat_completion(self, model: str, messages: List[dict], **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._chat_response(messages)
+
+
+def _fake_plot(title: str) -> str:
+    return f"{title} is a film. " * 40
+
+
+class FakeServices:
+    """Answers the TMDB, OMDB and Wikipedia API requests made through the shared HTTP clients."""
+    def __init__(self, latency: float, titles: List[str], counter: CallCounter):
+        self.latency = latency
+        self.titles = titles
+        self.counter = counter
+
+    def _respond(self, request: httpx.Request) -> httpx.Response:
+        url = urlparse(str(request.url))
+        params = request.url.params
+        if "omdbapi" in url.netloc:
+            self.counter.add("omdb")
+            title = params.get("t") or params.get("i", "")
+            return httpx.Response(200, json={
+                "Response": "True", "Title": title, "Year": params.get("y") or "2000", "Plot": _fake_plot(title)[:200],
+                "Genre": "Drama", "Director": "Fake Director", "Actors": "Fake Actor", "Poster": "https://example.com/poster.jpg",
+                "imdbRating": "7.0", "Runtime": "120 min", "Language": "English", "Country": "Netherlands", "Awards": "N/A",
+                "Released": "01 Jan 2000"})
+        if "themoviedb" in url.netloc:
+            self.counter.add("tmdb")
+            if url.path.endswith("genre/movie/list"):
+                return httpx.Response(200, json={"genres": [{"id": i, "name": name} for i, name in enumerate(["Action", "Drama", "Comedy", "Horror"])]})
+            if url.path.endswith("person/popular"):
+                return httpx.Response(200, json={"results": [{"id": i, "name": f"Fake Actor {i}"} for i in range(20)]})
+            if url.path.endswith("search/keyword"):
+                return httpx.Response(200, json={"results": [{"id": int(hashlib.sha256(params.get("query", "").encode()).hexdigest()[:6], 16)}]})
+            if url.path.endswith("discover/movie"):
+                return httpx.Response(200, json={"results": [{"original_title": title, "title": title} for title in self.titles[:20]]})
+        if "wikipedia" in url.netloc:
+            self.counter.add("wikipedia")
+            title = params.get("titles", "")
+            extract = f"{title}\n\n== Plot ==\n{_fake_plot(title)}\n\n== Cast ==\nFake Actor"
+            return httpx.Response(200, json={"query": {"pages": [{"title": title, "extract": extract}]}})
+        return httpx.Response(404)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        time.sleep(self.latency)
+        return self._respond(request)
+
+    async def ahandle(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self.latency)
+        return self._respond(request)
+
+
+class FakeWikipedia:
+    """Stands in for the shared wikipediaapi.Wikipedia instance."""
+    def __init__(self, latency: float, counter: CallCounter):
+        self.latency = latency
+        self.counter = counter
+
+    def page(self, title: str) -> SimpleNamespace:
+        time.sleep(self.latency)
+        self.counter.add("wikipedia")
+        plot = SimpleNamespace(text=_fake_plot(title))
+        return SimpleNamespace(exists=lambda: True, section_by_title=lambda name: plot if name == "Plot" else None)
+
+
+def install(openai_latency: float, http_latency: float, dimensions: int, titles: List[str]) -> CallCounter:
+    """Replaces every external client with a fake.
+
+    Args:
+        openai_latency (float): Seconds every OpenAI call takes.
+        http_latency (float): Seconds every TMDB, OMDB and Wikipedia call takes.
+        dimensions (int): The dimension of the fake embeddings, should match the synthetic corpora.
+        titles (List[str]): The catalogue the fake OpenAI and TMDB recommend from.
+
+    Returns:
+        CallCounter: Counts the calls to every fake service.
+    """
+    counter = CallCounter()
+    # The shared clients are built lazily, so setting them up front makes every caller use the fakes
+    auth._openai_client = FakeOpenAI(openai_latency, dimensions, titles, counter)
+    services = FakeServices(http_latency, titles, counter)
+    http_client._client = httpx.Client(transport=httpx.MockTransport(services.handle))
+    http_client._wikipedia = FakeWikipedia(http_latency, counter)
+
+    async_http_clients = weakref.WeakKeyDictionary()
+
+    def get_async_http_client() -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if loop not in async_http_clients:
+            async_http_clients[loop] = httpx.AsyncClient(transport=httpx.MockTransport(services.ahandle))
+        return async_http_clients[loop]
+
+    fake_async_openai = FakeAsyncOpenAI(openai_latency, dimensions, titles, counter)
+
+    def get_async_openai_client() -> FakeAsyncOpenAI:
+        return fake_async_openai
+
+    http_client.get_async_http_client = get_async_http_client
+    # These modules imported get_async_openai_client by name
+    import recommenders.OpenAIRecommender
+    for module in (auth, helpers, recommenders.OpenAIRecommender):
+        module.get_async_openai_client = get_async_openai_client
+    return counter
@@ -0,0 +1,265 @@
+"""Offline benchmarks of the corpus load, the index scoring and the end-to-end latency of every recommender.
+
+OpenAI, TMDB, OMDB and Wikipedia are replaced by the in-process fakes of benchmarks.fakes, and the corpora
+by the synthetic ones of benchmarks.corpora, so runs need no API keys and are comparable across commits.
+Run from the root of the repository, results are written as JSON:
+
+    python -m benchmarks.run --sizes 10,1000,10000
+    python -m benchmarks.compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Tuple
+
+import settings
+
+BENCHMARKS = ("corpus_load", "scoring", "end_to_end")
+RECOMMENDERS = {
+    "Pure AI": ("recommenders.OpenAIRecommender", "PureAIRecommender"),
+    "AI-Assisted": ("recommenders.OpenAIRecommender", "AIAssistRecommender"),
+    "Subtitle embeddings": ("recommenders.SubtitleRecommender", "SubtitleRecommender"),
+    "Worst wikipedia movies": ("recommenders.WorstMovieRecommender", "WorstMovieRecommender"),
+}
+# The titles the fake OpenAI and TMDB recommend from
+FAKE_CATALOGUE = [f"Synthetic Movie {i}" for i in range(100)]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Summarizes timings in seconds."""
+    ordered = sorted(samples)
+    return {
+        "runs": len(ordered),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "mean": statistics.fmean(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        "max": ordered[-1],
+    }
+
+
+def measure(function: Callable, repeat: int) -> Tuple[object, List[float]]:
+    """Calls the function repeat times and returns its last result and the duration of every call."""
+    samples, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - start)
+    return result, samples
+
+
+def git_revision() -> Dict[str, object]:
+    def git(*args):
+        result = subprocess.run(["git", *args], capture_output=True, text=True)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    return {"commit": git("rev-parse", "HEAD"), "subject": git("log", "-1", "--format=%s"),
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def configure_settings(workdir: str) -> None:
+    """Points every path in settings to the temporary directory. Must run before the project modules are imported,
+    as they copy the settings they use on import."""
+    settings.CACHE_PATH = os.path.join(workdir, "cache", "cache.sqlite3")
+    settings.SRT_STORE_PATH = os.path.join(workdir, "store", "subtitles")
+    settings.WIKIPEDIA_STORE_PATH = os.path.join(workdir, "store", "worst_movies")
+    settings.SRT_PATH = os.path.join(workdir, "subtitles")
+    settings.SRT_JSON_PATH = os.path.join(workdir, "json", "subtitles.json")
+    settings.WIKIPEDIA_JSON_PATH = os.path.join(workdir, "json", "worst_movies.json")
+    # Without a plot store or title catalogue, every lookup goes to the fake services
+    settings.WIKIPEDIA_PLOT_STORE_PATH = os.path.join(workdir, "store", "wikipedia_plots.sqlite3")
+    settings.TITLE_CATALOGUE_PATH = os.path.join(workdir, "store", "titles.sqlite3")
+    # The fake services have no rate limits, and the benchmarks measure the pipeline rather than the budgets
+    settings.RATE_LIMIT_ENABLED = False
+    settings.RATE_LIMIT_PATH = os.path.join(workdir, "cache", "rate_limits.sqlite3")
+    # The synthetic store has no SRT files behind it
+    settings.SRT_INCREMENTAL_INGESTION = False
+    for key in ("OPENAI_API_KEY", "TMDB_API_KEY", "OMDB_API_KEY"):
+        os.environ.setdefault(key, "benchmark")
+
+
+def bench_corpus_load(workdir: str, sizes: List[int], dimensions: int, repeat: int) -> Tuple[List[dict], Dict[Tuple[str, int], str]]:
+    """Writes the synthetic corpora, then times opening the store and building the exact index on top of it.
+
+    Returns:
+        Tuple[List[dict], Dict[Tuple[str, int], str]]: The results, and the store path of every (corpus, size).
+    """
+    from benchmarks.corpora import subtitle_corpus, worst_movie_corpus
+    from embedding_store import EmbeddingStore
+    from recommenders.EmbeddingIndex import EmbeddingIndex
+
+    results, paths = [], {}
+    for corpus_name, make_corpus in (("subtitles", subtitle_corpus), ("worst_movies", worst_movie_corpus)):
+        for size in sizes:
+            corpus = make_corpus(size, dimensions)
+            path = os.path.join(workdir, "corpora", f"{corpus_name}-{size}")
+            start = time.perf_counter()
+            EmbeddingStore.write(path, corpus)
+            write_seconds = time.perf_counter() - start
+            _, samples = measure(lambda: EmbeddingIndex.from_store(EmbeddingStore(path)), repeat)
+            paths[(corpus_name, size)] = path
+            results.append({"benchmark": "corpus_load", "corpus": corpus_name, "movies": size, "chunks": corpus.chunks,
+                            "dimensions": dimensions, "write_seconds": write_seconds, "seconds": summarize(samples)})
+            logging.warning("corpus_load %s %s: %.4fs", corpus_name, size, results[-1]["seconds"]["median"])
+    return results, paths
+
+
+def bench_scoring(paths: Dict[Tuple[str, int], str], dimensions: int, queries: int) -> List[dict]:
+    """Times EmbeddingIndex.search, the scoring step of generate_recommendations, once per query profile.
+    Subtitle corpora are also scored with the max aggregation, which reads every interval instead of the pooled vectors."""
+    from benchmarks.fakes import fake_embedding
+    from embedding_store import EmbeddingStore
+    from recommenders.EmbeddingIndex import EmbeddingIndex
+
+    query_vectors = [fake_embedding(f"benchmark profile {i}", dimensions) for i in range(queries)]
+    results = []
+    for (corpus_name, size), path in paths.items():
+        index = EmbeddingIndex.from_store(EmbeddingStore(path))
+        for aggregation in ("mean", "max") if corpus_name == "subtitles" else ("mean",):
+            # Touches the memory map once, so the first query does not pay for reading the vectors from disk
+            index.search(query_vectors[0], settings.AMOUNT_OF_MOVIES, aggregation=aggregation)
+            samples = []
+            for query in query_vectors:
+                start = time.perf_counter()
+                index.search(query, settings.AMOUNT_OF_MOVIES, aggregation=aggregation)
+                samples.append(time.perf_counter() - start)
+            results.append({"benchmark": "scoring", "corpus": corpus_name, "movies": size, "aggregation": aggregation,
+                            "seconds": summarize(samples)})
+            logging.warning("scoring %s %s %s: %.6fs", corpus_name, size, aggregation, results[-1]["seconds"]["median"])
+    return results
+
+
+def clear_caches() -> None:
+    """Empties every cache of enrichment and reference data, so the next recommendation pays for every call."""
+    from helpers import content_cache
+    from movie_data.omdb import omdb_cache
+    from movie_data.tmdb import reference_cache
+
+    content_cache.clear()
+    omdb_cache.clear()
+    reference_cache.clear()
+
+
+def bench_end_to_end(movies: int, dimensions: int, repeat: int, counter) -> List[dict]:
+    """Times generate_recommendations and agenerate_recommendations of every recommender, with empty caches (cold)
+    and after the same profile was recommended before (warm). The synthetic stores are opened from settings."""
+    import importlib
+    from benchmarks.corpora import subtitle_corpus, worst_movie_corpus
+    from embedding_store import EmbeddingStore
+    from user_profile import UserProfile
+
+    EmbeddingStore.write(settings.SRT_STORE_PATH, subtitle_corpus(movies, dimensions))
+    EmbeddingStore.write(settings.WIKIPEDIA_STORE_PATH, worst_movie_corpus(movies, dimensions))
+    user_profile = UserProfile(genres=["Drama"], themes=["Friendship", "Robots"], actors=["Fake Actor 1"],
+                               directors=["Fake Director"], recent_watches=["Synthetic Movie 1"],
+                               other_comments="Benchmark profile")
+
+    results = []
+    for name, (module, class_name) in RECOMMENDERS.items():
+        start = time.perf_counter()
+        recommender = getattr(importlib.import_module(module), class_name)()
+        init_seconds = time.perf_counter() - start
+        calls = {
+            "sync": lambda: recommender.generate_recommendations(user_profile),
+            "async": lambda: asyncio.run(recommender.agenerate_recommendations(user_profile)),
+        }
+        for mode, call in calls.items():
+            for cache in ("cold", "warm"):
+                samples, counts = [], {}
+                # The recommenders print the raw OpenAI responses
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for _ in range(repeat):
+                        if cache == "cold":
+                            clear_caches()
+                        else:
+                            call()
+                        counter.reset()
+                        start = time.perf_counter()
+                        recommendations = call()
+                        samples.append(time.perf_counter() - start)
+                        counts = counter.reset()
+                results.append({"benchmark": "end_to_end", "recommender": name, "mode": mode, "cache": cache,
+                                "movies": movies, "init_seconds": init_seconds, "recommendations": len(recommendations),
+                                "calls": counts, "seconds": summarize(samples)})
+                logging.warning("end_to_end %s %s %s: %.4fs", name, mode, cache, results[-1]["seconds"]["median"])
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Runs the offline benchmarks and writes the results as JSON.")
+    parser.add_argument("--sizes", default="10,1000,10000",
+                        help="Comma separated corpus sizes in films for corpus_load and scoring. 100000 films of 1536 dimensions take ~7 GB of disk.")
+    parser.add_argument("--dimensions", type=int, default=1536, help="The dimension of the synthetic and fake embeddings.")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help=f"Comma separated subset of {', '.join(BENCHMARKS)}.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per corpus load and end-to-end measurement.")
+    parser.add_argument("--queries", type=int, default=50, help="Query profiles per scoring measurement.")
+    parser.add_argument("--e2e-movies", type=int, default=1000, help="Films in the stores of the embedding recommenders for end_to_end.")
+    parser.add_argument("--openai-latency", type=float, default=0.2, help="Seconds every fake OpenAI call takes.")
+    parser.add_argument("--http-latency", type=float, default=0.05, help="Seconds every fake TMDB, OMDB and Wikipedia call takes.")
+    parser.add_argument("--output", help="The JSON file to write, defaults to benchmarks/results/<timestamp>-<commit>.json.")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory with the synthetic stores.")
+    args = parser.parse_args()
+    benchmarks = [benchmark.strip() for benchmark in args.benchmarks.split(",") if benchmark.strip()]
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+
+    # Progress goes to stderr as warnings, the INFO logs of the project would drown it
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    workdir = tempfile.mkdtemp(prefix="movie-recommender-bench-")
+    configure_settings(workdir)
+    from benchmarks import fakes
+    counter = fakes.install(args.openai_latency, args.http_latency, args.dimensions, FAKE_CATALOGUE)
+
+    started_at = datetime.now(timezone.utc)
+    results = []
+    try:
+        paths = {}
+        if "corpus_load" in benchmarks or "scoring" in benchmarks:
+            load_results, paths = bench_corpus_load(workdir, sizes, args.dimensions, args.repeat)
+            if "corpus_load" in benchmarks:
+                results += load_results
+        if "scoring" in benchmarks:
+            results += bench_scoring(paths, args.dimensions, args.queries)
+        if "end_to_end" in benchmarks:
+            results += bench_end_to_end(args.e2e_movies, args.dimensions, args.repeat, counter)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    revision = git_revision()
+    report = {
+        "revision": revision,
+        "started_at": started_at.isoformat(),
+        "environment": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "config": {"sizes": sizes, "dimensions": args.dimensions, "benchmarks": benchmarks, "repeat": args.repeat,
+                   "queries": args.queries, "e2e_movies": args.e2e_movies, "openai_latency": args.openai_latency,
+                   "http_latency": args.http_latency, "amount_of_movies": settings.AMOUNT_OF_MOVIES},
+        "results": results,
+    }
+    output = args.output or os.path.join("benchmarks", "results",
+                                         f"{started_at:%Y%m%dT%H%M%S}-{(revision['commit'] or 'unknown')[:10]}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+from metrics import metrics
+from singleflight import SingleFlight
+
+# Returned by PersistentCache.get for missing or expired keys, as None is a valid cached value
+MISSING = object()
+# PersistentCache evicts after this many writes of a process, or after this many seconds since it last did, whichever comes first
+EVICT_EVERY_WRITES = 1000
+EVICT_INTERVAL = 60.0
+
+
+class PersistentCache:
+    """A key-value cache in SQLite, shared by every process using the same file.
+    Every entry has its own time to live, and once there are more than max_entries the least recently used ones are evicted.
+    Values are stored as JSON, so None is a valid value (for example a cached "not found").
+
+    Eviction runs every EVICT_EVERY_WRITES writes or EVICT_INTERVAL seconds rather than on every write, so the cache can
+    briefly hold up to EVICT_EVERY_WRITES entries more than max_entries. The number of entries is kept as a running count,
+    which misses the writes of other processes, so it is recounted when it says the cache is full and every EVICT_INTERVAL seconds.
+    """
+    def __init__(self, path: str, max_entries: int, table: str = "cache",
+                 evict_every_writes: int = EVICT_EVERY_WRITES, evict_interval: float = EVICT_INTERVAL):
+        self.path = path
+        self.max_entries = max_entries
+        self.table = table
+        self.evict_every_writes = evict_every_writes
+        self.evict_interval = evict_interval
+        self._lock = threading.Lock()
+        self._db = None
+        self._entries = 0
+        self._writes = 0
+        self._evicted_at = 0.0
+        self._counted_at = 0.0
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        """The connection is opened on first use, so importing a module with a cache does not touch the disk.
+        Only used while holding self._lock."""
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_access ON {self.table} (last_access)")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_expires_at ON {self.table} (expires_at)")
+            self._db = connection
+            self._count(time.time())
+        return self._db
+
+    def get(self, key: str, default: Any = MISSING) -> Any:
+        """Returns the cached value for the key.
+
+        Args:
+            key (str): The key to look up.
+            default (Any, optional): Returned if the key is missing or expired. Defaults to MISSING.
+
+        Returns:
+            Any: The cached value or the default.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            if row[1] < now:
+                self._entries -= self._connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,)).rowcount
+                return default
+            self._connection.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        """Stores the value for ttl seconds, and evicts expired and least recently used entries when eviction is due.
+
+        Args:
+            key (str): The key to store the value under.
+            value (Any): A JSON serializable value.
+            ttl (float): Time to live in seconds.
+        """
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, items: Dict[str, Any], ttl: float) -> None:
+        """Stores several values for ttl seconds in a single transaction, which is much cheaper than a set per value.
+
+        Args:
+            items (Dict[str, Any]): The JSON serializable values by key.
+            ttl (float): Time to live in seconds.
+        """
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, json.dumps(value), now + ttl, now) for key, value in items.items()]
+        with self._lock:
+            connection = self._connection
+            connection.execute("BEGIN")
+            try:
+                for key in items:
+                    self._entries += connection.execute(f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)).fetchone() is None
+                connection.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)", rows
+                )
+                self._writes += len(rows)
+                if self._writes >= self.evict_every_writes or now - self._evicted_at >= self.evict_interval:
+                    self._evict(now)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                self._count(now)
+                raise
+            connection.execute("COMMIT")
+
+    def _evict(self, now: float) -> None:
+        """Deletes the expired entries, then the least recently used ones above max_entries. Only used while holding self._lock."""
+        connection = self._connection
+        self._writes, self._evicted_at = 0, now
+        self._entries -= connection.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (now,)).rowcount
+        if self._entries > self.max_entries or now - self._counted_at >= self.evict_interval:
+            self._count(now)
+        overflow = self._entries - self.max_entries
+        if overflow > 0:
+            logging.debug("Evicting %s entries from cache %s", overflow, self.table)
+            self._entries -= connection.execute(
+                f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY last_access LIMIT ?)", (overflow,)
+            ).rowcount
+
+    def _count(self, now: float) -> None:
+        """Counts the entries of every process. Only used while holding self._lock."""
+        self._entries = self._db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        self._evicted_at = self._counted_at = now
+
+    def clear(self) -> None:
+        """Removes every entry."""
+        with self._lock:
+            self._connection.execute(f"DELETE FROM {self.table}")
+            self._entries = 0
+
+
+class ContentCache:
+    """Content-addressed cache for deterministic model calls, such as embeddings and completions.
+    The key is a hash of the model name, the input and max_tokens, so switching models never serves stale results.
+    A small in-memory LRU tier sits in front of the PersistentCache disk tier. Hits and misses are counted per tier.
+    Identical calls that miss at the same time are coalesced, so only one of them reaches the model.
+    """
+    def __init__(self, disk_cache: PersistentCache, memory_entries: int, ttl: float):
+        self.disk_cache = disk_cache
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.flight = SingleFlight("content")
+
+    @staticmethod
+    def make_key(model: str, model_input: Any, max_tokens: int | None = None) -> str:
+        """Hashes the model, input and max_tokens into a cache key. The input can be any JSON serializable value."""
+        payload = json.dumps([model, model_input, max_tokens], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, model: str, model_input: Any, max_tokens: int | None = None) -> Any:
+        """Returns the cached result for (model, model_input, max_tokens), or MISSING."""
+        key = self.make_key(model, model_input, max_tokens)
+        value = self._get_memory(key)
+        if value is MISSING:
+            value = self._get_disk(key)
+        return value
+
+    async def aget(self, model: str, model_input: Any, max_tokens: int | None = None) -> Any:
+        """Async version of get. The disk tier is read in a thread, so SQLite does not block the event loop."""
+        key = self.make_key(model, model_input, max_tokens)
+        value = self._get_memory(key)
+        if value is MISSING:
+            value = await asyncio.to_thread(self._get_disk, key)
+        return value
+
+    def _get_memory(self, key: str) -> Any:
+        with self._lock:
+            if key not in self._memory:
+                return MISSING
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            value = self._memory[key]
+        metrics.count_cache("content", "memory_hit")
+        return value
+
+    def _get_disk(self, key: str) -> Any:
+        value = self.disk_cache.get(key)
+        with self._lock:
+            if value is MISSING:
+                self.misses += 1
+                metrics.count_cache("content", "miss")
+                return MISSING
+            self.disk_hits += 1
+        metrics.count_cache("content", "disk_hit")
+        self._remember(key, value)
+        return value
+
+    def set(self, model: str, model_input: Any, max_tokens: int | None, value: Any) -> None:
+        """Caches the result for (model, model_input, max_tokens) in both tiers. The value must be JSON serializable."""
+        key = self.make_key(model, model_input, max_tokens)
+        self.disk_cache.set(key, value, self.ttl)
+        self._remember(key, value)
+
+    async def aset(self, model: str, model_input: Any, max_tokens: int | None, value: Any) -> None:
+        """Async version of set, which writes to disk in a thread."""
+        await asyncio.to_thread(self.set, model, model_input, max_tokens, value)
+
+    def set_many(self, model: str, results: List[Tuple[Any, Any]], max_tokens: int | None = None) -> None:
+        """Caches the results of several inputs to the same model in both tiers, with a single write to disk.
+
+        Args:
+            model (str): The model name, part of the key.
+            results (List[Tuple[Any, Any]]): The (model_input, value) pairs. The values must be JSON serializable.
+            max_tokens (int | None, optional): The max_tokens of the calls, None for embeddings.
+        """
+        items = {self.make_key(model, model_input, max_tokens): value for model_input, value in results}
+        self.disk_cache.set_many(items, self.ttl)
+        for key, value in items.items():
+            self._remember(key, value)
+
+    def get_or_compute(self, model: str, model_input: Any, max_tokens: int | None, compute: Callable[[], Any]) -> Any:
+        """Returns the cached result for (model, model_input, max_tokens), or calls compute and caches its result.
+
+        Args:
+            model (str): The model name, part of the key.
+            model_input (Any): The prompt, messages or text sent to the model.
+            max_tokens (int | None): The max_tokens of the call, None for embeddings.
+            compute (Callable[[], Any]): Performs the actual call. Must return a JSON serializable value.
+
+        Returns:
+            Any: The cached or freshly computed result.
+        """
+        value = self.get(model, model_input, max_tokens)
+        if value is MISSING:
+            def compute_and_set() -> Any:
+                result = compute()
+                self.set(model, model_input, max_tokens, result)
+                return result
+            value = self.flight.do(self.make_key(model, model_input, max_tokens), compute_and_set)
+        return value
+
+    async def aget_or_compute(self, model: str, model_input: Any, max_tokens: int | None, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Async version of get_or_compute, where compute is a coroutine function. The disk tier is used in a thread."""
+        value = await self.aget(model, model_input, max_tokens)
+        if value is MISSING:
+            async def compute_and_set() -> Any:
+                result = await compute()
+                await self.aset(model, model_input, max_tokens, result)
+                return result
+            value = await self.flight.ado(self.make_key(model, model_input, max_tokens), compute_and_set)
+        return value
+
+    def clear(self) -> None:
+        """Removes every entry from both tiers and resets the counters."""
+        self.disk_cache.clear()
+        with self._lock:
+            self._memory.clear()
+            self.memory_hits = self.disk_hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit and miss counters."""
+        with self._lock:
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses}
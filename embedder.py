@@ -0,0 +1,99 @@
+import contextvars
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+from cache import MISSING, ContentCache
+from metrics import metrics
+from rate_limiter import rate_limiter
+from settings import EMBEDDING_MODEL, EMBEDDING_BATCH_MAX_ITEMS, EMBEDDING_BATCH_MAX_TOKENS, EMBEDDING_BATCH_CONCURRENCY
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate, about four characters per token for English text. Good enough to size batches."""
+    return len(text) // 4 + 1
+
+
+class BatchEmbedder:
+    """Embeds many texts with as few requests as possible. The embeddings endpoint accepts a list of inputs,
+    so texts are packed into batches under a token and item budget, and several batches are sent concurrently.
+    Results are mapped back by index, so the output has the same order as the input.
+
+    Texts already in the content cache are not sent again, and duplicate texts are only sent once. The embeddings of a
+    batch are cached with a single write. Bulk ingestion can skip the cache, so a corpus does not push cached completions out.
+    """
+    def __init__(self, client_factory: Callable, cache: ContentCache | None = None, model: str = EMBEDDING_MODEL,
+                 max_items: int = EMBEDDING_BATCH_MAX_ITEMS, max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+                 max_concurrency: int = EMBEDDING_BATCH_CONCURRENCY):
+        """
+        Args:
+            client_factory (Callable): Returns an OpenAI-compatible client, such as auth.get_openai_client or a fake one.
+            cache (ContentCache | None, optional): Cache to check before and fill after embedding. Defaults to None.
+            model (str, optional): The embedding model. Defaults to EMBEDDING_MODEL.
+            max_items (int, optional): Maximum amount of texts per request.
+            max_tokens (int, optional): Maximum amount of estimated tokens per request.
+            max_concurrency (int, optional): Maximum amount of requests in flight.
+        """
+        self.client_factory = client_factory
+        self.cache = cache
+        self.model = model
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.max_concurrency = max_concurrency
+
+    def _make_batches(self, texts: List[str]) -> List[List[str]]:
+        """Packs the texts into batches in order. A text larger than the token budget gets a batch of its own."""
+        batches = []
+        current, current_tokens = [], 0
+        for text in texts:
+            tokens = estimate_tokens(text)
+            if current and (len(current) >= self.max_items or current_tokens + tokens > self.max_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(text)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        rate_limiter.acquire("openai_embeddings", tokens=sum(estimate_tokens(text) for text in batch))
+        with metrics.timed("openai.embedding"):
+            response = self.client_factory().embeddings.create(model=self.model, input=batch)
+        metrics.count_tokens(self.model, response)
+        embeddings = [None] * len(batch)
+        for item in response.data:
+            embeddings[item.index] = item.embedding
+        return embeddings
+
+    def embed(self, texts: List[str], use_cache: bool = True) -> List[List[float]]:
+        """Embeds all texts.
+
+        Args:
+            texts (List[str]): The texts to embed.
+            use_cache (bool, optional): Look the texts up in the cache and cache their embeddings. Defaults to True.
+
+        Returns:
+            List[List[float]]: One embedding per text, in the same order.
+        """
+        cache = self.cache if use_cache else None
+        results: Dict[str, List[float]] = {}
+        pending = []
+        for text in dict.fromkeys(texts):
+            cached = cache.get(self.model, text) if cache is not None else MISSING
+            if cached is MISSING:
+                pending.append(text)
+            else:
+                results[text] = cached
+
+        batches = self._make_batches(pending)
+        if batches:
+            logging.info("Embedding %s texts in %s requests", len(pending), len(batches))
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+                # The batches run in the context of the caller, for its rate limit priority and request timings
+                futures = [executor.submit(contextvars.copy_context().run, self._embed_batch, batch) for batch in batches]
+                for batch, embeddings in zip(batches, (future.result() for future in futures)):
+                    results.update(zip(batch, embeddings))
+                    if cache is not None:
+                        cache.set_many(self.model, list(zip(batch, embeddings)))
+        return [results[text] for text in texts]
@@ -0,0 +1,260 @@
+import glob
+import json
+import logging
+import os
+import sys
+import time
+import numpy as np
+
+from typing import Dict, List, Tuple
+from settings import EMBEDDING_MODEL
+
+# (key, text, embedding) of a single embedded chunk. For subtitles the key is the interval, for plots it is "plot".
+Entry = Tuple[str, str, List[float]]
+
+STORE_VERSION = 3
+# Files the search indexes derive from a generation of the store, see IVFIndex and QuantizedVectors in recommenders/
+DERIVED_SUFFIXES = ("ivf.npz", "quantized.npz")
+
+
+def entries_from_dict(data: Dict[str, dict]) -> Dict[str, List[Entry]]:
+    """Flattens the JSON structure used by the SubtitleLoader and the JsonDataHandler into store entries.
+    Subtitle movies hold a dictionary per interval with a text and embedding, worst movies hold a plot and embedding directly.
+    Chunks without an embedding are skipped, as are movies without any embedded chunk.
+
+    Args:
+        data (Dict[str, dict]): The dictionary as it was saved to JSON.
+
+    Returns:
+        Dict[str, List[Entry]]: Keyvalue pair of movie name and its embedded chunks.
+    """
+    movies = {}
+    for title, movie in data.items():
+        if "embedding" in movie:
+            entries = [("plot", movie.get("plot", ""), movie["embedding"])]
+        else:
+            entries = [
+                (str(key), value.get("text", ""), value["embedding"])
+                for key, value in movie.items() if isinstance(value, dict) and "embedding" in value
+            ]
+        if entries:
+            movies[title] = entries
+    return movies
+
+
+def _meta_file(path: str) -> str:
+    return f"{path}.meta.json"
+
+
+def _data_files(path: str, generation: str) -> Dict[str, str]:
+    return {
+        "vectors": f"{path}.{generation}.vectors.npy",
+        "pooled": f"{path}.{generation}.pooled.npy",
+        "texts": f"{path}.{generation}.texts.txt",
+        "text_offsets": f"{path}.{generation}.text_offsets.npy",
+    }
+
+
+class EmbeddingStore:
+    """Binary storage for embedded movie chunks, split over a few files next to each other:
+
+    - <path>.<generation>.vectors.npy: all chunk embeddings as one L2-normalized float32 matrix, opened with np.memmap.
+    - <path>.<generation>.pooled.npy: the mean of the normalized chunk embeddings of every movie, one row per movie.
+    - <path>.meta.json: compact sidecar with the titles, the row offset of every movie, the chunk keys and the source fingerprints.
+    - <path>.<generation>.texts.txt and .text_offsets.npy: the raw chunk texts, only read when asked for.
+
+    The rows of movie i are vectors[offsets[i]:offsets[i + 1]]. Opening a store only parses the sidecar,
+    so startup time and resident memory do not grow with the size of the vectors.
+
+    Every write creates a new generation of data files and then swaps the sidecar, which points to the generation in use.
+    Readers therefore see either the old or the new store, never a mix of both. The previous generation is only removed
+    by the write after, so a reader that read the old sidecar just before the swap can still open its data files.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(_meta_file(path), 'r', encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        self.generation: str = meta["generation"]
+        self.titles: List[str] = meta["titles"]
+        self.keys: List[str] = meta["keys"]
+        self.model: str = meta["model"]
+        # Fingerprint of the source file per title, used for incremental ingestion
+        self.sources: Dict[str, dict] = meta.get("sources", {})
+        self.offsets = np.asarray(meta["offsets"], dtype=np.int64)
+        self._files = _data_files(path, self.generation)
+        self.vectors = np.load(self._files["vectors"], mmap_mode='r')
+        # Stores written before pooled vectors existed don't have them, the EmbeddingIndex pools those itself
+        self.pooled = np.load(self._files["pooled"], mmap_mode='r') if os.path.exists(self._files["pooled"]) else None
+        self._text_offsets = None
+        self._title_indexes = None
+        if self.model != EMBEDDING_MODEL:
+            logging.warning("Embedding store %s was built with %s, but %s is configured. Scores will be meaningless.",
+                            path, self.model, EMBEDDING_MODEL)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        """Checks if a complete store exists. The sidecar is written last, so its presence marks a finished store."""
+        return os.path.exists(_meta_file(path))
+
+    @classmethod
+    def write(cls, path: str, movies: Dict[str, List[Entry]], model: str = EMBEDDING_MODEL,
+              sources: Dict[str, dict] | None = None) -> "EmbeddingStore":
+        """Writes the movies to a new generation of the store at path, atomically replacing an existing one.
+        Vectors are written movie by movie, so only a single movie is held in memory on top of the input.
+
+        Args:
+            path (str): The base path of the store, without extension.
+            movies (Dict[str, List[Entry]]): Keyvalue pair of movie name and its embedded chunks.
+            model (str, optional): The embedding model the vectors were created with.
+            sources (Dict[str, dict] | None, optional): Fingerprint of the source file per title.
+
+        Returns:
+            EmbeddingStore: The freshly written store.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        generation = f"{time.time_ns():x}"
+        files = _data_files(path, generation)
+
+        titles, keys, offsets = [], [], [0]
+        for title, entries in movies.items():
+            titles.append(title)
+            offsets.append(offsets[-1] + len(entries))
+            keys.extend(key for key, _, _ in entries)
+        dimension = next((len(entries[0][2]) for entries in movies.values() if entries), 0)
+
+        matrix = np.lib.format.open_memmap(files["vectors"], mode='w+', dtype=np.float32, shape=(len(keys), dimension))
+        pooled = np.lib.format.open_memmap(files["pooled"], mode='w+', dtype=np.float32, shape=(len(titles), dimension))
+        text_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        with open(files["texts"], 'wb') as text_file:
+            for i, entries in enumerate(movies.values()):
+                if not entries:
+                    continue
+                block = np.asarray([embedding for _, _, embedding in entries], dtype=np.float32)
+                norms = np.linalg.norm(block, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                matrix[offsets[i]:offsets[i + 1]] = block / norms
+                pooled[i] = (block / norms).mean(axis=0)
+                for row, (_, text, _) in enumerate(entries, start=offsets[i]):
+                    encoded = text.encode('utf-8')
+                    text_file.write(encoded)
+                    text_offsets[row + 1] = text_offsets[row] + len(encoded)
+        matrix.flush()
+        pooled.flush()
+        del matrix, pooled
+        # np.save appends .npy to names that lack it, so write through a file object
+        with open(files["text_offsets"], 'wb') as offset_file:
+            np.save(offset_file, text_offsets)
+
+        meta = {"version": STORE_VERSION, "generation": generation, "model": model, "titles": titles,
+                "offsets": offsets, "keys": keys, "sources": sources or {}}
+        previous = cls._current_generation(path)
+        with open(_meta_file(path) + ".tmp", 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file, ensure_ascii=False, separators=(',', ':'))
+        os.replace(_meta_file(path) + ".tmp", _meta_file(path))
+        cls._remove_old_generations(path, [generation] + ([previous] if previous is not None else []))
+        logging.info("Wrote embedding store %s with %s movies and %s chunks", path, len(titles), len(keys))
+        return cls(path)
+
+    @staticmethod
+    def _current_generation(path: str) -> str | None:
+        """The generation the sidecar at path points to, or None if there is no store yet."""
+        try:
+            with open(_meta_file(path), 'r', encoding='utf-8') as meta_file:
+                return json.load(meta_file).get("generation")
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _remove_old_generations(path: str, keep: List[str]) -> None:
+        """Removes the data files of every generation except the given ones. Open memory maps stay valid on POSIX."""
+        current = set()
+        for generation in keep:
+            current |= set(_data_files(path, generation).values()) | {f"{path}.{generation}.{suffix}" for suffix in DERIVED_SUFFIXES}
+        for suffix in ("vectors.npy", "pooled.npy", "texts.txt", "text_offsets.npy") + DERIVED_SUFFIXES:
+            for file in glob.glob(f"{glob.escape(path)}.*.{suffix}"):
+                if file not in current:
+                    try:
+                        os.remove(file)
+                    except OSError as e:
+                        logging.warning("Could not remove old store file %s: %s", file, e)
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def index_of(self, title: str) -> int:
+        """Returns the index of a movie in titles and offsets. Raises KeyError for unknown movies."""
+        if self._title_indexes is None:
+            self._title_indexes = {title: i for i, title in enumerate(self.titles)}
+        return self._title_indexes[title]
+
+    def _load_text_offsets(self) -> np.ndarray:
+        if self._text_offsets is None:
+            self._text_offsets = np.load(self._files["text_offsets"], mmap_mode='r')
+        return self._text_offsets
+
+    def text(self, row: int) -> str:
+        """Reads the text of a single chunk from disk.
+
+        Args:
+            row (int): The row of the chunk in the vector matrix.
+
+        Returns:
+            str: The raw text of the chunk.
+        """
+        text_offsets = self._load_text_offsets()
+        start, end = int(text_offsets[row]), int(text_offsets[row + 1])
+        with open(self._files["texts"], 'rb') as text_file:
+            text_file.seek(start)
+            return text_file.read(end - start).decode('utf-8')
+
+    def movie_entries(self, title: str) -> List[Entry]:
+        """Reads every chunk of a movie back from disk, with a single read for the texts.
+
+        Args:
+            title (str): The movie name.
+
+        Returns:
+            List[Entry]: The (key, text, normalized embedding) of every chunk of the movie.
+        """
+        i = self.index_of(title)
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        text_offsets = self._load_text_offsets()
+        with open(self._files["texts"], 'rb') as text_file:
+            text_file.seek(int(text_offsets[start]))
+            data = text_file.read(int(text_offsets[end] - text_offsets[start]))
+        base = int(text_offsets[start])
+        return [
+            (self.keys[row],
+             data[int(text_offsets[row]) - base:int(text_offsets[row + 1]) - base].decode('utf-8'),
+             self.vectors[row])
+            for row in range(start, end)
+        ]
+
+    def movie_texts(self, title: str) -> Dict[str, str]:
+        """Returns the texts of every chunk of a movie, keyed by the chunk key."""
+        return {key: text for key, text, _ in self.movie_entries(title)}
+
+
+def convert_json_to_store(json_path: str, store_path: str) -> EmbeddingStore:
+    """Converts a subtitles.json or worst_movies.json file into an EmbeddingStore.
+
+    Args:
+        json_path (str): Path to the existing JSON file.
+        store_path (str): Base path of the store to create.
+
+    Returns:
+        EmbeddingStore: The converted store.
+    """
+    logging.info("Converting %s to embedding store %s", json_path, store_path)
+    with open(json_path, 'r', encoding='utf-8') as json_file:
+        data = json.load(json_file)
+    return EmbeddingStore.write(store_path, entries_from_dict(data))
+
+
+if __name__ == "__main__":
+    # Usage: python embedding_store.py <json path> <store path>
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3:
+        print("Usage: python embedding_store.py <json path> <store path>")
+        sys.exit(1)
+    convert_json_to_store(sys.argv[1], sys.argv[2])
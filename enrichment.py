@@ -0,0 +1,154 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import weakref
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple, TYPE_CHECKING
+from metrics import metrics
+from settings import ENRICHMENT_MAX_MOVIES, ENRICHMENT_STAGE_LIMITS
+
+if TYPE_CHECKING:
+    from Movie import Movie, MovieChoiceExplainer, MovieDataRetriever
+
+
+class MovieEnrichmentPipeline:
+    """Enriches Movie instances with OMDB data, the Wikipedia plot, a summary and an explanation.
+    Movies are enriched concurrently, and within a single movie the stages that do not depend on each other overlap:
+
+    - OMDB lookup and Wikipedia plot run at the same time.
+    - Once the movie is validated, the plot summary and the explanation run at the same time.
+
+    Every stage ("omdb", "wikipedia", "openai") has its own concurrency limit, so a burst of movies can't flood a single API.
+    enrich/enrich_all run on thread pools, aenrich/aenrich_all run the same stages on the event loop.
+    """
+    def __init__(self, movie_data_retriever: "MovieDataRetriever", movie_choice_explainer: "MovieChoiceExplainer",
+                 stage_limits: Dict[str, int] = ENRICHMENT_STAGE_LIMITS, max_movies: int = ENRICHMENT_MAX_MOVIES):
+        self.movie_data_retriever = movie_data_retriever
+        self.movie_choice_explainer = movie_choice_explainer
+        self._stage_limit_values = dict(stage_limits)
+        self._stage_limits = {stage: threading.BoundedSemaphore(limit) for stage, limit in stage_limits.items()}
+        # asyncio semaphores are bound to an event loop, so the async path keeps a set per loop
+        self._async_stage_limits = weakref.WeakKeyDictionary()
+        # Two pools, so movies waiting on their stages can never starve the stages themselves
+        self._movie_executor = ThreadPoolExecutor(max_workers=max_movies, thread_name_prefix="enrich-movie")
+        self._stage_executor = ThreadPoolExecutor(max_workers=sum(stage_limits.values()), thread_name_prefix="enrich-stage")
+
+    def _run_stage(self, stage: str, function: Callable, *args) -> Future:
+        """Submits a single stage to the stage pool, limited by the concurrency of that stage."""
+        def run():
+            with self._stage_limits[stage]:
+                return function(*args)
+        # Threads of a pool don't inherit the context, copying it keeps the stage timings of the request, see metrics.py
+        return self._stage_executor.submit(contextvars.copy_context().run, run)
+
+    @metrics.instrument("enrichment.movie")
+    def enrich(self, movie: "Movie") -> "Movie":
+        """Enriches a single movie in place.
+
+        Args:
+            movie (Movie): A Movie with at least a title, and optionally a year, reason and user profile.
+
+        Returns:
+            Movie: The same movie. If OMDB can't find it, movie.validated is False and the other stages are skipped.
+        """
+        requested_title = movie.title
+        movie_data = self._run_stage("omdb", self.movie_data_retriever.fetch_movie_data, movie.title, movie.year)
+        longer_plot = self._run_stage("wikipedia", self.movie_data_retriever.get_longer_plot, movie.title, movie.year)
+
+        movie.set_attributes(movie_data.result())
+        if not movie.validated:
+            return movie
+
+        movie.longer_plot = longer_plot.result()
+        if movie.longer_plot is None and movie.title != requested_title:
+            # OMDB corrected the title, which may be the one Wikipedia knows
+            movie.longer_plot = self._run_stage("wikipedia", self.movie_data_retriever.get_longer_plot, movie.title, movie.year).result()
+
+        # Summarize the Wikipedia plot if possible, otherwise the few lines of the OMDB plot
+        summary = self._run_stage("openai", self.movie_data_retriever.summarize_plot, movie.longer_plot or movie.plot)
+        explanation = None
+        if movie.reason is None and movie.user_profile_used is not None:
+            # If no reason has been given yet, we create our own!
+            explanation = self._run_stage("openai", self.movie_choice_explainer.explain_movie, movie, movie.user_profile_used)
+
+        movie.plot = summary.result()
+        if explanation is not None:
+            movie.reason = explanation.result()
+        return movie
+
+    def enrich_all(self, movies: List["Movie"]) -> List["Movie"]:
+        """Enriches all movies concurrently.
+
+        Args:
+            movies (List[Movie]): The movies to enrich.
+
+        Returns:
+            List[Movie]: The enriched movies, in the same order as they were given.
+        """
+        logging.debug("Enriching %s movies", len(movies))
+        futures = [self._movie_executor.submit(contextvars.copy_context().run, self.enrich, movie) for movie in movies]
+        return [future.result() for future in futures]
+
+    async def _arun_stage(self, stage: str, coroutine: Awaitable) -> Any:
+        """Awaits a single stage, limited by the concurrency of that stage on the running loop."""
+        loop = asyncio.get_running_loop()
+        limits = self._async_stage_limits.get(loop)
+        if limits is None:
+            limits = {name: asyncio.Semaphore(limit) for name, limit in self._stage_limit_values.items()}
+            self._async_stage_limits[loop] = limits
+        async with limits[stage]:
+            return await coroutine
+
+    @metrics.instrument("enrichment.movie")
+    async def aenrich(self, movie: "Movie") -> "Movie":
+        """Async version of enrich, with the same stages overlapping on the event loop."""
+        requested_title = movie.title
+        movie_data, longer_plot = await asyncio.gather(
+            self._arun_stage("omdb", self.movie_data_retriever.afetch_movie_data(movie.title, movie.year)),
+            self._arun_stage("wikipedia", self.movie_data_retriever.aget_longer_plot(movie.title, movie.year)),
+        )
+        movie.set_attributes(movie_data)
+        if not movie.validated:
+            return movie
+
+        movie.longer_plot = longer_plot
+        if movie.longer_plot is None and movie.title != requested_title:
+            movie.longer_plot = await self._arun_stage("wikipedia", self.movie_data_retriever.aget_longer_plot(movie.title, movie.year))
+
+        stages = [self._arun_stage("openai", self.movie_data_retriever.asummarize_plot(movie.longer_plot or movie.plot))]
+        if movie.reason is None and movie.user_profile_used is not None:
+            stages.append(self._arun_stage("openai", self.movie_choice_explainer.aexplain_movie(movie, movie.user_profile_used)))
+        results = await asyncio.gather(*stages)
+        movie.plot = results[0]
+        if len(results) > 1:
+            movie.reason = results[1]
+        return movie
+
+    async def aenrich_all(self, movies: List["Movie"]) -> List["Movie"]:
+        """Async version of enrich_all. All movies are enriched concurrently, limited per stage."""
+        logging.debug("Enriching %s movies", len(movies))
+        return list(await asyncio.gather(*(self.aenrich(movie) for movie in movies)))
+
+    async def aenrich_as_completed(self, movies: List["Movie"]) -> AsyncIterator[Tuple[int, "Movie"]]:
+        """Enriches all movies concurrently like aenrich_all, but yields every movie as soon as it is enriched.
+
+        Args:
+            movies (List[Movie]): The movies to enrich.
+
+        Yields:
+            Tuple[int, Movie]: The index of the movie in the given list, and the enriched movie. Fastest movies first.
+        """
+        async def enrich_indexed(index: int, movie: "Movie") -> Tuple[int, "Movie"]:
+            return index, await self.aenrich(movie)
+
+        logging.debug("Enriching %s movies as they complete", len(movies))
+        tasks = [asyncio.ensure_future(enrich_indexed(index, movie)) for index, movie in enumerate(movies)]
+        try:
+            for next_movie in asyncio.as_completed(tasks):
+                yield await next_movie
+        finally:
+            # A client that disconnects halfway closes the stream, the remaining movies are not needed anymore
+            for task in tasks:
+                task.cancel()
@@ -1,13 +1,24 @@
 from typing import Dict, List
-import numpy as np
-from auth import get_openai_client
-from settings import EMBEDDING_MODEL
+from auth import get_async_openai_client, get_openai_client
+from cache import ContentCache, PersistentCache
+from embedder import BatchEmbedder, estimate_tokens
+from metrics import metrics
+from rate_limiter import rate_limiter
+from settings import EMBEDDING_MODEL, OPENAI_MODEL, CACHE_PATH, CONTENT_CACHE_TTL, CONTENT_CACHE_MEMORY_ENTRIES, CONTENT_CACHE_MAX_ENTRIES
 from user_profile import UserProfile
 import json
 import logging
 
+content_cache = ContentCache(
+    PersistentCache(CACHE_PATH, max_entries=CONTENT_CACHE_MAX_ENTRIES, table="content"),
+    memory_entries=CONTENT_CACHE_MEMORY_ENTRIES,
+    ttl=CONTENT_CACHE_TTL
+)
+batch_embedder = BatchEmbedder(get_openai_client, cache=content_cache)
 
 def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
+    # numpy is only needed here, importing it lazily keeps it out of the startup of the API
+    import numpy as np
     vec1 = np.array(vec1)
     vec2 = np.array(vec2)
     return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
@@ -25,13 +36,107 @@ def create_preference_embedding(user_profile: UserProfile) -> List[float]:
     metadata = user_profile.to_metadata_str()
     return create_text_embedding(metadata)
 
+def create_preference_embeddings(user_profiles: List[UserProfile]) -> List[List[float]]:
+    """Batch version of create_preference_embedding, all profiles are embedded in a handful of batched requests.
+
+    Args:
+        user_profiles (List[UserProfile]): The user profiles to embed
+
+    Returns:
+        List[List[float]]: One embedding per user profile, in the same order
+    """
+    return create_text_embeddings([user_profile.to_metadata_str() for user_profile in user_profiles])
+
+def estimate_chat_tokens(messages: List[Dict[str, str]], max_tokens: int) -> int:
+    """Estimates the tokens a chat completion counts against the rate limit: the prompt and the longest possible answer."""
+    return sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+
 def create_text_embedding(text: str) -> List[float]:
-    response = get_openai_client().embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=text
-    )
-    # Extract the embedding data from the response
-    return response.data[0].embedding
+    """Embeds the text with the EMBEDDING_MODEL. Results are cached, so the same text is only embedded once.
+
+    Args:
+        text (str): The text to embed
+
+    Returns:
+        List[float]: Returns an embedding array
+    """
+    def embed() -> List[float]:
+        rate_limiter.acquire("openai_embeddings", tokens=estimate_tokens(text))
+        with metrics.timed("openai.embedding"):
+            response = get_openai_client().embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=text
+            )
+        metrics.count_tokens(EMBEDDING_MODEL, response)
+        # Extract the embedding data from the response
+        return response.data[0].embedding
+    return content_cache.get_or_compute(EMBEDDING_MODEL, text, None, embed)
+
+def create_text_embeddings(texts: List[str], use_cache: bool = True) -> List[List[float]]:
+    """Embeds many texts in a handful of batched requests instead of one request per text.
+
+    Args:
+        texts (List[str]): The texts to embed
+        use_cache (bool, optional): Use the content cache. Bulk ingestion skips it, as it keeps its embeddings itself
+
+    Returns:
+        List[List[float]]: One embedding per text, in the same order
+    """
+    return batch_embedder.embed(texts, use_cache=use_cache)
+
+def create_chat_completion(messages: List[Dict[str, str]], max_tokens: int) -> str:
+    """Sends the messages to the OPENAI_MODEL and returns the stripped answer.
+    Results are cached by (model, messages, max_tokens), so the same prompt is only sent once.
+
+    Args:
+        messages (List[Dict[str, str]]): The chat messages, as expected by the OpenAI API.
+        max_tokens (int): The maximum amount of tokens in the answer.
+
+    Returns:
+        str: The content of the answer.
+    """
+    def complete() -> str:
+        rate_limiter.acquire("openai", tokens=estimate_chat_tokens(messages, max_tokens))
+        with metrics.timed("openai.chat"):
+            response = get_openai_client().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                max_tokens=max_tokens
+            )
+        metrics.count_tokens(OPENAI_MODEL, response)
+        return response.choices[0].message.content.strip()
+    return content_cache.get_or_compute(OPENAI_MODEL, messages, max_tokens, complete)
+
+async def acreate_preference_embedding(user_profile: UserProfile) -> List[float]:
+    """Async version of create_preference_embedding."""
+    return await acreate_text_embedding(user_profile.to_metadata_str())
+
+async def acreate_text_embedding(text: str) -> List[float]:
+    """Async version of create_text_embedding, using the async OpenAI client. Shares the cache with the sync version."""
+    async def embed() -> List[float]:
+        await rate_limiter.aacquire("openai_embeddings", tokens=estimate_tokens(text))
+        with metrics.timed("openai.embedding"):
+            response = await get_async_openai_client().embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=text
+            )
+        metrics.count_tokens(EMBEDDING_MODEL, response)
+        return response.data[0].embedding
+    return await content_cache.aget_or_compute(EMBEDDING_MODEL, text, None, embed)
+
+async def acreate_chat_completion(messages: List[Dict[str, str]], max_tokens: int) -> str:
+    """Async version of create_chat_completion, using the async OpenAI client. Shares the cache with the sync version."""
+    async def complete() -> str:
+        await rate_limiter.aacquire("openai", tokens=estimate_chat_tokens(messages, max_tokens))
+        with metrics.timed("openai.chat"):
+            response = await get_async_openai_client().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                max_tokens=max_tokens
+            )
+        metrics.count_tokens(OPENAI_MODEL, response)
+        return response.choices[0].message.content.strip()
+    return await content_cache.aget_or_compute(OPENAI_MODEL, messages, max_tokens, complete)
 
 def load_json_data(path) -> Dict[str, dict]:
     """Loads the data from a JSON file.
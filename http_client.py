@@ -0,0 +1,175 @@
+import asyncio
+import importlib.util
+import logging
+import random
+import threading
+import time
+import weakref
+import httpx
+
+from rate_limiter import INTERACTIVE, RateLimitExceeded, current_priority, rate_limiter
+from settings import HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_MAX_RETRIES, HTTP_BACKOFF, \
+    RATE_LIMIT_MAX_WAIT
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client() -> httpx.Client:
+    """Returns the HTTP client shared by every module. It keeps a pool of keep-alive connections per host,
+    so repeated calls to TMDB, OMDB and Wikipedia skip the TCP and TLS handshakes.
+    HTTP/2 is used when the optional h2 package is installed.
+
+    Returns:
+        httpx.Client: The shared client.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(
+                    http2=importlib.util.find_spec("h2") is not None,
+                    timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS),
+                    follow_redirects=True,
+                )
+    return _client
+
+
+def _retry_delay(attempt: int, response: httpx.Response | None = None) -> float:
+    """Exponential backoff with jitter, or the Retry-After header of the response if it has one in seconds."""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+    return HTTP_BACKOFF * (2 ** attempt) * (1 + random.random())
+
+
+def _check_retry_delay(url: str, service: str | None, delay: float) -> None:
+    """Gives up instead of sleeping longer than RATE_LIMIT_MAX_WAIT, when a server asks an interactive call to retry much later.
+    Background calls wait as long as it takes, like they do for the rate limiter."""
+    if delay > RATE_LIMIT_MAX_WAIT and current_priority() == INTERACTIVE:
+        logging.warning("Request to %s asked to retry in %.0fs, giving up", url, delay)
+        raise RateLimitExceeded(service or httpx.URL(url).host, delay)
+
+
+def http_get(url: str, params: dict | None = None, headers: dict | None = None, service: str | None = None) -> httpx.Response:
+    """Sends a GET request through the shared client. Timeouts, connection errors, 429 and 5xx responses
+    are retried up to HTTP_MAX_RETRIES times with exponential backoff.
+
+    Args:
+        url (str): The URL to request.
+        params (dict | None, optional): Query parameters. Parameters that are None are left out, like requests does.
+        headers (dict | None, optional): Extra headers.
+        service (str | None, optional): The service whose rate limit every attempt waits for, see rate_limiter.py.
+
+    Returns:
+        httpx.Response: The response. After the last retry, a 429 or 5xx response is returned as is.
+
+    Raises:
+        RateLimitExceeded: If the rate limit of the service, or the Retry-After of a response, asks an interactive call to wait
+            longer than RATE_LIMIT_MAX_WAIT.
+    """
+    if params is not None:
+        params = {key: value for key, value in params.items() if value is not None}
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        if service is not None:
+            rate_limiter.acquire(service)
+        try:
+            response = get_http_client().get(url, params=params, headers=headers)
+        except httpx.TransportError as e:
+            if attempt == HTTP_MAX_RETRIES:
+                raise
+            delay = _retry_delay(attempt)
+            logging.warning("Request to %s failed (%s), retrying in %.1fs", url, e, delay)
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == HTTP_MAX_RETRIES:
+                return response
+            delay = _retry_delay(attempt, response)
+            if response.status_code == 429 and service is not None:
+                rate_limiter.penalize(service, delay)
+            _check_retry_delay(url, service, delay)
+            logging.warning("Request to %s returned %s, retrying in %.1fs", url, response.status_code, delay)
+        time.sleep(delay)
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Returns the async HTTP client shared by every coroutine on the running event loop.
+    An httpx.AsyncClient is bound to the loop it is used on, so every loop gets its own client.
+
+    Returns:
+        httpx.AsyncClient: The shared async client of the running loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS),
+            follow_redirects=True,
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def ahttp_get(url: str, params: dict | None = None, headers: dict | None = None, service: str | None = None) -> httpx.Response:
+    """Async version of http_get, with the same retry behaviour. Waiting for a retry does not block the event loop.
+
+    Args:
+        url (str): The URL to request.
+        params (dict | None, optional): Query parameters. Parameters that are None are left out.
+        headers (dict | None, optional): Extra headers.
+        service (str | None, optional): The service whose rate limit every attempt waits for.
+
+    Returns:
+        httpx.Response: The response. After the last retry, a 429 or 5xx response is returned as is.
+
+    Raises:
+        RateLimitExceeded: Like http_get.
+    """
+    if params is not None:
+        params = {key: value for key, value in params.items() if value is not None}
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        if service is not None:
+            await rate_limiter.aacquire(service)
+        try:
+            response = await get_async_http_client().get(url, params=params, headers=headers)
+        except httpx.TransportError as e:
+            if attempt == HTTP_MAX_RETRIES:
+                raise
+            delay = _retry_delay(attempt)
+            logging.warning("Request to %s failed (%s), retrying in %.1fs", url, e, delay)
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == HTTP_MAX_RETRIES:
+                return response
+            delay = _retry_delay(attempt, response)
+            if response.status_code == 429 and service is not None:
+                await asyncio.to_thread(rate_limiter.penalize, service, delay)
+            _check_retry_delay(url, service, delay)
+            logging.warning("Request to %s returned %s, retrying in %.1fs", url, response.status_code, delay)
+        await asyncio.sleep(delay)
+
+
+_wikipedia = None
+
+
+def get_wikipedia():
+    """Returns the wikipediaapi.Wikipedia instance shared by every module. It keeps its own requests session,
+    so connections to Wikipedia are reused instead of building a new client per page.
+
+    Returns:
+        wikipediaapi.Wikipedia: The shared English Wikipedia client.
+    """
+    global _wikipedia
+    if _wikipedia is None:
+        with _client_lock:
+            if _wikipedia is None:
+                import wikipediaapi
+                _wikipedia = wikipediaapi.Wikipedia(user_agent='movie-recommender', language='en', timeout=HTTP_TIMEOUT)
+    return _wikipedia
@@ -0,0 +1,53 @@
+import argparse
+import os
+import subprocess
+import sys
+
+from typing import List, Tuple
+
+DEFAULT_MODULES = ["api", "Movie", "recommenders.OpenAIRecommender", "recommenders.SubtitleRecommender", "recommenders.WorstMovieRecommender"]
+
+
+def measure_import(module: str) -> List[Tuple[str, int, int, int]]:
+    """Imports the module in a fresh interpreter with -X importtime.
+
+    Args:
+        module (str): The module to import, e.g. "api".
+
+    Returns:
+        List[Tuple[str, int, int, int]]: (module, self time, cumulative time, depth) of every imported module, times in microseconds.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        timings.append((name.strip(), int(self_time), int(cumulative), depth))
+    return timings
+
+
+def print_report(module: str, top: int) -> None:
+    timings = measure_import(module)
+    total = next((cumulative for name, _, cumulative, _ in reversed(timings) if name == module), 0)
+    print(f"{module}: {total / 1000:.0f} ms, {len(timings)} modules")
+    # Only the packages imported directly by this project, ordered by what they cost including their own imports
+    top_level = [timing for timing in timings if timing[3] <= 1 and timing[0] != module]
+    for name, _, cumulative, _ in sorted(top_level, key=lambda timing: timing[2], reverse=True)[:top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shows how long importing the entry points takes, and which imports are the slowest.")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES, help="The modules to import, defaults to the API and the recommenders.")
+    parser.add_argument("--top", type=int, default=10, help="The amount of slowest imports to show per module.")
+    args = parser.parse_args()
+    for module in args.modules:
+        print_report(module, args.top)
@@ -0,0 +1,235 @@
+import bisect
+import contextlib
+import contextvars
+import functools
+import inspect
+import threading
+import time
+
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Tuple
+from settings import METRICS_ENABLED, METRICS_BUCKETS
+
+PREFIX = "movie_recommender"
+COUNTER_HELP = {
+    "stage_errors_total": "Calls of a stage that raised an exception.",
+    "cache_requests_total": "Cache lookups per cache and result.",
+    "openai_tokens_total": "Tokens used per OpenAI model and kind, as reported by the API.",
+    "coalesced_calls_total": "Calls that waited for an identical call in flight instead of making their own, see singleflight.py.",
+    "rate_limit_rejections_total": "Interactive calls that failed as they would have waited too long for the rate limit of their service.",
+}
+GAUGE_HELP = {
+    "rate_limit_queue_depth": "Calls waiting for the rate limit of their service, over every process, see rate_limiter.py.",
+}
+
+# The (stage, seconds) of every stage timed in the current request, if the request collects them for Server-Timing
+_request_timings: contextvars.ContextVar[List[Tuple[str, float]] | None] = contextvars.ContextVar("request_timings", default=None)
+
+
+class Histogram:
+    """A Prometheus histogram of durations in seconds."""
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+class _Timer:
+    """Times a block and reports it to the registry, failed or not."""
+    __slots__ = ("registry", "stage", "start")
+
+    def __init__(self, registry: "MetricsRegistry", stage: str):
+        self.registry = registry
+        self.stage = stage
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        self.registry.observe(self.stage, time.perf_counter() - self.start, failed=exc_type is not None)
+        return False
+
+
+_NOT_TIMED = contextlib.nullcontext()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+class MetricsRegistry:
+    """Collects the latency of every external call and pipeline stage, and counts cache hits and OpenAI tokens.
+    Stages are named after the service or step, e.g. "omdb.lookup" or "movie.summarize_plot".
+
+    Disabled, timed() returns a shared no-op context manager and count() returns right away, so instrumented code
+    pays for a single flag check. Timings are still collected for requests that ask for them, see request_timings.
+    """
+    def __init__(self, enabled: bool = METRICS_ENABLED, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Histogram] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._gauges: Dict[str, Callable[[], List[Tuple[Dict[str, str], float]]]] = {}
+
+    def timed(self, stage: str) -> ContextManager:
+        """Times the block as the given stage.
+
+        Args:
+            stage (str): The name of the stage, used as its label.
+
+        Returns:
+            ContextManager: A timer, or a no-op if nothing collects the timing.
+        """
+        if not self.enabled and _request_timings.get() is None:
+            return _NOT_TIMED
+        return _Timer(self, stage)
+
+    def instrument(self, stage: str) -> Callable[[Callable], Callable]:
+        """Decorator version of timed, for functions and coroutine functions."""
+        def decorator(function: Callable) -> Callable:
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timed(stage):
+                        return await function(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timed(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, stage: str, seconds: float, failed: bool = False) -> None:
+        """Records the duration of a single call of the stage."""
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, seconds))
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+        if failed:
+            self.count("stage_errors_total", stage=stage)
+
+    def count(self, name: str, amount: float = 1, **labels: Any) -> None:
+        """Increases a counter.
+
+        Args:
+            name (str): The name of the counter without prefix, one of COUNTER_HELP.
+            amount (float, optional): The amount to add.
+            **labels: The labels of the counter, e.g. cache="omdb".
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def count_cache(self, cache: str, result: str) -> None:
+        """Counts a lookup of the cache, with a result such as "hit" or "miss"."""
+        self.count("cache_requests_total", cache=cache, result=result)
+
+    def count_tokens(self, model: str, response: Any) -> None:
+        """Counts the tokens in the usage of an OpenAI response. Embedding responses only have prompt tokens."""
+        usage = getattr(response, "usage", None) if self.enabled else None
+        if usage is None:
+            return
+        for kind in ("prompt", "completion"):
+            tokens = getattr(usage, f"{kind}_tokens", None)
+            if tokens:
+                self.count("openai_tokens_total", tokens, model=model, kind=kind)
+
+    def register_gauge(self, name: str, collect: Callable[[], List[Tuple[Dict[str, str], float]]]) -> None:
+        """Registers a gauge that is collected when the metrics are rendered, such as the length of a queue.
+
+        Args:
+            name (str): The name of the gauge without prefix, one of GAUGE_HELP.
+            collect (Callable[[], List[Tuple[Dict[str, str], float]]]): Returns the (labels, value) of every series of the gauge.
+        """
+        self._gauges[name] = collect
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            if self._histograms:
+                name = f"{PREFIX}_stage_seconds"
+                lines += [f"# HELP {name} Duration of the external calls and pipeline stages in seconds.", f"# TYPE {name} histogram"]
+                for stage, histogram in sorted(self._histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{_format_labels((('stage', stage), ('le', le)))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels((('stage', stage),))} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels((('stage', stage),))} {cumulative}")
+            counters = sorted(self._counters.items())
+        for counter in sorted({name for (name, _), _ in counters}):
+            name = f"{PREFIX}_{counter}"
+            lines += [f"# HELP {name} {COUNTER_HELP.get(counter, counter)}", f"# TYPE {name} counter"]
+            lines += [f"{name}{_format_labels(labels)} {value}" for (counter_name, labels), value in counters if counter_name == counter]
+        for gauge, collect in sorted(self._gauges.items()):
+            name = f"{PREFIX}_{gauge}"
+            lines += [f"# HELP {name} {GAUGE_HELP.get(gauge, gauge)}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}" for labels, value in collect()]
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+metrics = MetricsRegistry()
+
+
+@contextlib.contextmanager
+def request_timings() -> Iterator[List[Tuple[str, float]]]:
+    """Collects the (stage, seconds) of every stage timed within the block, also in tasks and threads started from it
+    that copy the context. Used for the Server-Timing header of a single request."""
+    timings = []
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def server_timing_header(timings: List[Tuple[str, float]], total: float | None = None) -> str:
+    """Formats the timings as a Server-Timing header, one entry per stage. Stages that ran several times, often concurrently,
+    are summed, so their duration can be more than the total.
+
+    Args:
+        timings (List[Tuple[str, float]]): The (stage, seconds) collected by request_timings.
+        total (float | None, optional): The duration of the whole request in seconds.
+
+    Returns:
+        str: The header value, e.g. 'omdb.lookup;dur=120.5;desc="5 calls", total;dur=950.1'.
+    """
+    durations: Dict[str, List[float]] = {}
+    for stage, seconds in timings:
+        durations.setdefault(stage, []).append(seconds)
+    entries = [f'{stage};dur={sum(values) * 1000:.1f};desc="{len(values)} calls"' for stage, values in durations.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
@@ -1,32 +1,150 @@
-import requests
+import asyncio
 import os
 import logging
 
-from auth import get_openai_client
-from settings import OMDB_URL, OPENAI_MODEL
+from helpers import create_chat_completion
+from http_client import ahttp_get, http_get
+from metrics import metrics
+from cache import MISSING, PersistentCache
+from movie_data.title_catalogue import title_catalogue
+from singleflight import SingleFlight
+from settings import OMDB_URL, CACHE_PATH, OMDB_CACHE_TTL, OMDB_NEGATIVE_CACHE_TTL, OMDB_CACHE_MAX_ENTRIES
 
-omdb_api_key = os.getenv('OMDB_API_KEY')
-client = get_openai_client()
+omdb_cache = PersistentCache(CACHE_PATH, max_entries=OMDB_CACHE_MAX_ENTRIES, table="omdb")
+# Concurrent lookups of the same movie that miss the cache share a single request
+omdb_flight = SingleFlight("omdb")
 
-def get_movie_by_title(title: str, year: str = None) -> dict | None:
-    logging.info("Validating movie: %s",title)
-    response = requests.get(OMDB_URL, params={"apikey": omdb_api_key, "t": title, "plot": "full", "y": year}) 
-    data = response.json()
+def _cache_key(title: str, year: str = None) -> str:
+    """Normalizes the title and year, so "The Matrix " and "the matrix" share a cache entry."""
+    normalized_title = " ".join(title.casefold().split())
+    normalized_year = str(year).strip() if year else ""
+    return f"{normalized_title}|{normalized_year}"
+
+def _resolve(title: str, year: str = None) -> tuple:
+    """Resolves the title in the local title catalogue, which also corrects titles that are slightly off.
+
+    Returns:
+        tuple: The cache key and the OMDB query parameters, by IMDb id if the catalogue knows the movie, by title and year otherwise.
+    """
+    if not title_catalogue.exists():
+        return _cache_key(title, year), {"t": title, "y": year}
+    match = title_catalogue.resolve(title, year)
+    if match is None:
+        metrics.count_cache("title_catalogue", "miss")
+        return _cache_key(title, year), {"t": title, "y": year}
+    metrics.count_cache("title_catalogue", "hit" if match.similarity == 1.0 else "fuzzy_hit")
+    if match.similarity < 1.0:
+        logging.info("Resolved %s (%s) to %s (%s, %s)", title, year, match.title, match.year, match.imdb_id)
+    return match.imdb_id, {"i": match.imdb_id}
+
+def lookup_movie(title: str, year: str = None) -> dict | None:
+    """Looks up a movie on OMDB, using the persistent cache first. Movies in the local title catalogue are looked up by
+    their IMDb id, so titles that are slightly off still find the movie, see movie_data/title_catalogue.py.
+    Other movies are looked up by title and year.
+    Found movies are cached for OMDB_CACHE_TTL and "Movie not found!" answers for OMDB_NEGATIVE_CACHE_TTL.
+    Other errors, such as an exceeded quota, are not cached.
+
+    Responses are cached under the title and year as asked, and under the IMDb id. A title that was looked up before
+    is answered from the cache without resolving it in the catalogue again.
+
+    Args:
+        title (str): The title of the movie.
+        year (str, optional): The year of the movie. Defaults to None.
+
+    Returns:
+        dict | None: The raw movie data from OMDB, or None if the movie is not found.
+    """
+    title_key = _cache_key(title, year)
+    data = omdb_cache.get(title_key)
+    if data is MISSING:
+        data = omdb_flight.do(("title", title_key), _lookup_uncached, title_key, title, year)
+    else:
+        metrics.count_cache("omdb", "hit")
+    # Coalesced callers get the same dictionary, and get_movie_by_title changes the plot in place
+    data = dict(data) if data is not None else None
+    if data is None:
+        logging.error("Movie not found: %s", title)
+    return data
+
+async def alookup_movie(title: str, year: str = None) -> dict | None:
+    """Async version of lookup_movie, sharing the same cache. The cache and the catalogue are used in a thread,
+    so SQLite does not block the event loop."""
+    title_key = _cache_key(title, year)
+    data = await asyncio.to_thread(omdb_cache.get, title_key)
+    if data is MISSING:
+        data = await omdb_flight.ado(("title", title_key), _alookup_uncached, title_key, title, year)
+    else:
+        metrics.count_cache("omdb", "hit")
+    data = dict(data) if data is not None else None
+    if data is None:
+        logging.error("Movie not found: %s", title)
+    return data
+
+def _lookup_uncached(title_key: str, title: str, year: str = None) -> dict | None:
+    """Resolves a title that is not cached, and requests it unless the movie is cached by its IMDb id."""
+    key, query = _resolve(title, year)
+    data = _cached_by_id(title_key, key)
+    if data is MISSING:
+        metrics.count_cache("omdb", "miss")
+        data = omdb_flight.do(key, _request_movie, (key, title_key), title, query)
+    return data
+
+async def _alookup_uncached(title_key: str, title: str, year: str = None) -> dict | None:
+    """Async version of _lookup_uncached."""
+    key, query = await asyncio.to_thread(_resolve, title, year)
+    data = await asyncio.to_thread(_cached_by_id, title_key, key)
+    if data is MISSING:
+        metrics.count_cache("omdb", "miss")
+        data = await omdb_flight.ado(key, _arequest_movie, (key, title_key), title, query)
+    return data
+
+def _cached_by_id(title_key: str, key: str) -> dict | None:
+    """Returns the movie cached under the IMDb id a title resolved to, and caches it under the title as well. MISSING if it is not cached."""
+    if key == title_key:
+        return MISSING
+    data = omdb_cache.get(key)
+    if data is not MISSING:
+        metrics.count_cache("omdb", "hit")
+        omdb_cache.set(title_key, data, OMDB_CACHE_TTL if data is not None else OMDB_NEGATIVE_CACHE_TTL)
+    return data
+
+def _request_movie(keys: tuple, title: str, query: dict) -> dict | None:
+    """Requests the movie from OMDB and caches the response under the keys."""
+    with metrics.timed("omdb.lookup"):
+        response = http_get(OMDB_URL, params={"apikey": os.getenv('OMDB_API_KEY'), "plot": "full", **query}, service="omdb")
+    return _cache_response(keys, title, response.json())
+
+async def _arequest_movie(keys: tuple, title: str, query: dict) -> dict | None:
+    """Async version of _request_movie."""
+    with metrics.timed("omdb.lookup"):
+        response = await ahttp_get(OMDB_URL, params={"apikey": os.getenv('OMDB_API_KEY'), "plot": "full", **query}, service="omdb")
+    return await asyncio.to_thread(_cache_response, keys, title, response.json())
+
+def _cache_response(keys: tuple, title: str, data: dict) -> dict | None:
+    """Caches an OMDB response under the keys and returns the movie data, or None if there is no movie."""
     if data['Response'] == "True":
-        data['Plot'] = _summarize_plot(data['Plot'])
+        omdb_cache.set_many(dict.fromkeys(keys, data), OMDB_CACHE_TTL)
         return data
-    logging.error("Movie not found: %s", title)
+    if data.get('Error') == "Movie not found!":
+        omdb_cache.set_many(dict.fromkeys(keys), OMDB_NEGATIVE_CACHE_TTL)
+    else:
+        logging.error("OMDB error for %s: %s", title, data.get('Error'))
     return None
 
+def get_movie_by_title(title: str, year: str = None) -> dict | None:
+    logging.info("Validating movie: %s",title)
+    data = lookup_movie(title, year)
+    if data is not None:
+        data['Plot'] = _summarize_plot(data['Plot'])
+    return data
+
 def _summarize_plot(plot: str) -> str:
     logging.debug("Summarizing plot -> %s", plot)
     prompt = (f"Summarize the following plot:\n\n{plot}")
-    response = client.chat.completions.create(
-        model=OPENAI_MODEL,
+    return create_chat_completion(
         messages=[
             {"role": "system", "content": "You are a helpful assistant that provides detailed movie recommendations."},
             {"role": "user", "content": prompt}
         ],
         max_tokens=200
-    )
-    return response.choices[0].message.content.strip()
\ No newline at end of file
+    )
\ No newline at end of file
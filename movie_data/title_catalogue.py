@@ -0,0 +1,245 @@
+"""A local catalogue of movie titles, built from IMDb's bulk files (https://datasets.imdbws.com/), to resolve titles without OMDB.
+
+    python -m movie_data.title_catalogue title.basics.tsv.gz --ratings title.ratings.tsv.gz
+
+Titles are looked up by their normalized form first. Titles that are slightly off, e.g. "The Godfather Part 2" or
+"Shawshank Redemption", are matched by the trigrams they share with the catalogue.
+"""
+import argparse
+import gzip
+import logging
+import time
+import unicodedata
+
+from typing import IO, Iterator, List, NamedTuple, Set
+from readonly_store import ReadOnlyStore, build_store
+from settings import TITLE_CATALOGUE_PATH, TITLE_CATALOGUE_TYPES, TITLE_CATALOGUE_MIN_SIMILARITY
+
+INSERT_BATCH_SIZE = 10000
+# Fuzzy matching only probes the postings of the rarest trigrams of a title, which are short and most telling,
+# and skips the trigrams that would take the amount of postings read above FUZZY_MAX_POSTINGS
+PROBED_TRIGRAMS = 8
+FUZZY_MAX_POSTINGS = 50000
+FUZZY_CANDIDATES = 50
+
+
+class TitleMatch(NamedTuple):
+    imdb_id: str
+    title: str
+    year: int | None
+    similarity: float
+
+
+def normalize_title(title: str) -> str:
+    """Normalizes case, accents, punctuation and whitespace, so "Amélie" and "amelie", or "Se7en." and "Se7en" match."""
+    decomposed = unicodedata.normalize("NFKD", title.casefold().replace("&", " and "))
+    characters = (character if character.isalnum() else " " for character in decomposed if not unicodedata.combining(character))
+    return " ".join("".join(characters).split())
+
+
+def trigrams(normalized_title: str) -> Set[int]:
+    """The trigrams of every word of a normalized title, padded like PostgreSQL's pg_trgm ("  w", " wo", "wor", "ord", "rd ").
+    Trigrams are packed into an integer, 21 bits per character, which keeps the index small."""
+    result = set()
+    for word in normalized_title.split():
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            result.add(ord(padded[i]) << 42 | ord(padded[i + 1]) << 21 | ord(padded[i + 2]))
+    return result
+
+
+def similarity(a: Set[int], b: Set[int]) -> float:
+    """The share of trigrams two titles have in common, from 0 to 1."""
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+def _parse_year(value: str | int | None) -> int | None:
+    try:
+        return int(str(value).strip()[:4])
+    except (TypeError, ValueError):
+        return None
+
+
+def _year_matches(year: int | None, requested_year: int | None) -> bool:
+    """Whether a title is from the requested year, give or take a year for festival and international releases.
+    Every title matches when no year is requested."""
+    return requested_year is None or (year is not None and abs(year - requested_year) <= 1)
+
+
+def iter_rows(file: IO[str]) -> Iterator[dict]:
+    """Streams the rows of an IMDb .tsv file as dictionaries, with None for the \\N of missing values."""
+    columns = next(file).rstrip("\n").split("\t")
+    for line in file:
+        values = line.rstrip("\n").split("\t")
+        yield {column: None if value == "\\N" else value for column, value in zip(columns, values)}
+
+
+def open_tsv(path: str) -> IO[str]:
+    """Opens an IMDb .tsv file, decompressing .gz files on the fly."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+class TitleCatalogue(ReadOnlyStore):
+    """IMDb ids, titles and years in SQLite, indexed by normalized title and by trigram."""
+    def resolve(self, title: str, year: str | int | None = None, min_similarity: float = TITLE_CATALOGUE_MIN_SIMILARITY) -> TitleMatch | None:
+        """Finds the movie that is meant by a title, which may be slightly off.
+
+        Args:
+            title (str): The title of the movie, e.g. from an LLM or the name of a subtitle file.
+            year (str | int | None, optional): The year of the movie. Only titles released within a year of it match.
+            min_similarity (float, optional): The share of trigrams a fuzzy match must have in common with the title.
+
+        Returns:
+            TitleMatch | None: The best match, with a similarity of 1 for an exact match, or None if no title is similar enough.
+                Of movies with the same title, the one with the most votes wins. None as well if the catalogue has the title,
+                but not from the requested year: the movie may be newer than the catalogue, and OMDB is searched by title and year instead.
+        """
+        normalized = normalize_title(title)
+        if not normalized:
+            return None
+        requested_year = _parse_year(year)
+        with self._lock:
+            connection = self._connection()
+            if connection is None:
+                return None
+            exact = connection.execute(
+                "SELECT imdb_id, title, year FROM titles WHERE normalized = ? ORDER BY votes DESC LIMIT ?", (normalized, FUZZY_CANDIDATES)
+            ).fetchall()
+            if exact:
+                matches = [row for row in exact if _year_matches(row[2], requested_year)]
+                if requested_year is not None:
+                    # The exact year goes first, then the most votes
+                    matches.sort(key=lambda row: abs(row[2] - requested_year))
+                    if not matches:
+                        # Titles shared by more movies than FUZZY_CANDIDATES, e.g. "Home", are looked up by year as well
+                        matches = connection.execute(
+                            "SELECT imdb_id, title, year FROM titles WHERE normalized = ? AND year BETWEEN ? AND ? "
+                            "ORDER BY ABS(year - ?), votes DESC LIMIT 1",
+                            (normalized, requested_year - 1, requested_year + 1, requested_year)
+                        ).fetchall()
+                # A title the catalogue only knows from other years is not resolved, the movie may be newer than the catalogue
+                return TitleMatch(*matches[0], 1.0) if matches else None
+            query = trigrams(normalized)
+            rows = self._fuzzy_candidates(connection, query)
+
+        best, best_score = None, None
+        for imdb_id, candidate_title, candidate_normalized, candidate_year, votes in rows:
+            candidate_similarity = similarity(query, trigrams(candidate_normalized))
+            if candidate_similarity < min_similarity or not _year_matches(candidate_year, requested_year):
+                continue
+            score = (candidate_similarity, requested_year is not None and candidate_year == requested_year, votes)
+            if best_score is None or score > best_score:
+                best, best_score = TitleMatch(imdb_id, candidate_title, candidate_year, candidate_similarity), score
+        return best
+
+    @staticmethod
+    def _fuzzy_candidates(connection, query: Set[int]) -> List[tuple]:
+        """The titles that share the most of the rarest trigrams of the query. Only used while holding self._lock."""
+        if not query:
+            return []
+        placeholders = ",".join("?" * len(query))
+        frequencies = connection.execute(
+            f"SELECT trigram, titles FROM trigram_frequencies WHERE trigram IN ({placeholders}) ORDER BY titles", list(query)
+        ).fetchall()
+        probed, postings = [], 0
+        for trigram, titles in frequencies[:PROBED_TRIGRAMS]:
+            if postings + titles > FUZZY_MAX_POSTINGS:
+                break
+            probed.append(trigram)
+            postings += titles
+        if not probed:
+            return []
+        placeholders = ",".join("?" * len(probed))
+        return connection.execute(
+            f"SELECT imdb_id, title, normalized, year, votes FROM titles WHERE id IN ("
+            f"SELECT title_id FROM trigrams WHERE trigram IN ({placeholders}) GROUP BY title_id ORDER BY COUNT(*) DESC LIMIT ?)",
+            probed + [FUZZY_CANDIDATES]
+        ).fetchall()
+
+    @classmethod
+    def build(cls, basics_path: str, path: str = TITLE_CATALOGUE_PATH, ratings_path: str | None = None,
+              title_types: tuple = TITLE_CATALOGUE_TYPES) -> "TitleCatalogue":
+        """Imports the titles of an IMDb title.basics file into a new catalogue, replacing the one at path.
+
+        Args:
+            basics_path (str): A title.basics.tsv or .tsv.gz file.
+            path (str, optional): The SQLite file of the catalogue.
+            ratings_path (str | None, optional): A title.ratings.tsv(.gz) file. The number of votes decides between movies with the same title.
+            title_types (tuple, optional): The titleType values to import, adult titles are always skipped.
+
+        Returns:
+            TitleCatalogue: The new catalogue.
+        """
+        start = time.perf_counter()
+        titles = 0
+        with build_store(path) as connection, open_tsv(basics_path) as basics:
+            connection.execute(
+                "CREATE TABLE titles (id INTEGER PRIMARY KEY, imdb_id TEXT NOT NULL, title TEXT NOT NULL, normalized TEXT NOT NULL, "
+                "year INTEGER, votes INTEGER NOT NULL DEFAULT 0)"
+            )
+            # The postings are collected in a temporary table and sorted into the clustered trigrams table at the end
+            connection.execute("CREATE TEMP TABLE postings (trigram INTEGER NOT NULL, title_id INTEGER NOT NULL)")
+            title_batch, trigram_batch = [], []
+            for row in iter_rows(basics):
+                if row.get("titleType") not in title_types or row.get("isAdult") == "1" or not row.get("primaryTitle"):
+                    continue
+                normalized = normalize_title(row["primaryTitle"])
+                if not normalized:
+                    continue
+                titles += 1
+                title_batch.append((titles, row["tconst"], row["primaryTitle"], normalized, _parse_year(row.get("startYear"))))
+                trigram_batch += ((trigram, titles) for trigram in trigrams(normalized))
+                if len(title_batch) >= INSERT_BATCH_SIZE:
+                    cls._insert(connection, title_batch, trigram_batch)
+                    title_batch, trigram_batch = [], []
+                    logging.info("Imported %s titles", titles)
+            cls._insert(connection, title_batch, trigram_batch)
+
+            # Indexing once after the import is much faster than keeping the indexes up to date during it
+            connection.execute("CREATE UNIQUE INDEX titles_imdb_id ON titles (imdb_id)")
+            connection.execute("CREATE INDEX titles_normalized ON titles (normalized)")
+            connection.execute("CREATE TABLE trigrams (trigram INTEGER NOT NULL, title_id INTEGER NOT NULL, PRIMARY KEY (trigram, title_id)) WITHOUT ROWID")
+            connection.execute("INSERT INTO trigrams SELECT trigram, title_id FROM postings ORDER BY trigram, title_id")
+            connection.execute("DROP TABLE postings")
+            connection.execute("CREATE TABLE trigram_frequencies (trigram INTEGER PRIMARY KEY, titles INTEGER NOT NULL)")
+            connection.execute("INSERT INTO trigram_frequencies SELECT trigram, COUNT(*) FROM trigrams GROUP BY trigram")
+            if ratings_path is not None:
+                with open_tsv(ratings_path) as ratings:
+                    cls._import_votes(connection, ratings)
+        logging.info("Built title catalogue %s with %s titles in %.1fs", path, titles, time.perf_counter() - start)
+        return cls(path)
+
+    @staticmethod
+    def _insert(connection, title_batch: List[tuple], trigram_batch: List[tuple]) -> None:
+        connection.executemany("INSERT INTO titles (id, imdb_id, title, normalized, year) VALUES (?, ?, ?, ?, ?)", title_batch)
+        connection.executemany("INSERT INTO postings VALUES (?, ?)", trigram_batch)
+
+    @staticmethod
+    def _import_votes(connection, ratings: IO[str]) -> None:
+        """Sets the number of votes of every title in the catalogue. Ratings of other titles are skipped by the update."""
+        batch = []
+        for row in iter_rows(ratings):
+            batch.append((int(row["numVotes"] or 0), row["tconst"]))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                connection.executemany("UPDATE titles SET votes = ? WHERE imdb_id = ?", batch)
+                batch = []
+        connection.executemany("UPDATE titles SET votes = ? WHERE imdb_id = ?", batch)
+
+
+title_catalogue = TitleCatalogue(TITLE_CATALOGUE_PATH)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Imports IMDb's title.basics into the local title catalogue.")
+    parser.add_argument("basics", help="The title.basics.tsv.gz file, or an uncompressed .tsv file.")
+    parser.add_argument("--ratings", help="The title.ratings.tsv.gz file, to prefer popular movies when titles are shared.")
+    parser.add_argument("--output", default=TITLE_CATALOGUE_PATH, help="The SQLite file to write.")
+    parser.add_argument("--types", nargs="+", default=list(TITLE_CATALOGUE_TYPES), help="The title types to import.")
+    args = parser.parse_args()
+    TitleCatalogue.build(args.basics, args.output, ratings_path=args.ratings, title_types=tuple(args.types))
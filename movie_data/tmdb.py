@@ -1,44 +1,210 @@
-import requests
-import streamlit as st
+import asyncio
+import contextvars
 import logging
+import threading
+import time
+import httpx
 
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List
 from auth import get_themoviedb_headers
-from settings import TMDB_URL, TMDB_DISCOVERY_URL
+from cache import MISSING
+from http_client import ahttp_get, http_get
+from metrics import metrics
+from singleflight import SingleFlight
+from settings import TMDB_URL, TMDB_DISCOVERY_URL, TMDB_REFERENCE_TTL, TMDB_KEYWORD_CONCURRENCY, TMDB_KEYWORD_NEGATIVE_TTL, \
+    TMDB_KEYWORD_MAX_ENTRIES
 from user_profile import UserProfile
 
 logging.basicConfig(level=logging.INFO)
 
-def get_genres() -> List[str]:
+# A keyword whose search fails is skipped for the request, and searched again by the next one
+KEYWORD_SEARCH_ERRORS = (httpx.HTTPError, KeyError, ValueError)
+
+class TMDBReferenceCache:
+    """Keeps TMDB reference data in memory, so building a discover URL needs no network calls for warm inputs.
+    Genres and actors are refreshed once they are older than the TTL, and so are keyword ids, which are kept per normalized keyword.
+    Keywords TMDB does not know are cached for the shorter negative_ttl, so they are not searched again on every request.
+    Failed searches are not cached at all. At most max_keywords keyword ids are kept, the least recently used are dropped.
+    Concurrent misses of the same value or keyword share a single request.
+    """
+    def __init__(self, ttl: float, negative_ttl: float = TMDB_KEYWORD_NEGATIVE_TTL, max_keywords: int = TMDB_KEYWORD_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_keywords = max_keywords
+        self._lock = threading.Lock()
+        self._values = {}
+        self._keyword_ids = OrderedDict()
+        self.flight = SingleFlight("tmdb_reference")
+
+    def get(self, name: str, fetch: Callable[[], dict]) -> dict:
+        """Returns the cached value, fetching it if it is missing or older than the TTL."""
+        with self._lock:
+            cached = self._values.get(name)
+        if cached is not None and cached[0] > time.monotonic():
+            metrics.count_cache("tmdb_reference", "hit")
+            return cached[1]
+        metrics.count_cache("tmdb_reference", "miss")
+        value = self.flight.do(("value", name), fetch)
+        with self._lock:
+            self._values[name] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def get_keyword_id(self, keyword: str, fetch: Callable[[str], int | None]) -> int | None:
+        """Returns the cached id of the keyword, fetching it if it is missing or expired. None means TMDB does not know the keyword.
+        Errors of fetch are raised, and nothing is cached for them."""
+        key = keyword.casefold()
+        keyword_id = self._cached_keyword_id(key)
+        if keyword_id is MISSING:
+            keyword_id = self.flight.do(("keyword", key), fetch, keyword)
+            self._remember_keyword_id(key, keyword_id)
+        return keyword_id
+
+    def _cached_keyword_id(self, key: str) -> int | None:
+        """Returns the cached id of the keyword, or MISSING if it is not cached or expired, and counts the hit or miss."""
+        with self._lock:
+            cached = self._keyword_ids.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self._keyword_ids.move_to_end(key)
+                metrics.count_cache("tmdb_keyword", "hit")
+                return cached[1]
+        metrics.count_cache("tmdb_keyword", "miss")
+        return MISSING
+
+    def _remember_keyword_id(self, key: str, keyword_id: int | None) -> None:
+        ttl = self.ttl if keyword_id is not None else self.negative_ttl
+        with self._lock:
+            self._keyword_ids[key] = (time.monotonic() + ttl, keyword_id)
+            self._keyword_ids.move_to_end(key)
+            while len(self._keyword_ids) > self.max_keywords:
+                self._keyword_ids.popitem(last=False)
+
+    async def aget(self, name: str, fetch: Callable[[], Awaitable[dict]]) -> dict:
+        """Async version of get, where fetch is a coroutine function."""
+        with self._lock:
+            cached = self._values.get(name)
+        if cached is not None and cached[0] > time.monotonic():
+            metrics.count_cache("tmdb_reference", "hit")
+            return cached[1]
+        metrics.count_cache("tmdb_reference", "miss")
+        value = await self.flight.ado(("value", name), fetch)
+        with self._lock:
+            self._values[name] = (time.monotonic() + self.ttl, value)
+        return value
+
+    async def aget_keyword_id(self, keyword: str, fetch: Callable[[str], Awaitable[int | None]]) -> int | None:
+        """Async version of get_keyword_id, where fetch is a coroutine function."""
+        key = keyword.casefold()
+        keyword_id = self._cached_keyword_id(key)
+        if keyword_id is MISSING:
+            keyword_id = await self.flight.ado(("keyword", key), fetch, keyword)
+            self._remember_keyword_id(key, keyword_id)
+        return keyword_id
+
+    def clear(self) -> None:
+        """Forgets all reference data and keyword ids."""
+        with self._lock:
+            self._values.clear()
+            self._keyword_ids.clear()
+
+reference_cache = TMDBReferenceCache(ttl=TMDB_REFERENCE_TTL)
+# Keywords of every request are resolved on the same threads, instead of starting a pool per request
+keyword_executor = ThreadPoolExecutor(max_workers=TMDB_KEYWORD_CONCURRENCY, thread_name_prefix="tmdb-keyword")
+# Users with the same preferences at the same time send the same discover URL, which is requested once
+discover_flight = SingleFlight("tmdb_discover")
+
+@metrics.instrument("tmdb.genres")
+def _fetch_genres() -> dict[str, int]:
     url = f"{TMDB_URL}genre/movie/list?language=en"
-    response = requests.get(url, headers=get_themoviedb_headers())
+    response = http_get(url, headers=get_themoviedb_headers(), service="tmdb")
     data = response.json()
     return {genre['name']: genre['id'] for genre in data['genres']}
 
-def get_actors() -> List[str]:
-    """ 
-    Get a list of popular actors 
-    Only returns top 20 "popular" actors, should be enough for demo purposes
-    """
+@metrics.instrument("tmdb.actors")
+def _fetch_actors() -> dict[str, int]:
     url = f"{TMDB_URL}person/popular"
-    response = requests.get(url, headers=get_themoviedb_headers())
+    response = http_get(url, headers=get_themoviedb_headers(), service="tmdb")
     data = response.json()
     return  {actor['name']: actor['id'] for actor in data['results']}
 
+@metrics.instrument("tmdb.keyword")
+def _fetch_keyword_id(keyword: str) -> int | None:
+    url = f"{TMDB_URL}search/keyword"
+    response = http_get(url, params={"query": keyword, "page": 1}, headers=get_themoviedb_headers(), service="tmdb")
+    return _first_keyword_id(response)
+
+@metrics.instrument("tmdb.genres")
+async def _afetch_genres() -> dict[str, int]:
+    response = await ahttp_get(f"{TMDB_URL}genre/movie/list?language=en", headers=get_themoviedb_headers(), service="tmdb")
+    return {genre['name']: genre['id'] for genre in response.json()['genres']}
+
+@metrics.instrument("tmdb.actors")
+async def _afetch_actors() -> dict[str, int]:
+    response = await ahttp_get(f"{TMDB_URL}person/popular", headers=get_themoviedb_headers(), service="tmdb")
+    return {actor['name']: actor['id'] for actor in response.json()['results']}
+
+@metrics.instrument("tmdb.keyword")
+async def _afetch_keyword_id(keyword: str) -> int | None:
+    response = await ahttp_get(f"{TMDB_URL}search/keyword", params={"query": keyword, "page": 1}, headers=get_themoviedb_headers(), service="tmdb")
+    return _first_keyword_id(response)
+
+def _first_keyword_id(response: httpx.Response) -> int | None:
+    """Returns the id of the best match of a keyword search, or None if the search found nothing.
+    Error responses, such as 429, 5xx or an invalid API key, raise instead, so they are not cached as unknown keywords."""
+    response.raise_for_status()
+    results = response.json()['results']
+    return results[0]['id'] if results else None
+
+def get_genres() -> dict[str, int]:
+    """Get the movie genres, cached for TMDB_REFERENCE_TTL seconds"""
+    return reference_cache.get("genres", _fetch_genres)
+
+def get_actors() -> dict[str, int]:
+    """ 
+    Get a list of popular actors, cached for TMDB_REFERENCE_TTL seconds
+    Only returns top 20 "popular" actors, should be enough for demo purposes
+    """
+    return reference_cache.get("actors", _fetch_actors)
+
 def get_keyword_ids(keywords: List[str]) -> List[int]:
     """
-    Get a list of keyword ids
+    Get a list of keyword ids. Keywords are resolved concurrently and cached, unknown keywords are skipped.
     """
-    keyword_ids = []
-    
-    for keyword in keywords:
-        url = f"{TMDB_URL}search/keyword?query={keyword}&page=1"
-        response = requests.get(url, headers=get_themoviedb_headers())
-        data = response.json()
+    keywords = [keyword.strip() for keyword in keywords if keyword.strip()]
+    if not keywords:
+        return []
+    def resolve(keyword: str) -> int | None:
+        try:
+            return reference_cache.get_keyword_id(keyword, _fetch_keyword_id)
+        except KEYWORD_SEARCH_ERRORS as e:
+            logging.warning("Keyword search for %s failed: %s", keyword, e)
+            return None
+
+    # The searches run in the context of the caller, for its rate limit priority and request timings
+    futures = [keyword_executor.submit(contextvars.copy_context().run, resolve, keyword) for keyword in keywords]
+    return _found_keyword_ids(keywords, [future.result() for future in futures])
+
+async def aget_keyword_ids(keywords: List[str]) -> List[int]:
+    """Async version of get_keyword_ids, sharing the same cache."""
+    keywords = [keyword.strip() for keyword in keywords if keyword.strip()]
+    async def resolve(keyword: str) -> int | None:
         try:
-            keyword_ids.append(data['results'][0]['id'])
-        except:
+            return await reference_cache.aget_keyword_id(keyword, _afetch_keyword_id)
+        except KEYWORD_SEARCH_ERRORS as e:
+            logging.warning("Keyword search for %s failed: %s", keyword, e)
+            return None
+
+    resolved = await asyncio.gather(*(resolve(keyword) for keyword in keywords))
+    return _found_keyword_ids(keywords, resolved)
+
+def _found_keyword_ids(keywords: List[str], resolved: List[int | None]) -> List[int]:
+    keyword_ids = []
+    for keyword, keyword_id in zip(keywords, resolved):
+        if keyword_id is None:
             logging.error(f"Keyword {keyword} not found")
+        else:
+            keyword_ids.append(keyword_id)
     return keyword_ids
 
 def build_tmdb_discover_url(user_profile: UserProfile) -> str:
@@ -52,6 +218,24 @@ def build_tmdb_discover_url(user_profile: UserProfile) -> str:
     Returns:
         _type_: the URL to send to TMDB
     """
+    genre_dict = get_genres() if user_profile.genres != [] else {}
+    keyword_ids = get_keyword_ids(user_profile.themes) if user_profile.themes != [''] else None
+    actor_dict = get_actors() if user_profile.actors != [] else {}
+    return _compose_discover_url(user_profile, genre_dict, keyword_ids, actor_dict)
+
+async def abuild_tmdb_discover_url(user_profile: UserProfile) -> str:
+    """Async version of build_tmdb_discover_url. The genres, keywords and actors are resolved concurrently."""
+    async def nothing():
+        return None
+    genre_dict, keyword_ids, actor_dict = await asyncio.gather(
+        reference_cache.aget("genres", _afetch_genres) if user_profile.genres != [] else nothing(),
+        aget_keyword_ids(user_profile.themes) if user_profile.themes != [''] else nothing(),
+        reference_cache.aget("actors", _afetch_actors) if user_profile.actors != [] else nothing(),
+    )
+    return _compose_discover_url(user_profile, genre_dict or {}, keyword_ids, actor_dict or {})
+
+def _compose_discover_url(user_profile: UserProfile, genre_dict: dict, keyword_ids: List[int] | None, actor_dict: dict) -> str:
+    """Appends the filters of the user profile to the discover URL, using the already resolved TMDB ids."""
     url = TMDB_DISCOVERY_URL
     
     # For each of the filters, we need to check if they are not empty. If they are, we skip them.
@@ -59,17 +243,14 @@ def build_tmdb_discover_url(user_profile: UserProfile) -> str:
     
     # All values are appended with a | to make sure the filters are OR filters. 
     if user_profile.genres != []:
-        genre_dict = get_genres()
         genres = '|'.join(map(str, [genre_dict[genre] for genre in user_profile.genres]))
         url += f"&with_genres={genres}"
         
-    if user_profile.themes != ['']:
-        keyword_ids = get_keyword_ids(user_profile.themes)
+    if keyword_ids is not None:
         keywords = '|'.join(map(str, keyword_ids))
         url += f"&with_keywords={keywords}"
         
     if user_profile.actors != []:
-        actor_dict = get_actors()
         actors = '|'.join(map(str, [actor_dict[actor] for actor in user_profile.actors]))
         url += f"&with_cast={actors}"
         
@@ -94,15 +275,29 @@ def discover_movies(user_profile: UserProfile) -> List:
         url = build_tmdb_discover_url(actor_profile)
         data = send_discovery_request(url)
         url = build_tmdb_discover_url(themes_profile)
-        data.update(send_discovery_request(url))
+        data.extend(send_discovery_request(url))
         
     # If still no movies are found, we return an empty list.
     if data == []:
-        st.write("No movies found with these filters")
+        logging.info("No movies found with these filters")
         return []
     
     return data
 
+async def adiscover_movies(user_profile: UserProfile) -> List:
+    """Async version of discover_movies. The two fallback searches run concurrently."""
+    data = await asend_discovery_request(await abuild_tmdb_discover_url(user_profile))
+    
+    if data == []:
+        actor_profile, themes_profile = split_user_profile(user_profile)
+        actor_url, themes_url = await asyncio.gather(abuild_tmdb_discover_url(actor_profile), abuild_tmdb_discover_url(themes_profile))
+        actor_data, themes_data = await asyncio.gather(asend_discovery_request(actor_url), asend_discovery_request(themes_url))
+        data = actor_data + themes_data
+        
+    if data == []:
+        logging.info("No movies found with these filters")
+    return data
+
 def send_discovery_request(url: str) -> dict:
     """For convenience reasons we split the request into a separate function. This function sends a request to the TMDB API
     This cannot be used for the other requests, since not all of them reutrn 'results'. 
@@ -113,12 +308,30 @@ def send_discovery_request(url: str) -> dict:
     Returns:
         dict: a dictionary with the the discovered movies
     """
-    response = requests.get(url, headers=get_themoviedb_headers())
-    data = response.json()
-    if data.get('results') == []:
+    # Coalesced callers share the list, and discover_movies extends it
+    return list(discover_flight.do(url, _request_discovery, url))
+
+async def asend_discovery_request(url: str) -> list:
+    """Async version of send_discovery_request."""
+    return list(await discover_flight.ado(url, _arequest_discovery, url))
+
+@metrics.instrument("tmdb.discover")
+def _request_discovery(url: str) -> list:
+    response = http_get(url, headers=get_themoviedb_headers(), service="tmdb")
+    return _discovery_results(response.json())
+
+@metrics.instrument("tmdb.discover")
+async def _arequest_discovery(url: str) -> list:
+    response = await ahttp_get(url, headers=get_themoviedb_headers(), service="tmdb")
+    return _discovery_results(response.json())
+
+def _discovery_results(data: dict) -> list:
+    """Returns the movies of a discover response. Error responses, such as an exceeded rate limit or an invalid API key,
+    have no results and are logged with the message of TMDB."""
+    if 'results' not in data:
+        logging.error("TMDB discover failed: %s", data.get('status_message', data))
         return []
-    else:
-        return data['results']
+    return data['results'] or []
     
 def split_user_profile(user_profile: UserProfile):
     """TMDB is very picky in their filters. Incompatible actors / themes will result in 0 matches. Therefore it can be
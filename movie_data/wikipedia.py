@@ -0,0 +1,85 @@
+import logging
+import re
+
+from http_client import ahttp_get
+from metrics import metrics
+from movie_data.wikipedia_dump import plot_store
+from settings import WIKIPEDIA_API_URL, WIKIPEDIA_PLOT_MAX_LENGTH, WIKIPEDIA_PLOT_STORE_FALLBACK
+from singleflight import SingleFlight
+
+HEADING = re.compile(r"^(=+)\s*(.+?)\s*\1\s*$", re.MULTILINE)
+# Concurrent requests for the plot of the same movie share a single page fetch, see MovieDataRetriever.get_longer_plot as well
+wikipedia_flight = SingleFlight("wikipedia")
+
+
+def extract_section(text: str, section_title: str) -> str | None:
+    """Extracts the text of a section from a plain text extract with wiki style headings ("== Plot ==").
+    Like wikipediaapi, the text of the section ends at the next heading.
+
+    Args:
+        text (str): The plain text extract of a page.
+        section_title (str): The section to extract.
+
+    Returns:
+        str | None: The text of the section, or None if the page has no such section.
+    """
+    headings = list(HEADING.finditer(text))
+    for i, heading in enumerate(headings):
+        if heading.group(2) == section_title:
+            end = headings[i + 1].start() if i + 1 < len(headings) else len(text)
+            return text[heading.end():end].strip()
+    return None
+
+
+def find_stored_plot(title: str, year: str | None = None) -> str | None:
+    """Looks the plot up in the plot store imported from a Wikipedia dump, see movie_data/wikipedia_dump.py.
+
+    Args:
+        title (str): The title of the movie.
+        year (str | None, optional): The year of the movie, to tell remakes apart.
+
+    Returns:
+        str | None: The stored plot, or None if there is no store or it has no plot for the movie.
+    """
+    if not plot_store.exists():
+        return None
+    plot = plot_store.get(title, year)
+    metrics.count_cache("wikipedia_plot_store", "hit" if plot is not None else "miss")
+    return plot
+
+
+def should_fetch_plot() -> bool:
+    """Whether Wikipedia itself is asked for plots missing from the plot store. Without a store it always is."""
+    return WIKIPEDIA_PLOT_STORE_FALLBACK or not plot_store.exists()
+
+
+async def afetch_longer_plot(title: str, year: str | None = None) -> str | None:
+    """Async version of MovieDataRetriever.get_longer_plot. Fetches the plain text of the page through the
+    shared async HTTP client, instead of the blocking wikipediaapi session.
+
+    Args:
+        title (str): The title of the movie. Needed for wikipedia search.
+        year (str | None, optional): The year of the movie, used to find it in the plot store.
+
+    Returns:
+        str | None: The plot, from the plot store or extracted from Wikipedia, or None if the page or its Plot section does not exist.
+    """
+    plot = find_stored_plot(title, year)
+    if plot is not None or not should_fetch_plot():
+        return plot
+    return await wikipedia_flight.ado(title, _afetch_plot_section, title)
+
+
+@metrics.instrument("wikipedia.plot")
+async def _afetch_plot_section(title: str) -> str | None:
+    params = {"action": "query", "prop": "extracts", "explaintext": 1, "exsectionformat": "wiki",
+              "titles": title, "redirects": 1, "format": "json", "formatversion": 2}
+    response = await ahttp_get(WIKIPEDIA_API_URL, params=params, headers={"User-Agent": "movie-recommender"}, service="wikipedia")
+    pages = response.json().get("query", {}).get("pages", [])
+    if not pages or pages[0].get("missing"):
+        logging.debug("No Wikipedia page for %s", title)
+        return None
+    plot_text = extract_section(pages[0].get("extract", ""), "Plot")
+    if plot_text:
+        return plot_text[:WIKIPEDIA_PLOT_MAX_LENGTH]
+    return None
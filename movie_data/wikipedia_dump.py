@@ -0,0 +1,205 @@
+"""Builds an offline plot store from a Wikipedia pages-articles dump, and looks plots up in it.
+
+    python -m movie_data.wikipedia_dump enwiki-latest-pages-articles.xml.bz2
+
+The dump is streamed page by page and the plots are written in batches, so building the store takes constant memory.
+"""
+import argparse
+import bz2
+import html
+import logging
+import re
+import time
+import xml.etree.ElementTree as ElementTree
+
+from typing import IO, Iterator, Tuple
+from readonly_store import ReadOnlyStore, build_store
+from settings import WIKIPEDIA_PLOT_STORE_PATH, WIKIPEDIA_PLOT_MAX_LENGTH
+
+PLOT_SECTIONS = ("plot", "plot summary")
+INSERT_BATCH_SIZE = 1000
+
+SECTION_HEADING = re.compile(r"^(={2,6})\s*(.+?)\s*\1\s*$", re.MULTILINE)
+DISAMBIGUATION = re.compile(r"\s*\(([^()]*\b)?film\)$", re.IGNORECASE)
+TITLE_YEAR = re.compile(r"\((\d{4})\b[^()]*film\)$", re.IGNORECASE)
+INFOBOX_RELEASED = re.compile(r"^\s*\|\s*released\s*=[^\n]*?\b(\d{4})\b", re.MULTILINE | re.IGNORECASE)
+LEAD_YEAR = re.compile(r"\bis an? (\d{4})\b[^.\n]*?\bfilm\b")
+FILM_MARKERS = re.compile(r"\{\{\s*infobox film\b|\[\[\s*category:\s*\d{4} films\s*\]\]", re.IGNORECASE)
+
+COMMENTS = re.compile(r"<!--.*?-->", re.DOTALL)
+REFERENCES = re.compile(r"<ref[^>/]*/>|<ref[^>]*>.*?</ref>", re.DOTALL | re.IGNORECASE)
+# Templates that wrap text in the running prose, which keep their last parameter. Other templates are dropped.
+INLINE_TEMPLATES = re.compile(r"\{\{\s*(?:nowrap|nobr|lang|small|vr|em)\s*\|(?:[^{}|]*\|)*([^{}|]*)\}\}", re.IGNORECASE)
+TEMPLATES = re.compile(r"\{\{[^{}]*\}\}")
+TABLES = re.compile(r"\{\|.*?\|\}", re.DOTALL)
+FILES = re.compile(r"\[\[(?:file|image):[^\[\]]*(?:\[\[[^\[\]]*\]\][^\[\]]*)*\]\]", re.IGNORECASE)
+LINKS = re.compile(r"\[\[(?:[^|\[\]]*\|)?([^\[\]]*)\]\]")
+EXTERNAL_LINKS = re.compile(r"\[https?://[^\s\]]+\s*([^\]]*)\]")
+FORMATTING = re.compile(r"'{2,}")
+TAGS = re.compile(r"<[^>]+>")
+
+
+def normalize_title(title: str) -> str:
+    """Drops the "(film)" or "(1995 film)" disambiguation of an article title and normalizes case and whitespace,
+    so "Heat (1995 film)" and the OMDB title "Heat" share a key."""
+    return " ".join(DISAMBIGUATION.sub("", title).casefold().split())
+
+
+def wikitext_to_text(wikitext: str) -> str:
+    """Converts wikitext to plain text: links become their label, and templates, references, files and markup are dropped."""
+    text = COMMENTS.sub("", wikitext)
+    text = REFERENCES.sub("", text)
+    # Templates nest, so replace the innermost ones until none are left
+    previous = None
+    while previous != text:
+        previous = text
+        unwrapped = None
+        while unwrapped != text:
+            unwrapped, text = text, INLINE_TEMPLATES.sub(r"\1", text)
+        text = TEMPLATES.sub("", text)
+    text = TABLES.sub("", text)
+    text = FILES.sub("", text)
+    text = LINKS.sub(r"\1", text)
+    text = EXTERNAL_LINKS.sub(r"\1", text)
+    text = FORMATTING.sub("", text)
+    text = TAGS.sub("", text)
+    text = html.unescape(text)
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def extract_plot(wikitext: str) -> str | None:
+    """Returns the plain text of the Plot section of an article, including its subsections, or None if it has none."""
+    headings = list(SECTION_HEADING.finditer(wikitext))
+    for i, heading in enumerate(headings):
+        if heading.group(2).strip().casefold() not in PLOT_SECTIONS:
+            continue
+        level = len(heading.group(1))
+        end = next((following.start() for following in headings[i + 1:] if len(following.group(1)) <= level), len(wikitext))
+        # The text of the subsections is part of the plot, their headings are not
+        return wikitext_to_text(SECTION_HEADING.sub("", wikitext[heading.end():end])) or None
+    return None
+
+
+def extract_year(title: str, wikitext: str) -> str:
+    """Finds the release year in the article title, the infobox or the first sentence. Empty if there is none."""
+    for pattern, text in ((TITLE_YEAR, title), (INFOBOX_RELEASED, wikitext[:5000]), (LEAD_YEAR, wikitext[:10000])):
+        match = pattern.search(text)
+        if match:
+            return match.group(1)
+    return ""
+
+
+def is_film_article(title: str, wikitext: str) -> bool:
+    return title.casefold().endswith("film)") or FILM_MARKERS.search(wikitext) is not None
+
+
+def iter_pages(dump: IO[bytes]) -> Iterator[Tuple[str, str]]:
+    """Streams the (title, wikitext) of every article in a pages-articles dump. Redirects and other namespaces are skipped.
+    Every page is cleared once read, so memory does not grow with the size of the dump."""
+    context = ElementTree.iterparse(dump, events=("start", "end"))
+    _, root = next(context)
+    title, namespace, redirect, text = None, None, False, None
+    for event, element in context:
+        if event != "end":
+            continue
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "title":
+            title = element.text
+        elif tag == "ns":
+            namespace = element.text
+        elif tag == "redirect":
+            redirect = True
+        elif tag == "text":
+            text = element.text
+        elif tag == "page":
+            if namespace == "0" and not redirect and title and text:
+                yield title, text
+            title, namespace, redirect, text = None, None, False, None
+            root.clear()
+
+
+def open_dump(path: str) -> IO[bytes]:
+    """Opens a dump, decompressing .bz2 files on the fly."""
+    return bz2.open(path, "rb") if path.endswith(".bz2") else open(path, "rb")
+
+
+class PlotStore(ReadOnlyStore):
+    """Plots imported from a Wikipedia dump, in a SQLite table indexed by (normalized title, year)."""
+    def get(self, title: str, year: str | int | None = None) -> str | None:
+        """Looks up the plot of a movie.
+
+        Args:
+            title (str): The title of the movie, e.g. "Heat" or "Heat (1995 film)".
+            year (str | int | None, optional): The release year, to tell remakes apart.
+
+        Returns:
+            str | None: The plot, cut off after WIKIPEDIA_PLOT_MAX_LENGTH characters, or None if the store has no plot for the movie.
+                Without a year, a title shared by several films only matches the article named exactly like it.
+        """
+        key = normalize_title(title)
+        with self._lock:
+            connection = self._connection()
+            if connection is None:
+                return None
+            if year:
+                row = connection.execute("SELECT plot FROM plots WHERE title = ? AND year = ?", (key, str(year).strip()[:4])).fetchone()
+                if row is not None:
+                    return row[0][:WIKIPEDIA_PLOT_MAX_LENGTH]
+            rows = connection.execute("SELECT article, plot FROM plots WHERE title = ? LIMIT 10", (key,)).fetchall()
+        exact = [plot for article, plot in rows if article.casefold() == title.strip().casefold()]
+        if exact:
+            return exact[0][:WIKIPEDIA_PLOT_MAX_LENGTH]
+        if len(rows) == 1 and not year:
+            return rows[0][1][:WIKIPEDIA_PLOT_MAX_LENGTH]
+        return None
+
+    @classmethod
+    def build(cls, dump_path: str, path: str = WIKIPEDIA_PLOT_STORE_PATH, films_only: bool = True) -> "PlotStore":
+        """Imports the Plot section of every article in the dump into a new store, replacing the one at path.
+
+        Args:
+            dump_path (str): A pages-articles .xml or .xml.bz2 dump.
+            path (str, optional): The SQLite file of the store.
+            films_only (bool, optional): Only import articles with a film infobox or category, or "(film)" in their title.
+
+        Returns:
+            PlotStore: The new store.
+        """
+        start = time.perf_counter()
+        pages = plots = 0
+        with build_store(path) as connection, open_dump(dump_path) as dump:
+            connection.execute("CREATE TABLE plots (title TEXT NOT NULL, year TEXT NOT NULL, article TEXT NOT NULL, plot TEXT NOT NULL)")
+            batch = []
+            for title, wikitext in iter_pages(dump):
+                pages += 1
+                if films_only and not is_film_article(title, wikitext):
+                    continue
+                plot = extract_plot(wikitext)
+                if plot is None:
+                    continue
+                batch.append((normalize_title(title), extract_year(title, wikitext), title, plot))
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    connection.executemany("INSERT INTO plots VALUES (?, ?, ?, ?)", batch)
+                    plots += len(batch)
+                    batch = []
+                    logging.info("Imported %s plots from %s pages", plots, pages)
+            connection.executemany("INSERT INTO plots VALUES (?, ?, ?, ?)", batch)
+            plots += len(batch)
+            # Indexing once after the import is much faster than keeping the index up to date during it
+            connection.execute("CREATE INDEX plots_title_year ON plots (title, year)")
+        logging.info("Built plot store %s with %s plots from %s pages in %.1fs", path, plots, pages, time.perf_counter() - start)
+        return cls(path)
+
+
+plot_store = PlotStore(WIKIPEDIA_PLOT_STORE_PATH)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Imports the plots of a Wikipedia pages-articles dump into the offline plot store.")
+    parser.add_argument("dump", help="The enwiki-*-pages-articles.xml.bz2 dump, or an uncompressed .xml file.")
+    parser.add_argument("--output", default=WIKIPEDIA_PLOT_STORE_PATH, help="The SQLite file to write.")
+    parser.add_argument("--all-articles", action="store_true", help="Import the Plot section of every article, not only those of films.")
+    args = parser.parse_args()
+    PlotStore.build(args.dump, args.output, films_only=not args.all_articles)
@@ -1,22 +1,28 @@
 import streamlit as st
+import hashlib
 import logging
+import threading
+import time
 
+from collections import OrderedDict
 from movie_data.tmdb import get_genres, get_actors, get_keyword_ids, discover_movies
 from dotenv import load_dotenv
-from recommenders.SubtitleRecommender import SubtitleRecommender
-from recommenders.OpenAIRecommender import AIAssistRecommender, PureAIRecommender
-from recommenders.WorstMovieRecommender import  WorstMovieRecommender
+from recommenders.RecommenderRegistry import lazy_factory
 from data.explanation import recommendation_explanation
+from settings import TMDB_REFERENCE_TTL, STREAMLIT_RESULTS_TTL, STREAMLIT_RESULTS_MAX_ENTRIES
 from user_profile import UserProfile
 
 st.set_page_config(layout="wide")
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-FullAIRecommender = PureAIRecommender()
-AiAssistRecommender = AIAssistRecommender()
-FunRecommender = WorstMovieRecommender() # very fun recommender
-SRTRecommender = SubtitleRecommender()
+# Only the selected recommender is imported and built, instead of all four on every run
+RECOMMENDATION_SYSTEMS = {
+    "Pure AI": lazy_factory("recommenders.OpenAIRecommender", "PureAIRecommender"),
+    "AI-Assisted": lazy_factory("recommenders.OpenAIRecommender", "AIAssistRecommender"),
+    "Subtitle embeddings": lazy_factory("recommenders.SubtitleRecommender", "SubtitleRecommender"),
+    "Worst wikipedia movies": lazy_factory("recommenders.WorstMovieRecommender", "WorstMovieRecommender"), # very fun recommender
+}
 
 if "movie_dict" not in st.session_state:
     st.session_state.recommended_movies = {}
@@ -28,27 +34,61 @@ if not load_dotenv():
     st.error("Could not load .env file, please make sure it exists in the root directory of the project.")
     
 
-actor_dict = get_actors()
-genre_dict = get_genres()
+# Streamlit reruns this script on every interaction, the caches below survive reruns and are shared by all sessions
+@st.cache_data(ttl=TMDB_REFERENCE_TTL, show_spinner=False)
+def load_actors():
+    return get_actors()
 
-def parse_form(recommendation_system, user_profile):
-    print(f"user profile {user_profile}")
-    recommended_movies = get_recommendation_system(recommendation_system).generate_recommendations(user_profile)
-    # Filter movies with self.validated = True
-    recommended_movies = {movie: details for movie, details in recommended_movies.items() if details.validated}
-    st.session_state.movies_dict = recommended_movies
-    
+@st.cache_data(ttl=TMDB_REFERENCE_TTL, show_spinner=False)
+def load_genres():
+    return get_genres()
+
+actor_dict = load_actors()
+genre_dict = load_genres()
+
+@st.cache_resource(show_spinner="Loading recommender...")
 def get_recommendation_system(recommendation_system):
-    if recommendation_system == "Pure AI":
-        return FullAIRecommender
-    elif recommendation_system == "AI-Assisted":
-        return AiAssistRecommender
-    elif recommendation_system == "Subtitle embeddings":
-        return SRTRecommender
-    elif recommendation_system == "Worst wikipedia movies":
-        return FunRecommender
-    else:
-        return FullAIRecommender
+    return RECOMMENDATION_SYSTEMS.get(recommendation_system, RECOMMENDATION_SYSTEMS["Pure AI"])()
+
+class RecommendationResults:
+    """The recommendations per (system, profile hash), shared by every session. The recommendations are collected while
+    they stream in, so they are stored here instead of being returned by a st.cache_data function.
+    Entries expire after ttl seconds, and at most max_entries are kept, the least recently used are dropped."""
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> dict | None:
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is None or cached[0] < time.monotonic():
+                return None
+            self._results.move_to_end(key)
+            return cached[1]
+
+    def set(self, key: tuple, recommendations: dict) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._results[key] = (now + self.ttl, recommendations)
+            self._results.move_to_end(key)
+            # Expired entries are dropped on every write, there are at most max_entries of them to check
+            for expired in [stale for stale, (expires_at, _) in self._results.items() if expires_at < now]:
+                del self._results[expired]
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+@st.cache_resource
+def recommendation_results():
+    return RecommendationResults(STREAMLIT_RESULTS_TTL, STREAMLIT_RESULTS_MAX_ENTRIES)
+
+def profile_hash(user_profile):
+    return hashlib.sha256(user_profile.to_metadata_str().encode("utf-8")).hexdigest()
+
+def cached_recommendations(recommendation_system, user_profile):
+    """Returns the recommendations made earlier for the same system and profile, or None if there are none or they expired."""
+    return recommendation_results().get((recommendation_system, profile_hash(user_profile)))
     
 user_profile = UserProfile()
 
@@ -80,7 +120,7 @@ user_profile.themes = themes.split(',')
 user_profile.other_comments = other_comments
 
 # Button to generate recommendations
-submitted = st.button("Get Recommendations", on_click=parse_form, args=(recommendation_system, user_profile))
+submitted = st.button("Get Recommendations")
     
     
 # Function to display movie details in a pop-up
@@ -95,17 +135,57 @@ def display_movie_details(movie, details):
     st.write(f"**Language:** {details.language}")
     st.write(f"**Country:** {details.country}")
 
-# Display movie posters and names with expanders
-if submitted or "movies_dict" in st.session_state:
+def display_movie_card(movie, details):
+    try:
+        st.image(details.poster, use_column_width=True)
+        with st.expander(f"{details.title} ({details.year})"):
+            display_movie_details(movie, details)
+    except Exception as e:
+        # No image available
+        logging.error(e)
+        logging.error(f"No data available for movie {movie}")
+
+def stream_recommendations(recommendation_system, user_profile):
+    """Shows a card for every recommendation as soon as its title is known, and fills it in once the movie is enriched."""
+    print(f"user profile {user_profile}")
+    cols = st.columns(4)
+    cards = {}
+    recommended_movies = {}
+    for event, index, details in get_recommendation_system(recommendation_system).stream_recommendations(user_profile):
+        if event == "skeleton":
+            cards[index] = cols[index % 4].empty()
+            with cards[index].container():
+                st.write(f"**{details.title}**" + (f" ({details.year})" if details.year else ""))
+                st.caption("Loading movie details...")
+        elif details.validated:
+            recommended_movies[index] = details
+            with cards[index].container():
+                display_movie_card(details.title, details)
+        else:
+            # Filter movies that could not be validated
+            cards[index].empty()
+    if not recommended_movies:
+        st.error("No recommendations could be found. Please try again!")
+    # Keep the recommendations in their ranked order for the next rerun
+    st.session_state.movies_dict = {recommended_movies[index].title: recommended_movies[index] for index in sorted(recommended_movies)}
+    if recommended_movies:
+        recommendation_results().set((recommendation_system, profile_hash(user_profile)), st.session_state.movies_dict)
+
+def display_movies(movies_dict):
+    cols = st.columns(4)
+    for i, (movie, details) in enumerate(movies_dict.items()):
+        with cols[i % 4]:
+            display_movie_card(movie, details)
+
+# Display movie posters and names with expanders, while they are being enriched.
+# Asking again for the same system and preferences, or opening an expander, shows the earlier recommendations.
+if submitted:
+    cached = cached_recommendations(recommendation_system, user_profile)
+    if cached is None:
+        stream_recommendations(recommendation_system, user_profile)
+    else:
+        st.session_state.movies_dict = cached
+        display_movies(cached)
+elif "movies_dict" in st.session_state:
     if st.session_state.movies_dict != {}:
-        cols = st.columns(4)
-        for i, (movie, details) in enumerate(st.session_state.movies_dict.items()):
-            with cols[i % 4]:
-                try:
-                    st.image(details.poster, use_column_width=True)
-                    with st.expander(f"{details.title} ({details.year})"):
-                        display_movie_details(movie, details)
-                except Exception as e:
-                    # No image available
-                    logging.error(e)
-                    logging.error(f"No data available for movie {movie}")
\ No newline at end of file
+        display_movies(st.session_state.movies_dict)
@@ -0,0 +1,253 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Dict, Iterator, List, Tuple
+from metrics import metrics
+from settings import RATE_LIMIT_ENABLED, RATE_LIMIT_PATH, RATE_LIMITS, RATE_LIMIT_MAX_WAIT, RATE_LIMIT_POLL_INTERVAL
+
+# Priority classes, lower goes first. Calls of a class only take tokens while no call of a higher class is waiting for the same service.
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+# A waiting call refreshes its entry every poll, entries of processes that died are dropped after this many seconds
+WAITER_TTL = 30.0
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("rate_limit_priority", default=INTERACTIVE)
+
+
+class RateLimitExceeded(Exception):
+    """Raised when an interactive call would have to wait longer than RATE_LIMIT_MAX_WAIT for its service,
+    or when a service answers an interactive call with a Retry-After longer than that."""
+    def __init__(self, service: str, retry_after: float):
+        super().__init__(f"Rate limit of {service} reached, retry after {retry_after:.0f}s")
+        self.service = service
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token buckets per service, shared by every process using the same SQLite file, so several API workers
+    stay within the limits of OMDB, TMDB and OpenAI together instead of each on their own.
+
+    Every service has one or more buckets, such as "requests" and "tokens" for OpenAI. A bucket holds up to its capacity
+    and refills at capacity per period. A call takes one request and optionally a number of tokens, and waits until
+    every bucket of its service has enough. Interactive calls fail with RateLimitExceeded instead of waiting longer
+    than max_wait, background calls wait as long as it takes.
+    """
+    def __init__(self, path: str = RATE_LIMIT_PATH, limits: Dict[str, Dict[str, Tuple[float, float]]] = RATE_LIMITS,
+                 enabled: bool = RATE_LIMIT_ENABLED, max_wait: float = RATE_LIMIT_MAX_WAIT, poll_interval: float = RATE_LIMIT_POLL_INTERVAL):
+        """
+        Args:
+            path (str, optional): The SQLite file shared by the processes.
+            limits (Dict[str, Dict[str, Tuple[float, float]]], optional): The (capacity, period in seconds) of every bucket of every service.
+            enabled (bool, optional): Disabled, every call goes through right away.
+            max_wait (float, optional): The longest an interactive call waits, in seconds.
+            poll_interval (float, optional): How often a waiting call checks the buckets again, at most, in seconds.
+        """
+        self.path = path
+        self.limits = limits
+        self.enabled = enabled
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        """The connection is opened on first use, like PersistentCache. Only used while holding self._lock."""
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (service TEXT NOT NULL, bucket TEXT NOT NULL, tokens REAL NOT NULL, "
+                "updated_at REAL NOT NULL, PRIMARY KEY (service, bucket))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS waiters (id INTEGER PRIMARY KEY, service TEXT NOT NULL, priority INTEGER NOT NULL, alive_until REAL NOT NULL)"
+            )
+            self._db = connection
+        return self._db
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """A write transaction, which other processes wait for. Only used while holding self._lock."""
+        connection = self._connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _costs(self, service: str, tokens: int) -> Dict[str, float]:
+        """The amount every bucket of the service is charged. A call larger than a bucket takes the whole bucket."""
+        costs = {}
+        for bucket, (capacity, _) in self.limits.get(service, {}).items():
+            costs[bucket] = min(1 if bucket == "requests" else tokens, capacity)
+        return costs
+
+    def _take(self, service: str, costs: Dict[str, float], priority: int, waiter: int | None) -> float:
+        """Takes the costs from the buckets of the service if they all have enough, and no call of a higher priority is waiting.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the seconds until they will be.
+        """
+        now = time.time()
+        with self._lock, self._transaction() as connection:
+            if waiter is not None:
+                connection.execute("UPDATE waiters SET alive_until = ? WHERE id = ?", (now + WAITER_TTL, waiter))
+            connection.execute("DELETE FROM waiters WHERE alive_until < ?", (now,))
+            if connection.execute("SELECT 1 FROM waiters WHERE service = ? AND priority < ? LIMIT 1", (service, priority)).fetchone():
+                return self.poll_interval
+
+            wait, levels = 0.0, {}
+            for bucket, cost in costs.items():
+                capacity, period = self.limits[service][bucket]
+                row = connection.execute("SELECT tokens, updated_at FROM buckets WHERE service = ? AND bucket = ?", (service, bucket)).fetchone()
+                level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * capacity / period)
+                levels[bucket] = level
+                if level < cost:
+                    wait = max(wait, (cost - level) * period / capacity)
+            if wait == 0:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO buckets (service, bucket, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                    [(service, bucket, levels[bucket] - cost, now) for bucket, cost in costs.items()]
+                )
+            return wait
+
+    def _register(self, service: str, priority: int) -> int:
+        with self._lock, self._transaction() as connection:
+            cursor = connection.execute(
+                "INSERT INTO waiters (service, priority, alive_until) VALUES (?, ?, ?)", (service, priority, time.time() + WAITER_TTL)
+            )
+            return cursor.lastrowid
+
+    def _unregister(self, waiter: int) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM waiters WHERE id = ?", (waiter,))
+
+    def _check_wait(self, service: str, priority: int, waited: float, wait: float) -> None:
+        """Raises RateLimitExceeded if an interactive call would wait too long."""
+        if priority == INTERACTIVE and self.max_wait is not None and waited + wait > self.max_wait:
+            metrics.count("rate_limit_rejections_total", service=service)
+            raise RateLimitExceeded(service, wait)
+
+    def acquire(self, service: str, tokens: int = 0) -> None:
+        """Waits until the service may be called. Services without limits are called right away.
+
+        Args:
+            service (str): The service to call, one of RATE_LIMITS, e.g. "tmdb".
+            tokens (int, optional): The estimated tokens of an OpenAI call, taken from the "tokens" bucket.
+
+        Raises:
+            RateLimitExceeded: If an interactive call would have to wait longer than max_wait.
+        """
+        if not self.enabled or service not in self.limits:
+            return
+        priority = _priority.get()
+        costs = self._costs(service, tokens)
+        wait = self._take(service, costs, priority, None)
+        if wait == 0:
+            return
+        self._check_wait(service, priority, 0.0, wait)
+        start = time.perf_counter()
+        waiter = self._register(service, priority)
+        try:
+            while wait > 0:
+                time.sleep(min(wait, self.poll_interval))
+                wait = self._take(service, costs, priority, waiter)
+                if wait > 0:
+                    self._check_wait(service, priority, time.perf_counter() - start, wait)
+        finally:
+            self._unregister(waiter)
+        self._observe_wait(service, priority, time.perf_counter() - start)
+
+    async def aacquire(self, service: str, tokens: int = 0) -> None:
+        """Async version of acquire. The buckets are updated in a thread, as a transaction can wait up to 30 seconds
+        for other processes, and waiting does not block the event loop."""
+        if not self.enabled or service not in self.limits:
+            return
+        priority = _priority.get()
+        costs = self._costs(service, tokens)
+        wait = await asyncio.to_thread(self._take, service, costs, priority, None)
+        if wait == 0:
+            return
+        self._check_wait(service, priority, 0.0, wait)
+        start = time.perf_counter()
+        waiter = await asyncio.to_thread(self._register, service, priority)
+        try:
+            while wait > 0:
+                await asyncio.sleep(min(wait, self.poll_interval))
+                wait = await asyncio.to_thread(self._take, service, costs, priority, waiter)
+                if wait > 0:
+                    self._check_wait(service, priority, time.perf_counter() - start, wait)
+        finally:
+            await asyncio.to_thread(self._unregister, waiter)
+        self._observe_wait(service, priority, time.perf_counter() - start)
+
+    @staticmethod
+    def _observe_wait(service: str, priority: int, seconds: float) -> None:
+        logging.debug("Waited %.2fs for the %s rate limit (%s)", seconds, service, PRIORITY_NAMES[priority])
+        metrics.observe(f"rate_limit.{service}", seconds)
+
+    def penalize(self, service: str, seconds: float) -> None:
+        """Empties the request bucket of the service for the given seconds, after it answered 429 Too Many Requests.
+        Every process then waits, instead of each finding out on its own."""
+        if not self.enabled or "requests" not in self.limits.get(service, {}):
+            return
+        capacity, period = self.limits[service]["requests"]
+        with self._lock, self._transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (service, bucket, tokens, updated_at) VALUES (?, 'requests', ?, ?)",
+                (service, -seconds * capacity / period, time.time())
+            )
+
+    def queue_depths(self) -> Dict[Tuple[str, str], int]:
+        """Returns the amount of calls waiting per (service, priority class), over every process."""
+        if not self.enabled:
+            return {}
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT service, priority, COUNT(*) FROM waiters WHERE alive_until >= ? GROUP BY service, priority", (time.time(),)
+            ).fetchall()
+        return {(service, PRIORITY_NAMES.get(priority, str(priority))): count for service, priority, count in rows}
+
+    def reset(self) -> None:
+        """Refills every bucket and forgets every waiting call."""
+        with self._lock, self._transaction() as connection:
+            connection.execute("DELETE FROM buckets")
+            connection.execute("DELETE FROM waiters")
+
+
+rate_limiter = RateLimiter()
+
+
+def _collect_queue_depths() -> List[Tuple[Dict[str, str], float]]:
+    return [({"service": service, "priority": priority}, count) for (service, priority), count in rate_limiter.queue_depths().items()]
+
+
+metrics.register_gauge("rate_limit_queue_depth", _collect_queue_depths)
+
+
+def current_priority() -> int:
+    """The priority class of calls made in the current context, INTERACTIVE unless within background_priority."""
+    return _priority.get()
+
+
+@contextlib.contextmanager
+def background_priority() -> Iterator[None]:
+    """Runs the calls within the block, and in tasks and threads started from it that copy the context, as background calls.
+    Used for corpus builds, so they leave the rate limits to interactive requests when those are waiting."""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
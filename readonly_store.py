@@ -0,0 +1,64 @@
+import contextlib
+import os
+import pathlib
+import sqlite3
+import threading
+
+from typing import Iterator
+
+
+class ReadOnlyStore:
+    """A SQLite file that is built once by an import and only read afterwards, such as the plot store and the title catalogue.
+    Imports write a new file and swap it in, open stores notice the new file on their next lookup.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+        self._file_id = None
+
+    def _connection(self) -> sqlite3.Connection | None:
+        """Opens the store on first use, and again after it was rebuilt. None if there is no store. Only used while holding self._lock."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        file_id = (stat.st_ino, stat.st_mtime_ns)
+        if self._db is None or file_id != self._file_id:
+            if self._db is not None:
+                self._db.close()
+            self._db = sqlite3.connect(pathlib.Path(self.path).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+            self._file_id = file_id
+        return self._db
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+
+@contextlib.contextmanager
+def build_store(path: str) -> Iterator[sqlite3.Connection]:
+    """Opens a connection to a new store that replaces the file at path once the block succeeds.
+    Until then the old store stays in place, and a failed import leaves it untouched.
+
+    Args:
+        path (str): The SQLite file of the store.
+
+    Returns:
+        Iterator[sqlite3.Connection]: A connection to the new file, without journal, as a failed import is thrown away.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary_path = path + ".tmp"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    connection = sqlite3.connect(temporary_path)
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    try:
+        yield connection
+        connection.commit()
+    except BaseException:
+        connection.close()
+        os.remove(temporary_path)
+        raise
+    connection.close()
+    os.replace(temporary_path, path)
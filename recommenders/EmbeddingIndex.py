@@ -0,0 +1,314 @@
+import logging
+import numpy as np
+
+from typing import List, Sequence, Tuple
+from embedding_store import EmbeddingStore
+from metrics import metrics
+from recommenders.IVFIndex import IVFIndex
+from recommenders.QuantizedVectors import QuantizedVectors
+from settings import BATCH_SCORING_MAX_SCORES, IVF_MIN_ROWS, IVF_NPROBE, AGGREGATION_TOP_K, AGGREGATION_TEMPERATURE, RERANK_CANDIDATES
+
+AGGREGATION_MODES = ("mean", "max", "top_k", "softmax")
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalizes every row of the matrix. Rows with a zero norm are left as zeros.
+
+    Args:
+        matrix (np.ndarray): A 2D array of vectors.
+
+    Returns:
+        np.ndarray: A float32 copy of the matrix where every row has unit length.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Returns the indices of the k highest scores, ordered from high to low.
+    Uses argpartition so only the top k are actually sorted.
+
+    Args:
+        scores (np.ndarray): 1D array of scores.
+        k (int): The amount of indices to return.
+
+    Returns:
+        np.ndarray: The indices of the top k scores.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """Row-wise top_k_indices: returns the indices of the k highest scores of every row, ordered from high to low.
+
+    Args:
+        scores (np.ndarray): 2D array of scores, one row per query.
+        k (int): The amount of indices to return per row.
+
+    Returns:
+        np.ndarray: A (rows, k) array with the indices of the top k scores of every row.
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1)
+
+
+def aggregate_segments(similarities: np.ndarray, offsets: np.ndarray, mode: str,
+                       top_k: int = AGGREGATION_TOP_K, temperature: float = AGGREGATION_TEMPERATURE) -> np.ndarray:
+    """Reduces the similarities of every segment (the intervals of a movie) to a single score, without a Python loop over segments.
+
+    - mean: the average similarity.
+    - max: the similarity of the best matching interval.
+    - top_k: the average of the top_k best matching intervals, or of all intervals of shorter movies.
+    - softmax: the similarities weighted by their softmax, lower temperatures move from mean towards max.
+
+    Args:
+        similarities (np.ndarray): The similarities of every row, 1D or 2D with one column per query.
+        offsets (np.ndarray): The row offsets of the segments, the rows of segment i are offsets[i]:offsets[i + 1].
+        mode (str): One of AGGREGATION_MODES.
+        top_k (int, optional): The amount of intervals averaged by top_k.
+        temperature (float, optional): The temperature of softmax.
+
+    Returns:
+        np.ndarray: One score per segment, with a column per query for 2D similarities.
+    """
+    starts = offsets[:-1]
+    counts = np.diff(offsets)
+    if similarities.ndim == 2:
+        counts = counts[:, np.newaxis]
+    if mode == "mean":
+        return np.add.reduceat(similarities, starts, axis=0) / counts
+    if mode == "max":
+        return np.maximum.reduceat(similarities, starts, axis=0)
+    if mode == "top_k":
+        segments = np.repeat(np.arange(len(starts)), np.diff(offsets))
+        rank = np.arange(len(segments)) - offsets[segments]
+        if similarities.ndim == 2:
+            segments, rank = segments[:, np.newaxis], rank[:, np.newaxis]
+        # Similarities lie in [-1, 1], so this key sorts by segment first and by descending similarity within a segment
+        order = np.argsort(segments * 4.0 - similarities, axis=0, kind="stable")
+        ranked = np.take_along_axis(similarities, order, axis=0)
+        return np.add.reduceat(np.where(rank < top_k, ranked, 0), starts, axis=0) / np.minimum(counts, top_k)
+    if mode == "softmax":
+        # Subtract the maximum of every segment so the exponent can't overflow
+        maxima = np.repeat(np.maximum.reduceat(similarities, starts, axis=0), np.diff(offsets), axis=0)
+        weights = np.exp((similarities - maxima) / temperature)
+        return np.add.reduceat(weights * similarities, starts, axis=0) / np.add.reduceat(weights, starts, axis=0)
+    raise ValueError(f"Unknown aggregation mode {mode}, expected one of {AGGREGATION_MODES}")
+
+
+class EmbeddingIndex:
+    """Holds the embeddings of a corpus as one contiguous, pre-normalized float32 matrix.
+    Every movie owns a consecutive block of rows (its intervals), described by the offsets array:
+    the rows of movie i are matrix[offsets[i]:offsets[i + 1]].
+
+    The default "mean" aggregation equals the average cosine similarity over the intervals of a movie. As the rows are
+    normalized, that is the dot product with the mean vector of the movie, so it is scored against one pooled vector
+    per movie. The other aggregation modes (see aggregate_segments) score every interval and reduce per movie.
+
+    With an approximate (IVF) index, search only scores the movies that own one of the intervals in the probed lists.
+    Those candidates are then scored exactly, so only movies without a single nearby interval can be missed.
+
+    With compressed vectors (float16 or int8, optionally truncated), search first scores every movie on the compressed
+    copy in memory, and then re-ranks the best candidates exactly on the float32 vectors. With both, the candidates of
+    the IVF index are scored on the compressed copy, and only the best of them are read from the float32 vectors.
+    """
+    def __init__(self, titles: Sequence[str], matrix: np.ndarray, offsets: np.ndarray, ann: IVFIndex | None = None,
+                 pooled: np.ndarray | None = None, aggregation: str = "mean", compressed: QuantizedVectors | None = None):
+        if aggregation not in AGGREGATION_MODES:
+            raise ValueError(f"Unknown aggregation mode {aggregation}, expected one of {AGGREGATION_MODES}")
+        self.titles = list(titles)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.counts = np.diff(self.offsets)
+        self.aggregation = aggregation
+        self.compressed = compressed
+        if pooled is None and len(self.titles) > 0:
+            pooled = aggregate_segments(self.matrix, self.offsets, "mean")
+        self.pooled = np.ascontiguousarray(pooled, dtype=np.float32) if pooled is not None else np.empty((0, self.matrix.shape[1]), dtype=np.float32)
+        self.ann = ann
+        # The movie that owns every row, to map the candidate rows of the approximate index back to movies
+        self.row_movies = np.repeat(np.arange(len(self.titles), dtype=np.int32), self.counts) if ann is not None else None
+
+    @classmethod
+    def from_store(cls, store: EmbeddingStore, approximate: bool | None = False, aggregation: str = "mean",
+                   compression: str | None = None) -> "EmbeddingIndex":
+        """Builds the index on top of an EmbeddingStore. The store already holds normalized float32 vectors,
+        so the memory-mapped matrix is used as is instead of being copied into memory.
+
+        Args:
+            store (EmbeddingStore): The store containing the embedded chunks of every movie.
+            approximate (bool | None, optional): Whether to search with an IVF index, persisted next to the store.
+                None uses one only for stores with at least IVF_MIN_ROWS chunks.
+            aggregation (str, optional): How the interval similarities of a movie are combined, one of AGGREGATION_MODES.
+            compression (str | None, optional): float16 or int8 to search in two stages on a compressed copy of the vectors,
+                persisted next to the store. Truncated to EMBEDDING_COMPRESSION_DIMENSIONS dimensions if set.
+
+        Returns:
+            EmbeddingIndex: The index containing every embedded chunk.
+        """
+        if approximate is None:
+            approximate = len(store.keys) >= IVF_MIN_ROWS
+        ann = IVFIndex.for_store(store) if approximate and len(store.keys) > 0 else None
+        compressed = QuantizedVectors.for_store(store, compression) if compression and len(store.keys) > 0 else None
+        logging.debug("Built %s embedding index with %s movies and %s chunks",
+                      "approximate" if ann is not None else compression or "exact", len(store.titles), len(store.keys))
+        return cls(store.titles, store.vectors, store.offsets, ann=ann, pooled=store.pooled, aggregation=aggregation,
+                   compressed=compressed)
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def score(self, query: Sequence[float], aggregation: str | None = None) -> np.ndarray:
+        """Calculates the similarity between the query and every movie, by combining the similarities of its intervals.
+
+        Args:
+            query (Sequence[float]): The query embedding, does not have to be normalized.
+            aggregation (str | None, optional): One of AGGREGATION_MODES, None uses the mode of the index.
+
+        Returns:
+            np.ndarray: One score per movie, in the same order as self.titles.
+        """
+        if len(self.titles) == 0:
+            return np.empty(0, dtype=np.float32)
+        aggregation = aggregation or self.aggregation
+        query = normalize_rows(np.asarray(query, dtype=np.float32)[np.newaxis, :])[0]
+        if aggregation == "mean":
+            return self.pooled @ query
+        return aggregate_segments(self.matrix @ query, self.offsets, aggregation)
+
+    def _movie_rows(self, movies: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The rows of the given movies back to back, and the offsets of every movie within them."""
+        counts = self.counts[movies]
+        local_offsets = np.concatenate(([0], np.cumsum(counts)))
+        # The start of the block of every movie plus the position within the block
+        rows = np.repeat(self.offsets[movies] - local_offsets[:-1], counts) + np.arange(local_offsets[-1])
+        return rows, local_offsets
+
+    def _score_movies(self, query: np.ndarray, movies: np.ndarray, aggregation: str) -> np.ndarray:
+        """Calculates the similarity between the normalized query and the given movies only."""
+        if aggregation == "mean":
+            return self.pooled[movies] @ query
+        rows, local_offsets = self._movie_rows(movies)
+        return aggregate_segments(self.matrix[rows] @ query, local_offsets, aggregation)
+
+    def _coarse_score(self, query: np.ndarray, aggregation: str, movies: np.ndarray | None = None) -> np.ndarray:
+        """Scores every movie, or the given movies only, on the compressed vectors, for the first stage of a two-stage search."""
+        query = self.compressed.prepare_queries(query[np.newaxis, :])[0]
+        if aggregation == "mean":
+            pooled = self.compressed.pooled if movies is None else self.compressed.pooled.take(movies)
+            return pooled.dot(query)
+        if movies is None:
+            return aggregate_segments(self.compressed.rows.dot(query), self.offsets, aggregation)
+        rows, local_offsets = self._movie_rows(movies)
+        return aggregate_segments(self.compressed.rows.take(rows).dot(query), local_offsets, aggregation)
+
+    @metrics.instrument("index.search")
+    def search(self, query: Sequence[float], k: int, exact: bool = False, nprobe: int = IVF_NPROBE,
+               aggregation: str | None = None) -> List[Tuple[str, float]]:
+        """Returns the k best matching movies for the query.
+
+        Args:
+            query (Sequence[float]): The query embedding.
+            k (int): The amount of movies to return.
+            exact (bool, optional): Score every movie on the float32 vectors, even if the index is approximate or compressed.
+            nprobe (int, optional): The amount of IVF lists to visit when searching approximately.
+            aggregation (str | None, optional): One of AGGREGATION_MODES, None uses the mode of the index.
+
+        Returns:
+            List[Tuple[str, float]]: Tuples of (title, score), ordered from best to worst match.
+        """
+        aggregation = aggregation or self.aggregation
+        if exact or (self.ann is None and self.compressed is None):
+            scores = self.score(query, aggregation)
+            return [(self.titles[i], float(scores[i])) for i in top_k_indices(scores, k)]
+        query = normalize_rows(np.asarray(query, dtype=np.float32)[np.newaxis, :])[0]
+        # Re-rank a few times more candidates than requested, to make up for the error of the compression
+        candidates = max(k * RERANK_CANDIDATES, k)
+        if self.ann is not None:
+            movies = np.unique(self.row_movies[self.ann.probe(query, nprobe)])
+            if self.compressed is not None and len(movies) > candidates:
+                movies = movies[top_k_indices(self._coarse_score(query, aggregation, movies), candidates)]
+        else:
+            movies = top_k_indices(self._coarse_score(query, aggregation), candidates)
+        scores = self._score_movies(query, movies, aggregation)
+        return [(self.titles[movies[i]], float(scores[i])) for i in top_k_indices(scores, k)]
+
+    def recall(self, queries: Sequence[Sequence[float]], k: int, nprobe: int = IVF_NPROBE) -> float:
+        """Recall check of the approximate index or compressed vectors: the fraction of the exact top k movies that the default search finds.
+
+        Args:
+            queries (Sequence[Sequence[float]]): Query embeddings, e.g. embeddings of real user profiles.
+            k (int): The amount of movies per query.
+            nprobe (int, optional): The amount of IVF lists to visit.
+
+        Returns:
+            float: The average recall over the queries, 1.0 if every search is exact.
+        """
+        if (self.ann is None and self.compressed is None) or len(queries) == 0:
+            return 1.0
+        found = 0
+        expected = 0
+        for query in queries:
+            exact = {title for title, _ in self.search(query, k, exact=True)}
+            approximate = {title for title, _ in self.search(query, k, nprobe=nprobe)}
+            found += len(exact & approximate)
+            expected += len(exact)
+        return found / max(expected, 1)
+
+    def score_batch(self, queries: Sequence[Sequence[float]], aggregation: str | None = None) -> np.ndarray:
+        """Batch version of score: scores many queries with one matrix-matrix product instead of one product per query.
+
+        Args:
+            queries (Sequence[Sequence[float]]): The query embeddings, do not have to be normalized.
+            aggregation (str | None, optional): One of AGGREGATION_MODES, None uses the mode of the index.
+
+        Returns:
+            np.ndarray: A (queries, movies) array with the score of every movie for every query.
+        """
+        aggregation = aggregation or self.aggregation
+        queries = normalize_rows(np.asarray(queries, dtype=np.float32).reshape(len(queries), -1))
+        if len(self.titles) == 0:
+            return np.empty((len(queries), 0), dtype=np.float32)
+        if aggregation == "mean":
+            return queries @ self.pooled.T
+        return aggregate_segments(self.matrix @ queries.T, self.offsets, aggregation).T
+
+    @metrics.instrument("index.search_batch")
+    def search_batch(self, queries: Sequence[Sequence[float]], k: int, aggregation: str | None = None) -> List[List[Tuple[str, float]]]:
+        """Batch version of search, always exact as a matrix-matrix product is bound by BLAS anyway. Queries are scored in chunks,
+        so the similarities of a chunk never hold more than BATCH_SCORING_MAX_SCORES values.
+
+        Args:
+            queries (Sequence[Sequence[float]]): The query embeddings.
+            k (int): The amount of movies to return per query.
+            aggregation (str | None, optional): One of AGGREGATION_MODES, None uses the mode of the index.
+
+        Returns:
+            List[List[Tuple[str, float]]]: For every query, tuples of (title, score) ordered from best to worst match.
+        """
+        aggregation = aggregation or self.aggregation
+        scored_rows = len(self.pooled) if aggregation == "mean" else len(self.matrix)
+        chunk_size = max(1, BATCH_SCORING_MAX_SCORES // max(scored_rows, 1))
+        results = []
+        for start in range(0, len(queries), chunk_size):
+            scores = self.score_batch(queries[start:start + chunk_size], aggregation)
+            top = top_k_rows(scores, k)
+            for row, indices in zip(scores, top):
+                results.append([(self.titles[i], float(row[i])) for i in indices])
+        return results
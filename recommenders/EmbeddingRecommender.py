@@ -0,0 +1,50 @@
+import logging
+
+from typing import Dict, List
+from Movie import Movie, create_movies
+from recommenders.Recommender import RecommenderInterface
+from recommenders.EmbeddingIndex import EmbeddingIndex
+from settings import AMOUNT_OF_MOVIES
+from helpers import create_text_embeddings
+from user_profile import UserProfile
+
+
+class EmbeddingRecommender(RecommenderInterface):
+    """Base class of the recommenders that compare the embedding of the user profile to an embedded corpus.
+    Subclasses build self.index, in which every movie is named "<title> (<year>)".
+    """
+    index: EmbeddingIndex
+
+    def _movie_specs(self, movie_names: List[str], user_profile: UserProfile | None) -> List[dict]:
+        """Splits the "<title> (<year>)" names of the top movies into the keyword arguments of a Movie."""
+        movie_specs = []
+        for movie_name in movie_names:
+            movie_name_clean = movie_name.strip()
+            title, year = map(str.strip, movie_name_clean.split('(', 1))
+            year = year.split(')', 1)[0]
+            movie_specs.append({"title": title, "year": year, "user_profile": user_profile})
+        return movie_specs
+
+    def generate_batch_recommendations(self, user_profiles: List[UserProfile]) -> List[Dict[str, Movie]]:
+        """Creates recommendations for many user profiles at once.
+        Identical profiles are embedded and scored once, all distinct profiles are embedded in batched requests
+        and scored against the corpus with a single matrix-matrix product.
+        Every movie is enriched once and shared by all profiles it is recommended to. Shared movies can't explain
+        themselves to a single user, so they carry no personal explanation.
+
+        Args:
+            user_profiles (List[UserProfile]): The user profiles to recommend movies for.
+
+        Returns:
+            List[Dict[str, Movie]]: The recommendations of every profile, in the same order as the profiles.
+        """
+        metadata = [user_profile.to_metadata_str() for user_profile in user_profiles]
+        unique_metadata = list(dict.fromkeys(metadata))
+        logging.debug("Generating batch recommendations for %s profiles, %s unique", len(metadata), len(unique_metadata))
+
+        embeddings = create_text_embeddings(unique_metadata)
+        top_movies = dict(zip(unique_metadata, self.index.search_batch(embeddings, AMOUNT_OF_MOVIES)))
+
+        movie_names = list(dict.fromkeys(name for matches in top_movies.values() for name, _ in matches))
+        movies = dict(zip(movie_names, create_movies(self._movie_specs(movie_names, None))))
+        return [{name: movies[name] for name, _ in top_movies[profile]} for profile in metadata]
@@ -0,0 +1,140 @@
+import logging
+import os
+import numpy as np
+
+from embedding_store import EmbeddingStore
+from settings import IVF_N_LISTS, IVF_KMEANS_ITERATIONS, IVF_TRAINING_SAMPLE
+
+# Rows are assigned to their nearest centroid in chunks, so assignment never holds a (rows, lists) matrix
+ASSIGN_CHUNK_ROWS = 65536
+
+
+def _nearest_centroids(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Returns the index of the most similar centroid for every (normalized) row of the matrix."""
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), ASSIGN_CHUNK_ROWS):
+        block = np.asarray(matrix[start:start + ASSIGN_CHUNK_ROWS], dtype=np.float32)
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def ivf_file(store: EmbeddingStore) -> str:
+    """The IVF index belongs to a single generation of the store, so a rewritten store never uses a stale index."""
+    return f"{store.path}.{store.generation}.ivf.npz"
+
+
+class IVFIndex:
+    """Inverted file index for approximate nearest-neighbour search over normalized vectors, in pure NumPy.
+
+    Spherical k-means splits the rows into n_lists clusters. Every row is stored in the list of its nearest centroid:
+    the rows of list i are rows[list_offsets[i]:list_offsets[i + 1]].
+    A query only visits the nprobe lists with the most similar centroids, so the cost of a query is about
+    nprobe / n_lists of a brute-force scan. Raising nprobe trades latency for recall.
+    """
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, rows: np.ndarray):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.rows = np.asarray(rows, dtype=np.int64)
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @staticmethod
+    def default_n_lists(n_rows: int) -> int:
+        """About 4 * sqrt(rows) lists, the usual starting point for IVF indexes."""
+        return max(1, min(n_rows, int(4 * np.sqrt(n_rows))))
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, n_lists: int, iterations: int = IVF_KMEANS_ITERATIONS,
+              sample_size: int = IVF_TRAINING_SAMPLE, seed: int = 0) -> "IVFIndex":
+        """Trains the centroids with spherical k-means on a sample of the rows, and assigns every row to a list.
+
+        Args:
+            matrix (np.ndarray): The L2-normalized vectors, may be a memory map.
+            n_lists (int): The amount of clusters.
+            iterations (int, optional): The amount of k-means iterations.
+            sample_size (int, optional): The amount of rows the centroids are trained on.
+            seed (int, optional): Seed of the random sample and initial centroids, so builds are reproducible.
+
+        Returns:
+            IVFIndex: The trained index.
+        """
+        rng = np.random.default_rng(seed)
+        n_rows = len(matrix)
+        n_lists = max(1, min(n_lists, n_rows))
+        sample_rows = np.sort(rng.choice(n_rows, size=min(sample_size, n_rows), replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+        n_lists = min(n_lists, len(sample))
+
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = _nearest_centroids(sample, centroids)
+            # Sum the members of every cluster in one pass over the sample, sorted by cluster
+            order = np.argsort(assignments, kind="stable")
+            sizes = np.bincount(assignments, minlength=n_lists)
+            filled = np.flatnonzero(sizes)
+            sums = np.zeros_like(centroids)
+            sums[filled] = np.add.reduceat(sample[order], np.concatenate(([0], np.cumsum(sizes)))[filled], axis=0)
+            norms = np.linalg.norm(sums, axis=1)
+            # Empty clusters are restarted on a random sample row
+            empty = norms == 0
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            norms[empty] = 1.0
+            centroids = sums / norms[:, np.newaxis]
+
+        assignments = _nearest_centroids(matrix, centroids)
+        rows = np.argsort(assignments, kind="stable")
+        list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=n_lists))))
+        logging.info("Built IVF index with %s lists over %s rows", n_lists, n_rows)
+        return cls(centroids, list_offsets, rows)
+
+    @classmethod
+    def load(cls, file: str) -> "IVFIndex":
+        with np.load(file) as data:
+            return cls(data["centroids"], data["list_offsets"], data["rows"])
+
+    def save(self, file: str) -> None:
+        """Saves the index, atomically replacing an existing file."""
+        # np.savez appends .npz to names that lack it, so write through a file object
+        with open(file + ".tmp", 'wb') as index_file:
+            np.savez(index_file, centroids=self.centroids, list_offsets=self.list_offsets, rows=self.rows)
+        os.replace(file + ".tmp", file)
+
+    @classmethod
+    def for_store(cls, store: EmbeddingStore, n_lists: int | None = IVF_N_LISTS) -> "IVFIndex":
+        """Loads the index persisted next to the store, or builds and persists it if there is none yet.
+
+        Args:
+            store (EmbeddingStore): The store to index.
+            n_lists (int | None, optional): The amount of lists, None picks default_n_lists. An index with a different
+                amount of lists is rebuilt.
+
+        Returns:
+            IVFIndex: The index over every row of the store.
+        """
+        n_lists = n_lists or cls.default_n_lists(len(store.vectors))
+        file = ivf_file(store)
+        if os.path.exists(file):
+            index = cls.load(file)
+            if index.n_lists == min(n_lists, len(store.vectors)) and len(index.rows) == len(store.vectors):
+                return index
+            logging.info("IVF index %s does not match the settings, rebuilding it", file)
+        index = cls.build(store.vectors, n_lists)
+        index.save(file)
+        return index
+
+    def probe(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """Returns the rows in the nprobe lists whose centroids are most similar to the query.
+
+        Args:
+            query (np.ndarray): The normalized query vector.
+            nprobe (int): The amount of lists to visit.
+
+        Returns:
+            np.ndarray: The candidate rows.
+        """
+        centroid_scores = self.centroids @ query
+        nprobe = min(nprobe, self.n_lists)
+        lists = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe] if nprobe < self.n_lists else np.arange(self.n_lists)
+        return np.concatenate([self.rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists])
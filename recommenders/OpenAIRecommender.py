@@ -1,14 +1,23 @@
 import json
-import streamlit as st
+import logging
 
 from typing import Dict, List
-from Movie import Movie
-from auth import get_openai_client
+from Movie import Movie, acreate_movies, create_movies
+from auth import get_async_openai_client, get_openai_client
+from helpers import estimate_chat_tokens
+from metrics import metrics
+from rate_limiter import rate_limiter
 from recommenders.Recommender import RecommenderInterface
-from movie_data.tmdb import discover_movies
+from movie_data.tmdb import adiscover_movies, discover_movies
 from settings import AMOUNT_OF_MOVIES as amount, OPENAI_MODEL
 from user_profile import UserProfile
 
+def _recommendation_messages(prompt: str) -> List[dict]:
+    return [
+        {"role": "system", "content": "You are a movie expert that provides detailed movie recommendations in JSON format."},
+        {"role": "user", "content": prompt}
+    ]
+
 def send_openai_request(prompt: str) -> str:
     """Sends request to OpenAI's chat endpoint and returns the response.
 
@@ -19,16 +28,33 @@ def send_openai_request(prompt: str) -> str:
         str: The response from the OpenAI API.
     """
     client = get_openai_client()
-    response = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "system", "content": "You are a movie expert that provides detailed movie recommendations in JSON format."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=4096
-    )
+    rate_limiter.acquire("openai", tokens=estimate_chat_tokens(_recommendation_messages(prompt), 4096))
+    with metrics.timed("openai.recommendation"):
+        response = client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=_recommendation_messages(prompt),
+            max_tokens=4096
+        )
+    metrics.count_tokens(OPENAI_MODEL, response)
+    return response.choices[0].message.content
+
+async def asend_openai_request(prompt: str) -> str:
+    """Async version of send_openai_request, using the async OpenAI client."""
+    await rate_limiter.aacquire("openai", tokens=estimate_chat_tokens(_recommendation_messages(prompt), 4096))
+    with metrics.timed("openai.recommendation"):
+        response = await get_async_openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=_recommendation_messages(prompt),
+            max_tokens=4096
+        )
+    metrics.count_tokens(OPENAI_MODEL, response)
     return response.choices[0].message.content
 
+def _parse_movie_list(recommendations: str) -> List[dict]:
+    print(recommendations)
+    movie_list = json.loads(recommendations).get('movies', [])
+    return [{"title": movie['title'], "explanation": movie['explanation']} for movie in movie_list]
+
 def parse_recommendations(recommendations: str) -> Dict[str, Movie]:
     """Parses the recommendation from OpenAI's response.
     Is always in JSON format, so we can parse it directly.
@@ -40,17 +66,22 @@ def parse_recommendations(recommendations: str) -> Dict[str, Movie]:
         Dict[str, Movie]: A dictionary with the movie title as key and the Movie object as value.
     """
     try:
-        print(recommendations)
-        movie_list = json.loads(recommendations).get('movies', [])
-        movie_dict = {}
-        for movie in movie_list:
-            # Turn movie from json into a Movie object
-            cur_movie = Movie(title=movie['title'], explanation=movie['explanation'])
-            movie_dict[movie['title']] = cur_movie
-        return movie_dict
+        movie_list = _parse_movie_list(recommendations)
+        # Turn movies from json into Movie objects, these are enriched concurrently
+        movies = create_movies(movie_list)
+        return {movie['title']: cur_movie for movie, cur_movie in zip(movie_list, movies)}
     except Exception as e:
-        st.error(f"An error occurred while parsing the recommendations: {e} \n Please try again!")
-        
+        logging.error(f"An error occurred while parsing the recommendations: {e}")
+        return {}
+
+async def aparse_recommendations(recommendations: str) -> Dict[str, Movie]:
+    """Async version of parse_recommendations."""
+    try:
+        movie_list = _parse_movie_list(recommendations)
+        movies = await acreate_movies(movie_list)
+        return {movie['title']: cur_movie for movie, cur_movie in zip(movie_list, movies)}
+    except Exception as e:
+        logging.error(f"An error occurred while parsing the recommendations: {e}")
         return {}
 
 def build_prompt(user_profile: UserProfile, current_movies: List = []) -> str:
@@ -93,6 +124,17 @@ class AIAssistRecommender(RecommenderInterface):
         recommendations = send_openai_request(prompt)
         return parse_recommendations(recommendations)
 
+    async def agenerate_recommendations(self, user_profile: UserProfile) -> Dict[str, Movie]:
+        current_movies = await adiscover_movies(user_profile)
+        prompt = build_prompt(user_profile=user_profile, current_movies=current_movies)
+        recommendations = await asend_openai_request(prompt)
+        return await aparse_recommendations(recommendations)
+
+    async def acandidates(self, user_profile: UserProfile) -> List[dict]:
+        current_movies = await adiscover_movies(user_profile)
+        prompt = build_prompt(user_profile=user_profile, current_movies=current_movies)
+        return _parse_movie_list(await asend_openai_request(prompt))
+
 class PureAIRecommender(RecommenderInterface):
     """PureAIRecommender is a recommender that uses OpenAI's chat endpoint to generate movie recommendations based on user preferences.
     It does not use the discover movies function generate recommendations.
@@ -104,3 +146,12 @@ class PureAIRecommender(RecommenderInterface):
         prompt = build_prompt(user_profile=user_profile)
         recommendations = send_openai_request(prompt)
         return parse_recommendations(recommendations)
+
+    async def agenerate_recommendations(self, user_profile: UserProfile) -> Dict[str, Movie]:
+        prompt = build_prompt(user_profile=user_profile)
+        recommendations = await asend_openai_request(prompt)
+        return await aparse_recommendations(recommendations)
+
+    async def acandidates(self, user_profile: UserProfile) -> List[dict]:
+        prompt = build_prompt(user_profile=user_profile)
+        return _parse_movie_list(await asend_openai_request(prompt))
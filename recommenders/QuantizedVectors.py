@@ -0,0 +1,212 @@
+import logging
+import os
+import threading
+import numpy as np
+
+from embedding_store import EmbeddingStore
+from settings import EMBEDDING_COMPRESSION_DIMENSIONS
+
+QUANTIZATION_DTYPES = ("float16", "int8")
+# Compressed vectors are converted back to float32 in chunks, so scoring never holds a float32 copy of the whole matrix
+SCORE_CHUNK_ROWS = 65536
+
+
+def truncate_rows(matrix: np.ndarray, dimensions: int | None) -> np.ndarray:
+    """Keeps the first dimensions of every row and normalizes the rows again. The text-embedding-3 models are trained
+    so that a prefix of the embedding is an embedding by itself.
+
+    Args:
+        matrix (np.ndarray): A 2D array of vectors.
+        dimensions (int | None): The amount of dimensions to keep, None keeps all of them.
+
+    Returns:
+        np.ndarray: A float32 array with unit length rows.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dimensions is not None:
+        matrix = matrix[:, :dimensions]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class QuantizedMatrix:
+    """A matrix stored as float16, or as int8 codes with a float32 scale per row (row = codes * scale)."""
+    def __init__(self, codes: np.ndarray, scales: np.ndarray | None = None):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def quantize(cls, matrix: np.ndarray, dtype: str) -> "QuantizedMatrix":
+        """Compresses a float32 matrix.
+
+        Args:
+            matrix (np.ndarray): The matrix to compress.
+            dtype (str): float16, or int8 for symmetric scalar quantization with a scale per row.
+
+        Returns:
+            QuantizedMatrix: The compressed matrix.
+        """
+        if dtype == "float16":
+            return cls(matrix.astype(np.float16))
+        if dtype == "int8":
+            scales = np.abs(matrix).max(axis=1) / 127
+            scales[scales == 0] = 1.0
+            codes = np.round(matrix / scales[:, np.newaxis]).astype(np.int8)
+            return cls(codes, scales.astype(np.float32))
+        raise ValueError(f"Unknown quantization {dtype}, expected one of {QUANTIZATION_DTYPES}")
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def take(self, indices: np.ndarray) -> "QuantizedMatrix":
+        """Returns the given rows, still compressed."""
+        return QuantizedMatrix(self.codes[indices], self.scales[indices] if self.scales is not None else None)
+
+    def dot(self, queries: np.ndarray) -> np.ndarray:
+        """Calculates matrix @ queries on the decompressed rows.
+
+        Args:
+            queries (np.ndarray): A query vector, or a (dimensions, queries) matrix.
+
+        Returns:
+            np.ndarray: One value per row, or a (rows, queries) matrix.
+        """
+        result = np.empty((len(self.codes),) + queries.shape[1:], dtype=np.float32)
+        for start in range(0, len(self.codes), SCORE_CHUNK_ROWS):
+            block = self.codes[start:start + SCORE_CHUNK_ROWS].astype(np.float32) @ queries
+            if self.scales is not None:
+                scales = self.scales[start:start + SCORE_CHUNK_ROWS]
+                block *= scales if block.ndim == 1 else scales[:, np.newaxis]
+            result[start:start + len(block)] = block
+        return result
+
+
+class QuantizedVectors:
+    """Compressed copy of the vectors of an EmbeddingStore, used for the coarse pass of a two-stage search.
+    Holds the (optionally truncated) rows of every chunk and the pooled mean vector of every movie.
+    The compressed copy is loaded into memory, the float32 vectors stay memory-mapped and are only read for re-ranking.
+    Loaded vectors only read the rows from their file when they are first used, as "mean" aggregation only needs the pooled vectors.
+    """
+    def __init__(self, rows: QuantizedMatrix | None, pooled: QuantizedMatrix, dtype: str, dimensions: int | None,
+                 file: str | None = None, row_count: int | None = None):
+        self._rows = rows
+        self.pooled = pooled
+        self.dtype = dtype
+        self.dimensions = dimensions
+        self.file = file
+        self.row_count = len(rows) if rows is not None else row_count
+        self._lock = threading.Lock()
+
+    @property
+    def rows(self) -> QuantizedMatrix:
+        """The compressed rows of every chunk, read from the file on first use."""
+        if self._rows is None:
+            with self._lock:
+                if self._rows is None:
+                    with np.load(self.file) as data:
+                        self._rows = QuantizedMatrix(data["row_codes"], data["row_scales"] if "row_scales" in data else None)
+                    logging.debug("Loaded %s compressed rows from %s", len(self._rows), self.file)
+        return self._rows
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, offsets: np.ndarray, dtype: str, dimensions: int | None = None) -> "QuantizedVectors":
+        """Compresses the rows and pooled vectors, a block of movies at a time.
+
+        Args:
+            matrix (np.ndarray): The L2-normalized float32 vectors, may be a memory map.
+            offsets (np.ndarray): The row offsets of every movie.
+            dtype (str): One of QUANTIZATION_DTYPES.
+            dimensions (int | None, optional): Truncate the vectors to this prefix dimension first.
+
+        Returns:
+            QuantizedVectors: The compressed vectors.
+        """
+        # Imported here, as the EmbeddingIndex module imports this one
+        from recommenders.EmbeddingIndex import aggregate_segments
+
+        if dtype not in QUANTIZATION_DTYPES:
+            raise ValueError(f"Unknown quantization {dtype}, expected one of {QUANTIZATION_DTYPES}")
+        offsets = np.asarray(offsets, dtype=np.int64)
+        row_blocks, pooled_blocks = [], []
+        first_movie = 0
+        while first_movie < len(offsets) - 1:
+            # Whole movies, so the pooled vector of a movie is computed from its truncated rows in one go
+            last_movie = max(first_movie + 1, int(np.searchsorted(offsets, offsets[first_movie] + SCORE_CHUNK_ROWS, side="right")) - 1)
+            last_movie = min(last_movie, len(offsets) - 1)
+            block = truncate_rows(matrix[offsets[first_movie]:offsets[last_movie]], dimensions)
+            row_blocks.append(QuantizedMatrix.quantize(block, dtype))
+            pooled_blocks.append(QuantizedMatrix.quantize(
+                aggregate_segments(block, offsets[first_movie:last_movie + 1] - offsets[first_movie], "mean"), dtype))
+            first_movie = last_movie
+
+        def concatenate(blocks):
+            if not blocks:
+                return QuantizedMatrix(np.empty((0, dimensions or matrix.shape[1]), dtype=np.float16 if dtype == "float16" else np.int8),
+                                       None if dtype == "float16" else np.empty(0, dtype=np.float32))
+            scales = np.concatenate([b.scales for b in blocks]) if blocks[0].scales is not None else None
+            return QuantizedMatrix(np.concatenate([b.codes for b in blocks]), scales)
+
+        vectors = cls(concatenate(row_blocks), concatenate(pooled_blocks), dtype, dimensions)
+        logging.info("Compressed %s vectors to %s (%s dimensions): %.1f MB instead of %.1f MB", len(matrix), dtype,
+                     dimensions or matrix.shape[1], vectors.nbytes / 1e6, (matrix.size + len(offsets) * matrix.shape[1]) * 4 / 1e6)
+        return vectors
+
+    @property
+    def nbytes(self) -> int:
+        """The memory held by the compressed vectors, without the rows if they were not read yet."""
+        return (self._rows.nbytes if self._rows is not None else 0) + self.pooled.nbytes
+
+    @classmethod
+    def load(cls, file: str) -> "QuantizedVectors":
+        """Reads the pooled vectors from the file. The rows are read when they are first used."""
+        with np.load(file) as data:
+            dimensions = int(data["dimensions"]) or None
+            pooled = QuantizedMatrix(data["pooled_codes"], data["pooled_scales"] if "pooled_scales" in data else None)
+            # Files written before the row count was saved only tell it by their rows
+            row_count = int(data["row_count"]) if "row_count" in data else len(data["row_codes"])
+            return cls(None, pooled, str(data["dtype"]), dimensions, file=file, row_count=row_count)
+
+    def save(self, file: str) -> None:
+        """Saves the compressed vectors, atomically replacing an existing file."""
+        arrays = {"row_codes": self.rows.codes, "pooled_codes": self.pooled.codes, "row_count": np.array(self.row_count),
+                  "dtype": np.array(self.dtype), "dimensions": np.array(self.dimensions or 0)}
+        if self.rows.scales is not None:
+            arrays["row_scales"] = self.rows.scales
+            arrays["pooled_scales"] = self.pooled.scales
+        # np.savez appends .npz to names that lack it, so write through a file object
+        with open(file + ".tmp", 'wb') as vectors_file:
+            np.savez(vectors_file, **arrays)
+        os.replace(file + ".tmp", file)
+
+    @classmethod
+    def for_store(cls, store: EmbeddingStore, dtype: str,
+                  dimensions: int | None = EMBEDDING_COMPRESSION_DIMENSIONS) -> "QuantizedVectors":
+        """Loads the compressed vectors persisted next to the store, or builds and persists them if there are none yet.
+        Vectors compressed with other settings are rebuilt.
+
+        Args:
+            store (EmbeddingStore): The store to compress.
+            dtype (str): One of QUANTIZATION_DTYPES.
+            dimensions (int | None, optional): Truncate the vectors to this prefix dimension first.
+
+        Returns:
+            QuantizedVectors: The compressed vectors of every chunk and movie in the store.
+        """
+        file = f"{store.path}.{store.generation}.quantized.npz"
+        if os.path.exists(file):
+            vectors = cls.load(file)
+            if vectors.dtype == dtype and vectors.dimensions == dimensions and vectors.row_count == len(store.vectors):
+                return vectors
+            logging.info("Compressed vectors %s do not match the settings, rebuilding them", file)
+        cls.build(store.vectors, store.offsets, dtype, dimensions).save(file)
+        # Loaded back, so the rows are only kept in memory if a search needs them
+        return cls.load(file)
+
+    def prepare_queries(self, queries: np.ndarray) -> np.ndarray:
+        """Truncates and normalizes the queries the same way as the compressed rows."""
+        return truncate_rows(queries, self.dimensions)
@@ -1,8 +1,85 @@
+import asyncio
+import threading
 
+from typing import AsyncIterator, Iterator, List, Tuple
+from Movie import Movie, enrichment_pipeline
+
+_stream_loop = None
+_stream_loop_lock = threading.Lock()
+
+
+def _get_stream_loop() -> asyncio.AbstractEventLoop:
+    """Returns the event loop that runs streams for sync callers. It lives in a daemon thread,
+    so the async HTTP and OpenAI clients bound to it are reused across streams."""
+    global _stream_loop
+    if _stream_loop is None:
+        with _stream_loop_lock:
+            if _stream_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="recommendation-stream", daemon=True).start()
+                _stream_loop = loop
+    return _stream_loop
 
-from typing import List
-from Movie import Movie
 
 class RecommenderInterface:
     def generate_recommendations(self, user_preference: dict[str, str]) -> dict[str, Movie]:
         pass
+
+    async def agenerate_recommendations(self, user_profile) -> dict[str, Movie]:
+        """Async version of generate_recommendations. Recommenders without a native async path run the sync one in a thread."""
+        return await asyncio.to_thread(self.generate_recommendations, user_profile)
+
+    def generate_batch_recommendations(self, user_profiles: List) -> List[dict[str, Movie]]:
+        """Creates recommendations for many user profiles. Recommenders without a batched path handle them one by one.
+
+        Args:
+            user_profiles (List[UserProfile]): The user profiles to recommend movies for.
+
+        Returns:
+            List[dict[str, Movie]]: The recommendations of every profile, in the same order as the profiles.
+        """
+        return [self.generate_recommendations(user_profile) for user_profile in user_profiles]
+
+    async def acandidates(self, user_profile) -> List[dict] | None:
+        """Returns the keyword arguments of every recommended Movie, before it is enriched, so the recommendations can be
+        streamed as they are enriched. Recommenders without a separate candidate step return None, and stream their
+        finished recommendations instead."""
+        return None
+
+    async def astream_recommendations(self, user_profile) -> AsyncIterator[Tuple[str, int, Movie]]:
+        """Streams the recommendations, so clients can show them before every movie is enriched.
+
+        Args:
+            user_profile (UserProfile): The preferences of the user.
+
+        Yields:
+            Tuple[str, int, Movie]: First a ("skeleton", index, movie) for every recommendation, with only the title and year known.
+            Then a ("movie", index, movie) for every movie as soon as its enrichment finishes. The index is the rank of the movie.
+            Without candidates, both are sent for every movie once all recommendations are finished.
+        """
+        candidates = await self.acandidates(user_profile)
+        if candidates is None:
+            recommendations = list((await self.agenerate_recommendations(user_profile)).values())
+            for index, movie in enumerate(recommendations):
+                yield "skeleton", index, movie
+            for index, movie in enumerate(recommendations):
+                yield "movie", index, movie
+            return
+        movies = [Movie(**kwargs, enrich=False) for kwargs in candidates]
+        for index, movie in enumerate(movies):
+            yield "skeleton", index, movie
+        async for index, movie in enrichment_pipeline.aenrich_as_completed(movies):
+            yield "movie", index, movie
+
+    def stream_recommendations(self, user_profile) -> Iterator[Tuple[str, int, Movie]]:
+        """Sync version of astream_recommendations, for Streamlit. The stream runs on a shared background event loop."""
+        loop = _get_stream_loop()
+        stream = self.astream_recommendations(user_profile)
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(stream.__anext__(), loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            asyncio.run_coroutine_threadsafe(stream.aclose(), loop).result()
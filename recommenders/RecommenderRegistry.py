@@ -0,0 +1,114 @@
+import asyncio
+import importlib
+import logging
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict
+from recommenders.Recommender import RecommenderInterface
+
+
+def lazy_factory(module: str, class_name: str) -> Callable[[], RecommenderInterface]:
+    """Returns a factory that only imports the module of the recommender once it is built.
+    The recommender modules pull in numpy and bs4, which would otherwise slow down every startup.
+
+    Args:
+        module (str): The module of the recommender, e.g. "recommenders.SubtitleRecommender".
+        class_name (str): The name of the recommender class in that module.
+
+    Returns:
+        Callable[[], RecommenderInterface]: A factory that builds the recommender.
+    """
+    def build() -> RecommenderInterface:
+        return getattr(importlib.import_module(module), class_name)()
+    return build
+
+
+class RecommenderRegistry:
+    """Builds every recommender once and shares it across requests, so the subtitle and worst movie corpora
+    are loaded a single time instead of on every request.
+
+    warm_up() starts building all recommenders in the background. get() waits for a recommender that is still loading,
+    and retries the build of a recommender that failed before. status() reports the state of every recommender for health checks.
+    """
+    def __init__(self, factories: Dict[str, Callable[[], RecommenderInterface]]):
+        self.factories = factories
+        self._lock = threading.Lock()
+        self._builds: Dict[str, Future] = {}
+        self._load_seconds: Dict[str, float] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(len(factories), 1), thread_name_prefix="recommender-warm-up")
+
+    def _build(self, name: str) -> RecommenderInterface:
+        logging.info("Loading recommender %s", name)
+        start = time.perf_counter()
+        try:
+            recommender = self.factories[name]()
+        except Exception as e:
+            logging.error("Loading recommender %s failed: %s", name, e)
+            raise
+        self._load_seconds[name] = time.perf_counter() - start
+        logging.info("Loaded recommender %s in %.2fs", name, self._load_seconds[name])
+        return recommender
+
+    def _start(self, name: str) -> Future:
+        """Starts building the recommender unless it is loading or loaded already. Failed builds are started again."""
+        with self._lock:
+            build = self._builds.get(name)
+            if build is None or (build.done() and build.exception() is not None):
+                build = self._executor.submit(self._build, name)
+                self._builds[name] = build
+            return build
+
+    def warm_up(self) -> None:
+        """Starts building every recommender in the background."""
+        for name in self.factories:
+            self._start(name)
+
+    def get(self, name: str) -> RecommenderInterface:
+        """Returns the shared recommender, waiting for it if it is still loading.
+
+        Args:
+            name (str): The name the recommender was registered with.
+
+        Raises:
+            KeyError: If no recommender is registered with this name.
+            Exception: Whatever the recommender raised while loading.
+
+        Returns:
+            RecommenderInterface: The loaded recommender.
+        """
+        if name not in self.factories:
+            raise KeyError(name)
+        return self._start(name).result()
+
+    async def aget(self, name: str) -> RecommenderInterface:
+        """Async version of get. Waiting for a recommender that is still loading does not block the event loop."""
+        if name not in self.factories:
+            raise KeyError(name)
+        return await asyncio.wrap_future(self._start(name))
+
+    def status(self) -> Dict[str, dict]:
+        """Returns the state of every recommender: not_started, loading, ready or failed (with the error)."""
+        statuses = {}
+        with self._lock:
+            builds = dict(self._builds)
+        for name in self.factories:
+            build = builds.get(name)
+            if build is None:
+                statuses[name] = {"status": "not_started"}
+            elif not build.done():
+                statuses[name] = {"status": "loading"}
+            elif build.exception() is not None:
+                statuses[name] = {"status": "failed", "error": repr(build.exception())}
+            else:
+                statuses[name] = {"status": "ready", "load_seconds": round(self._load_seconds.get(name, 0.0), 3)}
+        return statuses
+
+    def is_ready(self) -> bool:
+        """True once every recommender is loaded."""
+        return all(status["status"] == "ready" for status in self.status().values())
+
+    def shutdown(self) -> None:
+        """Stops the warm-up threads, without waiting for builds that are still running."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,131 +1,192 @@
-import numpy as np
-import pysrt
-import json
+import asyncio
+import hashlib
 import logging
 import os
 
-from typing import Dict
-from Movie import Movie
-from recommenders.Recommender import RecommenderInterface
-from settings import SRT_JSON_PATH, SRT_PATH, SRT_INTERVAL
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List
+from Movie import Movie, acreate_movies, create_movies
+from recommenders.EmbeddingRecommender import EmbeddingRecommender
+from recommenders.EmbeddingIndex import EmbeddingIndex
+from embedding_store import EmbeddingStore, convert_json_to_store, entries_from_dict
+from settings import SRT_JSON_PATH, SRT_STORE_PATH, SRT_PATH, SRT_INTERVAL, SRT_WINDOW_OVERLAP, SRT_WINDOW_MAX_TOKENS, AMOUNT_OF_MOVIES, SRT_INCREMENTAL_INGESTION, SRT_INGESTION_WORKERS, SUBTITLE_AGGREGATION, EMBEDDING_COMPRESSION
 from auth import get_openai_client
-from helpers import cosine_similarity, create_preference_embedding, create_text_embedding, load_json_data
+from helpers import acreate_preference_embedding, create_preference_embedding, create_text_embeddings
+from rate_limiter import background_priority
+from srt_reader import open_srt, read_cues, iter_windows
 from user_profile import UserProfile
 
+def fingerprint_file(path: str) -> dict:
+    """Fingerprints a file by its size, modification time and content hash.
+
+    Args:
+        path (str): The file to fingerprint.
+
+    Returns:
+        dict: The sha256 of the content, the size and the mtime in nanoseconds.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(block)
+    stat = os.stat(path)
+    return {"sha256": sha256.hexdigest(), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def _parse_srt_path(file_path: str, title: str) -> dict:
+    """Module level, so it can be sent to the worker processes of the ingestion pool."""
+    with open_srt(file_path) as file:
+        return SubtitleLoader._parse_srt_file(file, title)
+
 class SubtitleLoader:
-    """Loads subtitles from a specified folder and saves them to a JSON file for later use.
-    If the JSON file already exists, it will load the subtitles from there instead of parsing the SRT files again.
+    """Loads subtitles from a specified folder and saves them to a binary embedding store for later use.
+    A subtitles.json from before the store existed is converted once instead of being re-embedded.
+
+    Ingestion is incremental: every SRT file is fingerprinted, and only new or changed files are parsed and embedded.
+    Movies whose SRT file was deleted are dropped. Parsing runs across a process pool, and the result is merged
+    into the existing store atomically. Adding one film therefore costs one film's worth of work.
     """
-    def __init__(self, json_path: str, srt_path: str, client):
-        self.json_path = json_path
+    def __init__(self, store_path: str, srt_path: str, client, json_path: str = None, incremental: bool = SRT_INCREMENTAL_INGESTION):
+        self.store_path = store_path
         self.srt_path = srt_path
         self.client = client
+        self.json_path = json_path
+        self.incremental = incremental
     
-    def load_subtitles(self) -> Dict[str, dict]:
-        """Loads the subtitles from the JSON file if it exists, otherwise parses the SRT files and saves them to a JSON file.
+    def load_subtitles(self) -> EmbeddingStore:
+        """Opens the embedding store, converting the legacy JSON file if needed, and ingests new or changed SRT files.
+        Without incremental ingestion an existing store is used as is.
 
         Returns:
-            Dict[str, dict]: A keyvalue pair where key is movie name, and value is a dictionary of the movie subtitles, embeddings, chopped up in intervals of 10 minutes.
+            EmbeddingStore: The store with the subtitle embeddings of every movie, chopped up in intervals of 10 minutes.
         """
-        if os.path.exists(self.json_path):
-            return load_json_data(self.json_path)
-        else:
-            subtitles = self._parse_srt_files(self.srt_path)
-            self._save_to_json(subtitles, self.json_path)
-            return subtitles
+        store = None
+        if EmbeddingStore.exists(self.store_path):
+            store = EmbeddingStore(self.store_path)
+        elif self.json_path and os.path.exists(self.json_path):
+            store = convert_json_to_store(self.json_path, self.store_path)
+        if store is None or self.incremental:
+            store = self.ingest(store)
+        return store
     
-    def _save_to_json(self, subtitles: Dict[str, dict], path: str) -> bool:
-        """If the JSON file does not exist, saves the subtitles to a JSON file. This is to prevent parsing the SRT files every time.
+    def ingest(self, store: EmbeddingStore | None) -> EmbeddingStore:
+        """Synchronizes the store with the SRT folder. Files whose size and mtime did not change are not even hashed.
+        Movies in the store without a fingerprint (converted from JSON) adopt the fingerprint of their current SRT file,
+        and are dropped like any other movie once their SRT file is gone. Without an SRT folder the store is left as is.
+
+        Any change rewrites the whole store, copying the unchanged movies over. That is intended: the store stays a single
+        contiguous matrix per generation, and copying vectors is cheap next to embedding the new movies.
 
         Args:
-            subtitles (Dict[str, dict]): The dictionary which has been created from the SRT files.
-            path (str): Path to save it to. 
+            store (EmbeddingStore | None): The current store, or None to ingest every file.
 
         Returns:
-            bool: True if successful, False otherwise.
+            EmbeddingStore: The up to date store. The same instance if nothing changed.
         """
-        try:
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            with open(path, 'w', encoding='utf-8') as json_file:
-                json.dump(subtitles, json_file, ensure_ascii=False, indent=4)
-            return True
-        except Exception as e:
-            logging.error(f"unexpected error occurred whilst loading JSON: {e}")
-            return False
+        if store is not None and not os.path.isdir(self.srt_path):
+            logging.warning("Subtitle folder %s does not exist, using the embedding store as is", self.srt_path)
+            return store
+        known_sources = store.sources if store is not None else {}
+        known_titles = set(store.titles) if store is not None else set()
+        srt_files = {
+            file.split('.srt')[0]: os.path.join(self.srt_path, file)
+            for file in os.listdir(self.srt_path) if file.endswith('.srt')
+        } if os.path.isdir(self.srt_path) else {}
+
+        sources, changed = {}, {}
+        for title, file_path in srt_files.items():
+            known = known_sources.get(title)
+            stat = os.stat(file_path)
+            if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                sources[title] = known
+                continue
+            fingerprint = fingerprint_file(file_path)
+            sources[title] = fingerprint
+            if known is None and title in known_titles:
+                continue
+            if known is None or known["sha256"] != fingerprint["sha256"]:
+                changed[title] = file_path
+
+        deleted = {title for title in known_titles | set(known_sources) if title not in srt_files}
+        if store is not None and not changed and not deleted and sources == known_sources:
+            return store
+        logging.info("Ingesting subtitles: %s new or changed, %s deleted", len(changed), len(deleted))
+
+        parsed_movies = self._parse_srt_files(changed)
+        new_entries = entries_from_dict(parsed_movies)
+        movies = {}
+        if store is not None:
+            for title in store.titles:
+                if title in deleted or title in changed:
+                    continue
+                movies[title] = store.movie_entries(title)
+        movies.update(new_entries)
+        # Sources without entries (e.g. an empty SRT file) are kept, so they are not parsed again
+        return EmbeddingStore.write(self.store_path, movies, sources=sources)
     
-    def _parse_srt_files(self, srt_folder: str) -> Dict[str, dict]:
+    def _parse_srt_files(self, srt_files: Dict[str, str]) -> Dict[str, dict]:
         """Main method to parse the SRT files and create a dictionary of the subtitles and embeddings.
-        Will loop through the determined folder and parse each SRT file using pysrt. 
-        
-        These will then be delegated to _parse_srt_file to create a dictionary per file. 
+        Every file is parsed in a separate process by _parse_srt_file, to create a dictionary per file.
+        Afterwards, all intervals are embedded at once.
 
         Args:
-            srt_folder (str): The folder where the SRT files are stored.
+            srt_files (Dict[str, str]): Keyvaluepair of movie name and the path of its SRT file.
 
         Returns:
             Dict[str, dict]: Keyvaluepair where key is movie name, and value is a dictionary of the movie subtitles, embeddings, chopped up in intervals of 10 minutes.
         """
-        parsed_movies = {}
-        for file in os.listdir(srt_folder):
-            if file.endswith('.srt'):
-                title = file.split('.srt')[0]
-                file_path = os.path.join(srt_folder, file)
-                subs = pysrt.open(file_path)
-                parsed_movies[title] = self._parse_srt_file(subs, title)
+        if not srt_files:
+            return {}
+        titles = list(srt_files)
+        with ProcessPoolExecutor(max_workers=SRT_INGESTION_WORKERS) as executor:
+            parsed = executor.map(_parse_srt_path, [srt_files[title] for title in titles], titles)
+            parsed_movies = dict(zip(titles, parsed))
+        self._embed_intervals(parsed_movies)
         return parsed_movies
     
-    def _parse_srt_file(self, file: pysrt.SubRipFile, title: str) -> dict:
-        """Parses a single SRT file and creates a dictionary of the subtitles and embeddings."""
-        
-        movie = {}
-        interval_length = SRT_INTERVAL
-        current_interval = 10
-        current_text = ""
-        
-        # Create dictionary entry
-        movie["title"] = title
-        
-        # Loop over subtitles in file. These are already an array thanks to pysrt
-        for sub in file:
-            # Convert the pysrt time to minutes
-            start_time_minutes = sub.start.minutes + sub.start.hours * 60
-            
-            # Calculate the interval with floor division. 
-            # If the interval is different, save the current text and start a new one.
-            interval = start_time_minutes // interval_length
-            if interval != current_interval:
-                if current_text:
-                    movie[current_interval]["text"] = current_text.strip()
-                    
-                # Update interval and text
-                current_interval = interval
-                current_text = ""
-                
-            # Append the text to the current text
-            current_text += f" {sub.text}"
-            
-            # Create a new dictionary entry if this is a new interval
-            if current_interval not in movie:
-                movie[current_interval] = {}
-        
-        # Save the last text
-        if current_text:
-            movie[current_interval]["text"] = current_text.strip()
-            
-        # Loop over the intervals and create embeddings for the text
-        for interval, data in movie.items():
-            if isinstance(data, dict) and "text" in data:
-                response = create_text_embedding(data["text"])
-                movie[interval]["embedding"] = response
+    def _embed_intervals(self, parsed_movies: Dict[str, dict]) -> None:
+        """Embeds the text of every interval of every movie in place. 
+        All texts are sent in a handful of batched requests, instead of one request per interval.
+
+        Args:
+            parsed_movies (Dict[str, dict]): The movies as created by _parse_srt_file.
+        """
+        intervals = [
+            (title, interval) for title, movie in parsed_movies.items() 
+            for interval, data in movie.items() if isinstance(data, dict) and "text" in data
+        ]
+        # Ingestion gives way to interactive requests that wait for the same rate limits. The embeddings are kept in the
+        # embedding store, so they skip the content cache instead of pushing cached completions out of it.
+        with background_priority():
+            embeddings = create_text_embeddings([parsed_movies[title][interval]["text"] for title, interval in intervals], use_cache=False)
+        for (title, interval), embedding in zip(intervals, embeddings):
+            parsed_movies[title][interval]["embedding"] = embedding
+    
+    @staticmethod
+    def _parse_srt_file(file: Iterable[str], title: str) -> dict:
+        """Parses a single SRT file and creates a dictionary of the subtitles per window, see srt_reader.py.
+        Windows are SRT_INTERVAL minutes long and overlap by SRT_WINDOW_OVERLAP minutes, and are split when their text
+        would exceed SRT_WINDOW_MAX_TOKENS. Embeddings are added by _embed_intervals.
+
+        Args:
+            file (Iterable[str]): The lines of the SRT file, read one at a time.
+            title (str): The title of the movie.
+
+        Returns:
+            dict: The title, and the text of every window by its key.
+        """
+        movie = {"title": title}
+        length = SRT_INTERVAL * 60 if SRT_INTERVAL is not None else None
+        for window in iter_windows(read_cues(file), length, SRT_WINDOW_OVERLAP * 60, SRT_WINDOW_MAX_TOKENS):
+            movie[window.key] = {"text": window.text}
         return movie
 
-class SubtitleRecommender(RecommenderInterface):
+class SubtitleRecommender(EmbeddingRecommender):
     """My experimental recommender. It uses subtitles embeddings from movies to recommend movies based on user preferences.
     This does not work 100%. It uses cosine similarity to compare the user profile to the embeddings of the subtitles.
     
-    In order to use this recommender, you will either need to have the /data/json/subtitles.json file or the SRT files in the /data/subtitles folder.
+    In order to use this recommender, you will either need to have the /data/store/subtitles.* store, the /data/json/subtitles.json file or the SRT files in the /data/subtitles folder.
     
-    If you want to add more movies, you can add SRT files to the /data/subtitles folder, delete the /data/json/subtitles.json file and run the api or streamlit.
+    If you want to add more movies, you can add SRT files to the /data/subtitles folder and run the api or streamlit. Only the new files are embedded.
     If you add a subtitle, please use the format <title> <year>.srt. For example: "The Matrix (1999).srt"
 
     #TODO Make this recommender user friendly. Does not work well with the current setup.
@@ -133,8 +194,12 @@ class SubtitleRecommender(RecommenderInterface):
         RecommenderInterface (_type_): The basic recommender interface. Used for compatibility.
     """
     def __init__(self) -> None:
-        subtitle_loader = SubtitleLoader(SRT_JSON_PATH, SRT_PATH, get_openai_client())
+        subtitle_loader = SubtitleLoader(SRT_STORE_PATH, SRT_PATH, get_openai_client(), json_path=SRT_JSON_PATH)
         self.subtitles = subtitle_loader.load_subtitles()
+        # Built once, so a query is a single matrix-vector product instead of a loop over every interval.
+        # Large corpora get an approximate IVF index, small ones are scored exactly.
+        self.index = EmbeddingIndex.from_store(self.subtitles, approximate=None, aggregation=SUBTITLE_AGGREGATION,
+                                               compression=EMBEDDING_COMPRESSION)
     
     def generate_recommendations(self, user_profile: UserProfile) -> Dict[str, Movie]:
         """Creates recommendations based on the user profile. It uses cosine similarity to compare the user profile to the embeddings of the subtitles.
@@ -143,41 +208,30 @@ class SubtitleRecommender(RecommenderInterface):
             user_profile (UserProfile): The UserProfile class that was provided 
 
         Returns:
-            Dict[str, Movie]: returns an ordered dictionary of movies with the title as key and the Movie class as value.
+            Dict[str, Movie]: returns an ordered dictionary of the top movies with the title as key and the Movie class as value.
         """
         # Create embedding for the user profile
         logging.debug("Generating recommendations based on subtitles")
         user_embedding = create_preference_embedding(user_profile)
-        movie_scores = []
         
-        # Loop over the subtitles and calculate the similarity
-        for title, movie in self.subtitles.items():
-            interval_embeddings = [
-                data["embedding"] for interval, data in movie.items() if isinstance(data, dict) and "embedding" in data
-            ]
-            if not interval_embeddings:
-                continue
-            similarities = [cosine_similarity(user_embedding, np.array(embedding)) for embedding in interval_embeddings]
-            average_similarity = np.mean(similarities)
-            # Append the title and average similarity to the movie_scores list
-            movie_scores.append((title, average_similarity))
-            
-        logging.debug("Recommendation scores calculated")
-        # Sort it by the similarity. This is [x[1]] because the tuple is (title, similarity)
-        movie_scores.sort(key=lambda x: x[1], reverse=True)
-        logging.debug("Recommendations sorted")
-        logging.debug("The top 5 recommendations are:")
-        for title, score in movie_scores[:5]:
+        # Average similarity over the intervals of every movie, only the top movies are returned
+        movie_scores = self.index.search(user_embedding, AMOUNT_OF_MOVIES)
+        logging.debug("The top %s recommendations are:", AMOUNT_OF_MOVIES)
+        for title, score in movie_scores:
             logging.debug("%s: %s", title, score)
             
-        movie_dict = {}
-        
         logging.debug("Creating Movie classes for recommendations")
-        # Create a Movie class for each movie and add it to the movie_dict
-        for movie_name, score in movie_scores:
-            movie_name_clean = movie_name.strip()
-            title, year = map(str.strip, movie_name_clean.split('(', 1))
-            year = year.split(')', 1)[0]
-            movie = Movie(title=title, year=year, user_profile=user_profile)
-            movie_dict[movie_name] = movie
-        return movie_dict
+        # Create a Movie class for each movie, these are enriched concurrently
+        movie_names = [movie_name for movie_name, _ in movie_scores]
+        return dict(zip(movie_names, create_movies(self._movie_specs(movie_names, user_profile))))
+
+    async def agenerate_recommendations(self, user_profile: UserProfile) -> Dict[str, Movie]:
+        """Async version of generate_recommendations. The index search runs in a thread, so scanning the vectors does not block the event loop."""
+        user_embedding = await acreate_preference_embedding(user_profile)
+        movie_names = [movie_name for movie_name, _ in await asyncio.to_thread(self.index.search, user_embedding, AMOUNT_OF_MOVIES)]
+        return dict(zip(movie_names, await acreate_movies(self._movie_specs(movie_names, user_profile))))
+
+    async def acandidates(self, user_profile: UserProfile) -> List[dict]:
+        user_embedding = await acreate_preference_embedding(user_profile)
+        movie_names = [movie for movie, _ in await asyncio.to_thread(self.index.search, user_embedding, AMOUNT_OF_MOVIES)]
+        return self._movie_specs(movie_names, user_profile)
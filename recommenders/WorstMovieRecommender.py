@@ -1,14 +1,17 @@
+import asyncio
 import logging
 import os
-import requests
-import json
 
-from typing import Dict
+from typing import Dict, List
 from bs4 import BeautifulSoup
-from Movie import Movie
-from recommenders.Recommender import RecommenderInterface
-from settings import WIKIPEDIA_JSON_PATH, AMOUNT_OF_MOVIES, WORST_WIKIPEDIA_URL
-from helpers import cosine_similarity, create_preference_embedding, create_text_embedding, load_json_data
+from Movie import Movie, acreate_movies, create_movies
+from http_client import http_get
+from rate_limiter import background_priority
+from recommenders.EmbeddingRecommender import EmbeddingRecommender
+from recommenders.EmbeddingIndex import EmbeddingIndex
+from embedding_store import EmbeddingStore, convert_json_to_store, entries_from_dict
+from settings import WIKIPEDIA_JSON_PATH, WIKIPEDIA_STORE_PATH, AMOUNT_OF_MOVIES, WORST_WIKIPEDIA_URL, EMBEDDING_COMPRESSION
+from helpers import acreate_preference_embedding, create_preference_embedding, create_text_embeddings
 from user_profile import UserProfile
 
 class WikipediaMovieFetcher:
@@ -16,7 +19,7 @@ class WikipediaMovieFetcher:
         self.url = url
     
     def fetch_movies(self) -> Dict[str, dict]:
-        response = requests.get(self.url)
+        response = http_get(self.url, service="wikipedia")
         soup = BeautifulSoup(response.text, 'html.parser')
         movies = {}
         movie_name = ""
@@ -29,40 +32,48 @@ class WikipediaMovieFetcher:
         return movies
 
 class JsonDataHandler:
-    """Handles the loading and saving of JSON data for the worst movies of all time. 
+    """Handles the loading and saving of the embedded worst movies of all time. 
     Is different from SubtitleLoader.py due to different internal structure.  
+    The data is saved to a binary embedding store, a worst_movies.json from before the store existed is converted once.
     """
-    def __init__(self, path: str):
+    def __init__(self, path: str, store_path: str):
         self.path = path
+        self.store_path = store_path
     
+    def load_data(self) -> EmbeddingStore | None:
+        """Opens the embedding store, converting the legacy JSON file if needed.
 
+        Returns:
+            EmbeddingStore | None: The store, or None if neither the store nor the JSON file exists.
+        """
+        if EmbeddingStore.exists(self.store_path):
+            return EmbeddingStore(self.store_path)
+        if os.path.exists(self.path):
+            return convert_json_to_store(self.path, self.store_path)
+        return None
     
-    def save_data(self, data: Dict[str, dict]) -> bool:
+    def save_data(self, data: Dict[str, dict]) -> EmbeddingStore | None:
         try:
-            os.makedirs(os.path.dirname(self.path), exist_ok=True)
-            with open(self.path, 'w', encoding='utf-8') as json_file:
-                json.dump(data, json_file, ensure_ascii=False, indent=4)
-            return True
+            return EmbeddingStore.write(self.store_path, entries_from_dict(data))
         except Exception as e:
             logging.error(f"An error occurred while saving data: {e}")
-            return False
+            return None
 
-class WorstMovieRecommender(RecommenderInterface):
+class WorstMovieRecommender(EmbeddingRecommender):
     """My implementation of a movie recommender system based on the worst movies of all time from wikipedia. 
     Args:
         RecommenderInterface (_type_): The recommender interface which this class implements.
     """
     def __init__(self) -> None:
-        self.json_data_handler = JsonDataHandler(path=WIKIPEDIA_JSON_PATH)
+        self.json_data_handler = JsonDataHandler(path=WIKIPEDIA_JSON_PATH, store_path=WIKIPEDIA_STORE_PATH)
         self.movie_fetcher = WikipediaMovieFetcher(url=WORST_WIKIPEDIA_URL)
      
-        # Check if the JSON file exists, if not fetch the data and save it to a JSON file.
-        json_file_path = self.json_data_handler.path
-        if os.path.exists(json_file_path):
-            self.wikipedia_movies = load_json_data(json_file_path)
-        else:
-            self.wikipedia_movies = self._fetch_and_embed_movies()
-            self.json_data_handler.save_data(self.wikipedia_movies)
+        # Check if the store exists, if not fetch the data and save it to a store.
+        self.wikipedia_movies = self.json_data_handler.load_data()
+        if self.wikipedia_movies is None:
+            self.wikipedia_movies = self.json_data_handler.save_data(self._fetch_and_embed_movies())
+        # Every movie has a single plot embedding, so the index mean is the plain cosine similarity
+        self.index = EmbeddingIndex.from_store(self.wikipedia_movies, compression=EMBEDDING_COMPRESSION)
         
     def _fetch_and_embed_movies(self) -> Dict[str, dict]:
         """Fetches the movies from the wikipedia page and embeds the plot of each movie.
@@ -70,13 +81,16 @@ class WorstMovieRecommender(RecommenderInterface):
         Returns:
             Dict[str, dict]: A list of movies with their respective plots and embeddings.
         """
-        movies = self.movie_fetcher.fetch_movies()
-        for movie, data in movies.items():
-            embedding = create_text_embedding(data["plot"])
+        # Building the corpus gives way to interactive requests that wait for the same rate limits
+        with background_priority():
+            movies = self.movie_fetcher.fetch_movies()
+            # Only movies with a plot can be embedded, all plots are embedded in a few batched requests
+            titles = [movie for movie, data in movies.items() if "plot" in data]
+            embeddings = create_text_embeddings([movies[movie]["plot"] for movie in titles])
+        for movie, embedding in zip(titles, embeddings):
             movies[movie]["embedding"] = embedding
         return movies
 
-
     def generate_recommendations(self, user_profile: UserProfile) -> Dict[str, Movie]:
         """Parse the user profile, compare it to the wikipedia movies and return the top movies.
 
@@ -89,23 +103,19 @@ class WorstMovieRecommender(RecommenderInterface):
         # Create an embedding of the user profile
         user_profile_embedding = create_preference_embedding(user_profile)
 
-        # Compare the user profile embedding to the wikipedia movies
-        movie_similarities = []
-        for movie, data in self.wikipedia_movies.items():
-            similarity = cosine_similarity(user_profile_embedding, data["embedding"])
-            movie_similarities.append((movie, similarity))
+        # Compare the user profile embedding to the wikipedia movies and get the top movies
+        top_movies = [movie for movie, _ in self.index.search(user_profile_embedding, AMOUNT_OF_MOVIES)]
         
-        # Sort the movies by similarity and get the top movies. x[1] is the similarity score, as the list is a tuple (movie, similarity)
-        movie_similarities.sort(key=lambda x: x[1], reverse=True)
-        top_movies = [movie for movie, _ in movie_similarities[:AMOUNT_OF_MOVIES]]
-        
-        # Create a dictionary of the top movies
-        movie_dict = {}
-        for movie_name in top_movies:
-            movie_name_clean = movie_name.strip()
-            title, year = map(str.strip, movie_name_clean.split('(', 1))
-            year = year.split(')', 1)[0]
-            movie = Movie(title=title, year=year, user_profile=user_profile)
-            movie_dict[movie_name] = movie
-            
-        return movie_dict
+        # Create a dictionary of the top movies, these are enriched concurrently
+        return dict(zip(top_movies, create_movies(self._movie_specs(top_movies, user_profile))))
+
+    async def agenerate_recommendations(self, user_profile: UserProfile) -> Dict[str, Movie]:
+        """Async version of generate_recommendations. The index search runs in a thread, so scanning the vectors does not block the event loop."""
+        user_profile_embedding = await acreate_preference_embedding(user_profile)
+        top_movies = [movie for movie, _ in await asyncio.to_thread(self.index.search, user_profile_embedding, AMOUNT_OF_MOVIES)]
+        return dict(zip(top_movies, await acreate_movies(self._movie_specs(top_movies, user_profile))))
+
+    async def acandidates(self, user_profile: UserProfile) -> List[dict]:
+        user_profile_embedding = await acreate_preference_embedding(user_profile)
+        top_movies = [movie for movie, _ in await asyncio.to_thread(self.index.search, user_profile_embedding, AMOUNT_OF_MOVIES)]
+        return self._movie_specs(top_movies, user_profile)
@@ -2,17 +2,131 @@ OMDB_URL = "http://www.omdbapi.com/"
 TMDB_URL = "https://api.themoviedb.org/3/"
 TMDB_DISCOVERY_URL = "https://api.themoviedb.org/3/discover/movie?include_adult=false&include_video=false&language=en-US&page=1&sort_by=popularity.desc"
 WORST_WIKIPEDIA_URL = "https://en.wikipedia.org/wiki/List_of_films_considered_the_worst"
+WIKIPEDIA_API_URL = "https://en.wikipedia.org/w/api.php"
+# Longer plots from Wikipedia are cut off after this many characters
+WIKIPEDIA_PLOT_MAX_LENGTH = 2500
 
 AMOUNT_OF_MOVIES = 5
 
 WIKIPEDIA_JSON_PATH = "data/json/worst_movies.json"
 SRT_JSON_PATH = "data/json/subtitles.json"
+# Binary embedding stores, see embedding_store.py. The JSON files above are only read to convert them once.
+WIKIPEDIA_STORE_PATH = "data/store/worst_movies"
+SRT_STORE_PATH = "data/store/subtitles"
 SRT_PATH = "data/subtitles/"
-# The minute interval used to split SRT files by
+# SQLite file shared by the persistent caches, see cache.py
+CACHE_PATH = "data/cache/cache.sqlite3"
+# Plots imported from a Wikipedia dump, see movie_data/wikipedia_dump.py. Looked up before Wikipedia itself,
+# which is only asked for movies missing from the store if WIKIPEDIA_PLOT_STORE_FALLBACK is set (and always without a store).
+WIKIPEDIA_PLOT_STORE_PATH = "data/store/wikipedia_plots.sqlite3"
+WIKIPEDIA_PLOT_STORE_FALLBACK = True
+# Local catalogue of IMDb titles, see movie_data/title_catalogue.py. Titles are resolved against it before OMDB is asked for the
+# details by IMDb id. Fuzzy matches must share TITLE_CATALOGUE_MIN_SIMILARITY of their trigrams with the requested title.
+TITLE_CATALOGUE_PATH = "data/store/titles.sqlite3"
+TITLE_CATALOGUE_TYPES = ("movie", "tvMovie")
+TITLE_CATALOGUE_MIN_SIMILARITY = 0.5
+# The minute interval used to split SRT files by. Consecutive intervals overlap by SRT_WINDOW_OVERLAP minutes, and an interval
+# whose text would exceed SRT_WINDOW_MAX_TOKENS estimated tokens is split, so it fits the embedding model (8191 tokens for
+# text-embedding-3). With SRT_INTERVAL set to None, intervals are as long as SRT_WINDOW_MAX_TOKENS allows. See srt_reader.py.
 SRT_INTERVAL = 10 
+SRT_WINDOW_OVERLAP = 0
+SRT_WINDOW_MAX_TOKENS = 8000
+# Sync the subtitle store with SRT_PATH on every load, only new or changed files are parsed and embedded
+SRT_INCREMENTAL_INGESTION = True
+# Processes used to parse SRT files, None uses every CPU
+SRT_INGESTION_WORKERS = None
+
+# OMDB lookups are cached, "Movie not found!" answers for a shorter time. Times are in seconds.
+OMDB_CACHE_TTL = 7 * 24 * 60 * 60
+OMDB_NEGATIVE_CACHE_TTL = 6 * 60 * 60
+OMDB_CACHE_MAX_ENTRIES = 50000
+
+# Embeddings and completions are cached by a hash of (model, input, max_tokens), see ContentCache in cache.py
+CONTENT_CACHE_TTL = 30 * 24 * 60 * 60
+CONTENT_CACHE_MEMORY_ENTRIES = 1024
+CONTENT_CACHE_MAX_ENTRIES = 100000
+
+# Texts are embedded in batches, see embedder.py. The API allows up to 2048 inputs per request.
+EMBEDDING_BATCH_MAX_ITEMS = 256
+EMBEDDING_BATCH_MAX_TOKENS = 100000
+EMBEDDING_BATCH_CONCURRENCY = 4
+
+# How the subtitle recommender combines the similarities of the intervals of a movie: "mean" (scored against one pooled
+# vector per movie, the cheapest), "max", "top_k" (mean of the AGGREGATION_TOP_K best intervals) or "softmax" (weighted by
+# the softmax of the similarities at AGGREGATION_TEMPERATURE, lower is closer to max).
+SUBTITLE_AGGREGATION = "mean"
+AGGREGATION_TOP_K = 3
+AGGREGATION_TEMPERATURE = 0.05
+
+# Compressed copies of the subtitle and worst movie vectors ("float16", "int8" or None for no compression), searched first
+# before the best AMOUNT_OF_MOVIES * RERANK_CANDIDATES movies are re-ranked on the float32 vectors. The compressed copy
+# can also be truncated to its first EMBEDDING_COMPRESSION_DIMENSIONS dimensions, e.g. 512 for text-embedding-3 models.
+EMBEDDING_COMPRESSION = None
+EMBEDDING_COMPRESSION_DIMENSIONS = None
+RERANK_CANDIDATES = 10
+
+# Batch recommendations score many profiles at once. A chunk of profiles holds at most this many interval similarities (4 bytes each).
+BATCH_SCORING_MAX_SCORES = 2 ** 26
+
+# Subtitle corpora with at least IVF_MIN_ROWS intervals are searched with an approximate IVF index, see recommenders/IVFIndex.py.
+# A query visits the IVF_NPROBE most similar of IVF_N_LISTS lists (None picks about 4 * sqrt(intervals)). More lists probed means better recall, but slower queries.
+IVF_MIN_ROWS = 100000
+IVF_NPROBE = 16
+IVF_N_LISTS = None
+IVF_KMEANS_ITERATIONS = 10
+IVF_TRAINING_SAMPLE = 50000
+
+# TMDB genres, popular actors and keyword ids are refreshed after this many seconds, keyword ids are resolved concurrently.
+# Keywords TMDB does not know are searched again after TMDB_KEYWORD_NEGATIVE_TTL seconds.
+TMDB_REFERENCE_TTL = 24 * 60 * 60
+TMDB_KEYWORD_CONCURRENCY = 8
+TMDB_KEYWORD_NEGATIVE_TTL = 60 * 60
+TMDB_KEYWORD_MAX_ENTRIES = 10000
+
+# The Streamlit app shows the same recommendations again for the same system and preferences within this many seconds.
+# At most STREAMLIT_RESULTS_MAX_ENTRIES results are kept, shared by every session.
+STREAMLIT_RESULTS_TTL = 60 * 60
+STREAMLIT_RESULTS_MAX_ENTRIES = 1000
+
+# Shared HTTP client for TMDB, OMDB and Wikipedia, see http_client.py. Timeouts are in seconds.
+HTTP_TIMEOUT = 10.0
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+# 429 and 5xx responses and connection errors are retried with exponential backoff, starting at HTTP_BACKOFF seconds
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF = 0.5
+
+# Rate limits of the external services, shared by every process through RATE_LIMIT_PATH, see rate_limiter.py.
+# Every bucket is (capacity, period in seconds) and refills continuously, so the OMDB day quota is spread over the day.
+# OpenAI calls take a request and their estimated tokens. Interactive calls fail instead of waiting longer than
+# RATE_LIMIT_MAX_WAIT seconds, background corpus builds wait as long as it takes and give way to interactive calls.
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_PATH = "data/cache/rate_limits.sqlite3"
+RATE_LIMITS = {
+    "omdb": {"requests": (1000, 24 * 60 * 60)},
+    "tmdb": {"requests": (40, 10)},
+    "wikipedia": {"requests": (100, 1)},
+    "openai": {"requests": (3500, 60), "tokens": (200000, 60)},
+    "openai_embeddings": {"requests": (3000, 60), "tokens": (1000000, 60)},
+}
+RATE_LIMIT_MAX_WAIT = 30.0
+RATE_LIMIT_POLL_INTERVAL = 0.25
+
+# Latency histograms of every external call and pipeline stage, and call, token and cache counters, served on /metrics
+# of the API, see metrics.py. Turned off, an instrumented call only checks a flag.
+METRICS_ENABLED = False
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Adds a Server-Timing header with the time spent per stage to the /recommend responses, works without METRICS_ENABLED
+SERVER_TIMING = False
 
 # TODO fix consistency of amount of movies used
 
+# Concurrency of the Movie enrichment pipeline, see enrichment.py.
+# ENRICHMENT_MAX_MOVIES movies are enriched at the same time, every stage has its own limit of concurrent calls.
+ENRICHMENT_MAX_MOVIES = 5
+ENRICHMENT_STAGE_LIMITS = {"omdb": 5, "wikipedia": 5, "openai": 5}
+
 
 OPENAI_MODEL = "gpt-3.5-turbo-1106" # Alternatively, gpt-4, gpt-4-turbo, gpt-4o, gpt-4o-mini
 
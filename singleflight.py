@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import weakref
+
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable
+from metrics import metrics
+
+
+class SingleFlight:
+    """Coalesces identical calls that are in flight at the same time. The first caller of a key does the call,
+    callers that ask for the same key before it finishes wait for its result instead of making the call themselves.
+    Errors are shared the same way. Once the call finishes the key is forgotten, caching the result is up to the caller.
+
+    Threads are coalesced with do, coroutines with ado. Coroutines are coalesced per event loop.
+    """
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): Names the flight in the counters, e.g. "omdb".
+        """
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        # asyncio tasks are bound to an event loop, so the async path keeps its calls per loop
+        self._async_calls = weakref.WeakKeyDictionary()
+        self.calls = 0
+        self.coalesced = 0
+
+    def _count(self, coalesced: bool) -> None:
+        with self._lock:
+            if coalesced:
+                self.coalesced += 1
+            else:
+                self.calls += 1
+        if coalesced:
+            metrics.count("coalesced_calls_total", flight=self.name)
+
+    def do(self, key: Hashable, function: Callable[..., Any], *args) -> Any:
+        """Calls function(*args), unless a call for the same key is in flight already.
+
+        Args:
+            key (Hashable): Identifies the call, e.g. the normalized title of a lookup.
+            function (Callable[..., Any]): Performs the actual call.
+
+        Returns:
+            Any: The result of the call, shared with every caller of the same key.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        self._count(coalesced=not leader)
+        if not leader:
+            return future.result()
+        try:
+            result = function(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def ado(self, key: Hashable, function: Callable[..., Awaitable[Any]], *args) -> Any:
+        """Async version of do, where function is a coroutine function.
+        The call runs as a task of its own, so a caller that is cancelled does not cancel it for the others."""
+        loop = asyncio.get_running_loop()
+        calls = self._async_calls.get(loop)
+        if calls is None:
+            calls = self._async_calls[loop] = {}
+        task = calls.get(key)
+        self._count(coalesced=task is not None)
+        if task is None:
+            task = calls[key] = asyncio.ensure_future(function(*args))
+
+            def forget(task: asyncio.Task) -> None:
+                calls.pop(key, None)
+                # Retrieves the exception, in case every caller was cancelled before it came in
+                if not task.cancelled():
+                    task.exception()
+            task.add_done_callback(forget)
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the amount of calls made and the amount of calls that waited for another one instead."""
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced}
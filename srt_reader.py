@@ -0,0 +1,141 @@
+import codecs
+import math
+import re
+
+from typing import IO, Dict, Iterable, Iterator, List, NamedTuple
+from embedder import estimate_tokens
+
+TIMING = re.compile(r"(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})\s*-->\s*(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})")
+BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+
+
+class Cue(NamedTuple):
+    """A single subtitle, with its start and end in seconds and its lines joined by newlines like pysrt does."""
+    start: float
+    end: float
+    text: str
+
+
+class Window(NamedTuple):
+    """The text of the cues that start within a window of a subtitle track, which is embedded as a single chunk.
+    The key is the number of the window, with the part appended if the window was split to stay under the token cap."""
+    key: str
+    start: float
+    end: float
+    text: str
+
+
+def _seconds(hours: str, minutes: str, seconds: str, milliseconds: str) -> float:
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds) + int(milliseconds.ljust(3, "0")) / 1000
+
+
+def read_cues(lines: Iterable[str]) -> Iterator[Cue]:
+    """Parses SRT lines into cues, one cue at a time, so a file is never held in memory as a whole.
+    Cue numbers are not needed and may be missing, cues without timing or text are skipped.
+
+    Args:
+        lines (Iterable[str]): The lines of an SRT file, e.g. an open text file.
+
+    Returns:
+        Iterator[Cue]: The cues in the order of the file.
+    """
+    timing, text = None, []
+    for line in lines:
+        line = line.strip()
+        match = TIMING.match(line) if "-->" in line else None
+        if match is not None:
+            # A timing line without a blank line before it starts a new cue. A number right above it is its cue number.
+            if timing is not None:
+                if text and text[-1].isdigit():
+                    text.pop()
+                if text:
+                    yield Cue(timing[0], timing[1], "\n".join(text))
+            timing, text = (_seconds(*match.groups()[:4]), _seconds(*match.groups()[4:])), []
+        elif not line:
+            if timing is not None and text:
+                yield Cue(timing[0], timing[1], "\n".join(text))
+            timing, text = None, []
+        elif timing is not None:
+            text.append(line)
+    if timing is not None and text:
+        yield Cue(timing[0], timing[1], "\n".join(text))
+
+
+def open_srt(path: str) -> IO[str]:
+    """Opens an SRT file as text. Like pysrt the encoding is taken from the byte order mark, UTF-8 otherwise,
+    and bytes that are not valid in it are replaced instead of failing the whole file."""
+    with open(path, "rb") as file:
+        start = file.read(4)
+    encoding = next((encoding for bom, encoding in BOMS if start.startswith(bom)), "utf-8")
+    return open(path, encoding=encoding, errors="replace", newline=None)
+
+
+def iter_windows(cues: Iterable[Cue], length: float | None, overlap: float = 0, max_tokens: int | None = None) -> Iterator[Window]:
+    """Groups cues into windows of a fixed length, which overlap by the given amount, in a single pass over the cues.
+    Only the windows a cue can still fall into are kept, so memory is bounded by the window length and not the track.
+    The text of a window is joined once when it is complete, instead of being concatenated cue by cue.
+
+    Windows start every length - overlap seconds, and cues belong to every window they start in. A window whose
+    estimated tokens would exceed max_tokens is split into parts, so every window fits the embedding model.
+
+    Args:
+        cues (Iterable[Cue]): The cues, in the order of the track.
+        length (float | None): The length of a window in seconds. None makes windows as long as max_tokens allows.
+        overlap (float, optional): The seconds every window shares with the next. Only used with a length.
+        max_tokens (int | None, optional): The maximum estimated tokens of a window. None for no maximum.
+
+    Returns:
+        Iterator[Window]: The windows with text, in the order they are completed. Empty windows are skipped.
+    """
+    if length is None:
+        if max_tokens is None:
+            raise ValueError("Windows need a length, a token cap or both")
+        length, overlap = math.inf, 0
+    step = length - overlap
+    if step <= 0:
+        raise ValueError(f"The overlap of a window ({overlap}s) must be shorter than the window ({length}s)")
+
+    # The parts of the text, estimated tokens, split count and start and end of every open window, by number
+    open_windows: Dict[int, list] = {}
+    # Windows with a lower number are complete
+    closed = 0
+
+    def close(number: int) -> Window:
+        parts, _, split, start, end = open_windows[number]
+        if length == math.inf:
+            key = str(split)
+        else:
+            key = str(number) if split == 0 else f"{number}.{split}"
+        return Window(key, start, end, " ".join(parts))
+
+    for cue in cues:
+        if length == math.inf:
+            first = last = 0
+        else:
+            first = max(math.floor((cue.start - length) / step) + 1, closed)
+            # A cue that is out of order goes to the first window that is still open
+            last = max(int(cue.start // step), first)
+        # Cues come in order of their start, so windows that end before this cue are complete
+        for number in sorted(number for number in open_windows if number < first):
+            yield close(number)
+            del open_windows[number]
+        closed = first
+        tokens = estimate_tokens(cue.text)
+        for number in range(first, last + 1):
+            window = open_windows.get(number)
+            if window is not None and max_tokens is not None and window[1] + tokens > max_tokens:
+                yield close(number)
+                window = open_windows[number] = [[], 0, window[2] + 1, cue.start, cue.end]
+            elif window is None:
+                window = open_windows[number] = [[], 0, 0, cue.start, cue.end]
+            window[0].append(cue.text)
+            window[1] += tokens
+            window[4] = max(window[4], cue.end)
+    for number in sorted(open_windows):
+        yield close(number)
+
+
+def read_windows(path: str, length: float | None, overlap: float = 0, max_tokens: int | None = None) -> List[Window]:
+    """Reads the windows of an SRT file, streaming the file line by line. See iter_windows for the arguments."""
+    with open_srt(path) as file:
+        return list(iter_windows(read_cues(file), length, overlap, max_tokens))